@@ -0,0 +1,66 @@
+"""
+benchmark for the float and the fixed-point implementation of the Austin ramp.
+only the step intervals are computed, no steps are made.
+runs without a TMC or Raspberry Pi attached; the pins are written to FakeGpioMem
+"""
+import sys
+import timeit
+from src.TMC_2209_StepperDriver import *
+
+STEPS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+
+print("---")
+print("SCRIPT START")
+print("---")
+
+TMC_gpio.use_gpio_mem(FakeGpioMem())
+tmc = TMC_2209(21, 16, 20, serialport=None, skip_uart_init=True, loglevel=Loglevel.ERROR)
+
+
+def ramp_intervals(compute_new_speed, steps = STEPS):
+    """computes the step intervals of one movement over the given µsteps"""
+    tmc.set_current_position(0)
+    tmc._target_pos = steps
+    tmc._stop = StopMode.NO
+    tmc._speed = 0.0
+    tmc._n = 0
+    tmc._n_fx = 0
+    tmc._cn_fx = 0
+    compute_new_speed()
+    intervals = []
+    while tmc._speed != 0.0 and tmc.distance_to_go() != 0:
+        intervals.append(tmc._step_interval)
+        tmc._current_pos += 1
+        compute_new_speed()
+    return intervals
+
+
+# trapezoids and triangles
+for steps, max_speed, acceleration in [(STEPS, 4000, 8000), (5000, 4000, 40000),
+                                       (4040, 2000, 1200), (505, 1000, 1000),
+                                       (300, 4000, 8000)]:
+    tmc.set_max_speed(max_speed)
+    tmc.set_acceleration(acceleration)
+    intervals_float = ramp_intervals(tmc.compute_new_speed, steps)
+    intervals_fixed = ramp_intervals(tmc.compute_new_speed_fixed, steps)
+    max_diff = max(abs(a - b) for a, b in zip(intervals_float, intervals_fixed))
+    print(f"{steps:6} steps at {max_speed}/{acceleration}: "
+          f"{len(intervals_float)} float / {len(intervals_fixed)} fixed-point steps, "
+          f"max interval difference: {max_diff:.3f} µs")
+
+tmc.set_max_speed(4000)
+tmc.set_acceleration(8000)
+
+for name, compute_new_speed in [("float", tmc.compute_new_speed),
+                                ("fixed-point", tmc.compute_new_speed_fixed)]:
+    duration = min(timeit.repeat(lambda f=compute_new_speed: ramp_intervals(f),
+                                 number=1, repeat=5))
+    print(f"{name:12}: {STEPS / duration:12.0f} steps per second")
+
+tmc.set_deinitialize_true()
+
+
+print("---")
+print("SCRIPT FINISHED")
+print("---")
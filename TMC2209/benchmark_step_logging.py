@@ -0,0 +1,57 @@
+"""
+benchmark for the cost of MOVEMENT logging on the per step hot path.
+times make_a_step, which checks the loglevel on every step,
+against pulse_step, which the planned stepping loops call
+when movement logging is off.
+runs without a TMC or Raspberry Pi attached; the STEP pin is written to FakeGpioMem
+"""
+import sys
+import timeit
+import logging
+from src.TMC_2209_StepperDriver import *
+
+STEPS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+
+print("---")
+print("SCRIPT START")
+print("---")
+
+TMC_gpio.use_gpio_mem(FakeGpioMem())
+tmc = TMC_2209(21, 16, 20, serialport=None, skip_uart_init=True, loglevel=Loglevel.INFO)
+# only the python overhead is measured, not the busy-waited pulse width
+tmc._min_pulse_width = 0
+
+
+def step_loop(step):
+    """makes STEPS steps with the given step method"""
+    for _ in range(STEPS):
+        step()
+
+
+def best_of(step):
+    """returns the shortest time of 5 runs of the step loop in seconds"""
+    return min(timeit.repeat(lambda: step_loop(step), number=1, repeat=5))
+
+
+pulse = best_of(tmc.pulse_step)
+checked = best_of(tmc.make_a_step)
+print(f"{'pulse_step':22}: {pulse / STEPS * 1e9:8.1f} ns per step")
+print(f"{'make_a_step':22}: {checked / STEPS * 1e9:8.1f} ns per step")
+print(f"{'loglevel check':22}: {(checked - pulse) / STEPS * 1e9:8.1f} ns per step")
+
+# movement logging on, but the messages are not written anywhere
+tmc.tmc_logger.set_loglevel(Loglevel.MOVEMENT)
+tmc.tmc_logger.remove_all_handlers()
+tmc.tmc_logger.add_handler(logging.NullHandler())
+tmc.tmc_logger.logger.propagate = False
+logged = best_of(tmc.make_a_step)
+print(f"{'logged make_a_step':22}: {logged / STEPS * 1e9:8.1f} ns per step")
+
+
+tmc.set_deinitialize_true()
+del tmc
+
+print("---")
+print("SCRIPT FINISHED")
+print("---")
@@ -0,0 +1,107 @@
+"""
+benchmark for the crc and the frames of the UART register access.
+compares the bitwise crc and the list frames, as they were,
+with the crc table and the preallocated frames of TMC_UART.
+the frames are not sent and the pause between frames is 0.
+write_reg only queues the frame for the thread of the bus;
+runs without a TMC attached
+"""
+import sys
+import time
+import timeit
+from src._TMC_2209_logger import TMC_logger, Loglevel
+from src._TMC_2209_uart import TMC_UART, TMC_UART_Bus
+
+FRAMES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+print("---")
+print("SCRIPT START")
+print("---")
+
+
+class SerialSink:
+    """takes the frames instead of a serial port, converted like pyserial does"""
+
+    def write(self, data):
+        """converts the frame to bytes and returns its length"""
+        return len(bytes(data))
+
+    def reset_output_buffer(self):
+        """nothing to reset"""
+
+    def reset_input_buffer(self):
+        """nothing to reset"""
+
+    def close(self):
+        """nothing to close"""
+
+
+def crc8_bitwise(datagram, initial_value=0):
+    """TMC_UART.compute_crc8_atm as it was before the crc table"""
+    crc = initial_value
+    for byte in datagram:
+        for _ in range(0, 8):
+            if (crc >> 7) ^ (byte & 0x01):
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+            byte = byte >> 1
+    return crc
+
+
+w_frame_list = [0x55, 0, 0, 0, 0, 0, 0, 0]
+
+
+def write_reg_before(ser, mtr_id, register, val):
+    """TMC_UART.write_reg as it was before"""
+    ser.reset_output_buffer()
+    ser.reset_input_buffer()
+    w_frame_list[1] = mtr_id
+    w_frame_list[2] = register | 0x80
+    w_frame_list[3] = 0xFF & (val>>24)
+    w_frame_list[4] = 0xFF & (val>>16)
+    w_frame_list[5] = 0xFF & (val>>8)
+    w_frame_list[6] = 0xFF & val
+    w_frame_list[7] = crc8_bitwise(w_frame_list[:-1])
+    rtn = ser.write(w_frame_list)
+    time.sleep(uart.bus.communication_pause)
+    return rtn == len(w_frame_list)
+
+
+def drain():
+    """waits until the thread of the bus has taken all queued frames,
+    so that a backlog of one round does not slow down the next one
+    and flush_serial_buffer does not wait for it"""
+    while uart.bus._queue.qsize():
+        time.sleep(0.001)
+
+
+sink = SerialSink()
+uart = TMC_UART(TMC_logger(Loglevel.ERROR, "benchmark"), None, 115200)
+uart.bus = TMC_UART_Bus(uart.tmc_logger, SerialSink(), 0)
+
+reply = bytes([0x05, 0xFF, 0x6A, 0x00, 0x00, 0x01, 0x23])
+for value in range(256):
+    assert crc8_bitwise([value, 0x12, 0x6A]) == uart.compute_crc8_atm([value, 0x12, 0x6A])
+assert crc8_bitwise(reply) == uart.compute_crc8_atm(reply)
+
+uart.write_reg(0x22, -12345)
+write_reg_before(sink, 0, 0x22, -12345)
+assert bytes(uart.w_frame) == bytes(w_frame_list)
+print("crc table and frames match the bitwise implementation")
+
+for name, function in [
+        ("reply crc bitwise", lambda: crc8_bitwise(reply)),
+        ("reply crc table", lambda: uart.compute_crc8_atm(reply)),
+        ("write_reg before", lambda: write_reg_before(sink, 0, 0x22, 0x10000)),
+        ("write_reg now", lambda: uart.write_reg(0x22, 0x10000))]:
+    duration = min(timeit.repeat(function, setup=drain, number=FRAMES, repeat=5))
+    print(f"{name:20}: {duration / FRAMES * 1e6:6.2f} µs per frame")
+drain()
+uart.flush_serial_buffer()
+
+
+print("---")
+print("SCRIPT FINISHED")
+print("---")
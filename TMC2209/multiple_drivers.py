@@ -35,12 +35,7 @@ tmc2.set_movement_abs_rel(MovementAbsRel.ABSOLUTE)
 for tmc in [tmc1, tmc2]:
 
     tmc.tmc_logger.set_loglevel(Loglevel.DEBUG)
-    tmc.set_direction_reg(False)
-    tmc.set_current(300)
-    tmc.set_interpolation(True)
-    tmc.set_spreadcycle(False)
-    tmc.set_microstepping_resolution(2)
-    tmc.set_internal_rsense(False)
+    tmc.apply_profile(DEFAULT_PROFILE)
     tmc.set_motor_enabled(True)
     tmc.set_acceleration(1000)
     tmc.set_max_speed(SPEED)
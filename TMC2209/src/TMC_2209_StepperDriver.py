@@ -17,10 +17,19 @@ import time
 import statistics
 import logging
 from ._TMC_2209_GPIO_board import TMC_gpio, Gpio, GpioMode, GpioPUD
+from ._TMC_2209_GPIO_mmap import GpioMem, FakeGpioMem
 from ._TMC_2209_uart import TMC_UART as tmc_uart
 from ._TMC_2209_logger import TMC_logger, Loglevel
-from ._TMC_2209_move import MovementAbsRel, MovementPhase, StopMode, Direction, MAX_STEPS_ALLOWED
+from ._TMC_2209_move import (MovementAbsRel, MovementPhase, StopMode, Direction, RampMode,
+                             MotionBackend, MAX_STEPS_ALLOWED)
+from ._TMC_2209_ramp import RampProfile
+from ._TMC_2209_corexy import TMC_CoreXY
+from ._TMC_2209_process import TMC_CoreXYProcess
+from ._TMC_2209_scheduler import StepScheduler
+from ._TMC_2209_jitter import StepJitterRecorder
+from ._TMC_2209_profile import DEFAULT_PROFILE, load_profile
 from . import _TMC_2209_math as tmc_math
+from . import _TMC_2209_reg as tmc_reg
 
 
 
@@ -33,23 +42,46 @@ class TMC_2209:
     """
 
     from ._TMC_2209_comm import (
-        read_drv_status, read_gconf, read_gstat, clear_gstat, read_ioin, read_chopconf,
+        batch, read_drv_status, read_gconf, read_gstat, clear_gstat, read_ioin, read_chopconf,
         get_direction_reg, set_direction_reg, get_iscale_analog, set_iscale_analog,get_vsense,
         set_vsense, get_internal_rsense, set_internal_rsense, set_irun_ihold, set_pdn_disable,
-        set_current, get_spreadcycle, set_spreadcycle, get_interpolation, set_interpolation,
-        read_microstepping_resolution, get_microstepping_resolution, set_microstepping_resolution,
-        set_mstep_resolution_reg_select, get_interface_transmission_counter, get_tstep, set_vactual,
+        set_current, set_current_boost, get_spreadcycle, set_spreadcycle, get_interpolation,
+        set_interpolation, read_microstepping_resolution, get_microstepping_resolution,
+        set_microstepping_resolution, change_microstepping_resolution,
+        set_mstep_resolution_reg_select,
+        get_interface_transmission_counter,
+        get_warm_start_state, restore_warm_start_state,
+        set_mscnt_direction, set_mscnt_reference, check_position, get_tstep, set_vactual,
         get_stallguard_result, set_stallguard_threshold, set_coolstep_threshold,
+        set_stealthchop_threshold, set_stealthchop_max_speed, get_stealthchop_max_speed,
         get_microstep_counter, get_microstep_counter_in_steps, set_toff
     )
 
     from ._TMC_2209_move import (
         set_movement_abs_rel, get_current_position, set_current_position, set_max_speed,
         set_max_speed_fullstep, get_max_speed, set_acceleration, set_acceleration_fullstep,
-        get_acceleration, stop, get_movement_phase, run_to_position_steps,
-        run_to_position_revolutions, run_to_position_steps_threaded,
+        get_acceleration, stop, set_jitter_recorder, get_jitter_recorder, set_motion_backend,
+        set_ramp_mode, set_ramp_profile, get_ramp_profile,
+        _set_movement_phase, get_movement_phase, estimate_duration_steps,
+        run_to_position_steps, _run_to_position_steps, run_to_position_revolutions,
+        run_to_position_steps_threaded, _run_queued_movement,
         run_to_position_revolutions_threaded, wait_for_movement_finished_threaded, run,
-        distance_to_go, compute_new_speed, run_speed, make_a_step
+        run_planned, distance_to_go, _compute_new_speed, compute_new_speed,
+        compute_new_speed_fixed, run_speed, make_a_step,
+        pulse_step
+    )
+
+    from ._TMC_2209_vactual import (
+        set_vactual_update_interval, set_vactual_creep_speed, run_vactual,
+        _vactual_position_from_mscnt
+    )
+
+    from ._TMC_2209_homing import (
+        home_stallguard, _home_approach
+    )
+
+    from ._TMC_2209_profile import (
+        apply_profile
     )
 
     from ._TMC_2209_test import (
@@ -58,6 +90,7 @@ class TMC_2209:
 
     tmc_uart = None
     tmc_logger = None
+    step_scheduler = None
     _pin_step = -1
     _pin_dir = -1
     _pin_en = -1
@@ -66,6 +99,7 @@ class TMC_2209:
     _direction = True
 
     _stop = StopMode.NO
+    _stop_count = 0                 # amount of stops issued with stop
     _starttime = 0
     _sg_callback = None
 
@@ -88,11 +122,32 @@ class TMC_2209:
     _c0 = 0                         # Initial step size in microseconds
     _cn = 0                         # Last step size in microseconds
     _cmin = 0                       # Min step size in microseconds based on maxSpeed
+    _n_fx = 0                       # _n in fixed-point (steps * 2^16)
+    _cn_fx = 0                      # _cn in fixed-point (µs * 2^16)
+    _c0_fx = 0                      # _c0 in fixed-point (µs * 2^16)
+    _cmin_fx = 0                    # _cmin in fixed-point (µs * 2^16)
+    _stop_k = 0                     # Precomputed numerator of Equation 16 in fixed-point
     _sg_threshold = 100             # threshold for stallguard
+    _stealthchop_max_speed = 0      # speed of the StealthChop/SpreadCycle switch; 0: off
+    _cs_irun = None                 # run current scale of set_current
+    _cs_ihold = 0                   # hold current scale of set_current
+    _ihold_delay = 0                # hold current delay of set_current
+    _cs_irun_boost = None           # run current scale while accelerating; None: no boost
+    _gstat_at_init = None           # GSTAT before it was cleared by the init
+    _ifcnt_at_init = None           # IFCNT before the first write of the init
+    _mscnt_ref = None               # MSCNT and position in 1/256 µsteps of set_mscnt_reference
+    _mscnt_direction = 1            # 1: MSCNT counts up for positive movements; -1: down
     _movement_abs_rel = MovementAbsRel.ABSOLUTE
     _movement_phase = MovementPhase.STANDSTILL
+    _ramp_mode = RampMode.PLANNED
+    _ramp_profile = RampProfile.TRAPEZOID
+    _motion_backend = MotionBackend.STEP_DIR
+    _vactual_update_interval = 0.02  # time between two VACTUAL updates in seconds
+    _vactual_creep_speed = 50       # speed for the final position correction in µsteps/s
 
-    _movement_thread = None
+    _jitter_recorder = None
+    _motion_worker = None
+    _movement_future = None
 
     _deinit_finished = False
 
@@ -126,14 +181,16 @@ class TMC_2209:
             logprefix = f"TMC2209 {driver_address}"
         self.tmc_logger = TMC_logger(loglevel, logprefix, log_handlers, log_formatter)
         self.tmc_uart = tmc_uart(self.tmc_logger, serialport, baudrate, driver_address)
+        self.step_scheduler = StepScheduler()
 
 
         self.tmc_logger.log("Init", Loglevel.INFO)
         TMC_gpio.init(gpio_mode)
 
         self.tmc_logger.log(f"EN Pin: {pin_en}", Loglevel.DEBUG)
-        self._pin_en = pin_en
-        TMC_gpio.gpio_setup(self._pin_en, GpioMode.OUT, initial=Gpio.HIGH)
+        if pin_en != -1:
+            self._pin_en = pin_en
+            TMC_gpio.gpio_setup(self._pin_en, GpioMode.OUT, initial=Gpio.HIGH)
 
         self.tmc_logger.log(f"STEP Pin: {pin_step}", Loglevel.DEBUG)
         if pin_step != -1:
@@ -149,6 +206,8 @@ class TMC_2209:
 
         if not skip_uart_init:
             self.read_steps_per_rev()
+            self._gstat_at_init = self.tmc_uart.read_int(tmc_reg.GSTAT)
+            self._ifcnt_at_init = self.tmc_uart.read_int(tmc_reg.IFCNT)
             self.clear_gstat()
 
         self.tmc_uart.flush_serial_buffer()
@@ -164,7 +223,8 @@ class TMC_2209:
         if self._deinit_finished is False:
             self.tmc_logger.log("Deinit", Loglevel.INFO)
 
-            self.set_motor_enabled(False)
+            if self._pin_en != -1:
+                self.set_motor_enabled(False)
 
             self.tmc_logger.log("GPIO cleanup", Loglevel.INFO)
             if self._pin_step != -1:
@@ -177,6 +237,9 @@ class TMC_2209:
                 TMC_gpio.gpio_remove_event_detect(self._pin_stallguard)
                 TMC_gpio.gpio_cleanup(self._pin_stallguard)
 
+            if self._motion_worker is not None:
+                self._motion_worker.shutdown()
+
             self.tmc_logger.log("Deinit finished", Loglevel.INFO)
             self._deinit_finished= True
         else:
@@ -286,19 +349,27 @@ class TMC_2209:
 
         self.tmc_logger.log(f"Testing homing with threshold = {threshold}", Loglevel.INFO)
         self.set_spreadcycle(0)
+        # StallGuard only works in StealthChop, so the switch to SpreadCycle is disabled
+        stealthchop_max_speed = self._stealthchop_max_speed
+        if stealthchop_max_speed:
+            self.set_stealthchop_max_speed(0)
         if direction == Direction.CCW:
             steps = MAX_STEPS_ALLOWED * (-1)
         elif direction == Direction.CW:
             steps = MAX_STEPS_ALLOWED
-        self.run_to_position_steps_threaded(steps, MovementAbsRel.RELATIVE)
-        #print("Position: ", self.get_current_position())
-        while self.get_movement_phase() != MovementPhase.STANDSTILL:
-            stallguard_result = self.get_stallguard_result()
-
-            if (self.get_movement_phase() == MovementPhase.MAXSPEED and
-                stallguard_result < threshold):
-                #print("Position: ", self.get_current_position())
-                self.stop()
-                break
-
-        self.wait_for_movement_finished_threaded()
+        try:
+            self.run_to_position_steps_threaded(steps, MovementAbsRel.RELATIVE)
+            #print("Position: ", self.get_current_position())
+            while self.get_movement_phase() != MovementPhase.STANDSTILL:
+                stallguard_result = self.get_stallguard_result()
+
+                if (self.get_movement_phase() == MovementPhase.MAXSPEED and
+                    stallguard_result < threshold):
+                    #print("Position: ", self.get_current_position())
+                    self.stop()
+                    break
+
+            self.wait_for_movement_finished_threaded()
+        finally:
+            if stealthchop_max_speed:
+                self.set_stealthchop_max_speed(stealthchop_max_speed)
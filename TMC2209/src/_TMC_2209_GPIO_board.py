@@ -1,3 +1,4 @@
+import time
 from os.path import exists
 from enum import Enum, IntEnum
 from ._TMC_2209_logger import TMC_logger, Loglevel
@@ -20,16 +21,33 @@ class GpioPUD(IntEnum):
     PUD_DOWN = 21
 
 
-from RPi import GPIO
-            
+# RPi.GPIO is only needed for the pin setup and the inputs;
+# without it the outputs can be written through a GpioMem backend
+try:
+    from RPi import GPIO
+except ImportError:
+    GPIO = None
+
 class TMC_gpio:
     """TMC_gpio class"""
 
     _gpios = [None] * 200
+    _gpio_mem = None
+
+    @staticmethod
+    def use_gpio_mem(gpio_mem):
+        """write outputs through a memory mapped GPIO backend (GpioMem)
+        instead of RPi.GPIO; None switches back to RPi.GPIO"""
+        TMC_gpio._gpio_mem = gpio_mem
 
     @staticmethod
     def init(gpio_mode=None):
-        """init gpio library"""
+        """init gpio library; without RPi.GPIO a GpioMem backend has to be set"""
+        if GPIO is None:
+            if TMC_gpio._gpio_mem is None:
+                raise ImportError("RPi.GPIO is not installed; "
+                                  "set a GpioMem backend with TMC_gpio.use_gpio_mem")
+            return
         GPIO.setwarnings(False)
         if gpio_mode is None:
             gpio_mode = GPIO.BCM
@@ -43,6 +61,10 @@ class TMC_gpio:
         initial = int(initial)
         pull_up_down = int(pull_up_down)
         mode = int(mode)
+        if GPIO is None:
+            if mode == GpioMode.OUT:
+                TMC_gpio._gpio_mem.output(pin, initial)
+            return
         if mode == GpioMode.OUT: # TODO: better way to pass different params
             GPIO.setup(pin, mode, initial=initial)
         else:
@@ -51,26 +73,59 @@ class TMC_gpio:
     @staticmethod
     def gpio_cleanup(pin):
         """cleanup gpio pin"""
-        GPIO.cleanup(pin)
+        if GPIO is not None:
+            GPIO.cleanup(pin)
 
     @staticmethod
     def gpio_input(pin):
         """get input value of gpio pin"""
-        del pin
-        return 0 # TODO: implement
+        if TMC_gpio._gpio_mem is not None:
+            return TMC_gpio._gpio_mem.input(pin)
+        return GPIO.input(pin)
 
     @staticmethod
     def gpio_output(pin, value):
         """set output value of gpio pin"""
-        GPIO.output(pin, value)
+        if TMC_gpio._gpio_mem is not None:
+            TMC_gpio._gpio_mem.output(pin, value)
+        else:
+            GPIO.output(pin, value)
+
+    @staticmethod
+    def gpio_output_multi(pins, value):
+        """set the same output value on several gpio pins with one call"""
+        if TMC_gpio._gpio_mem is not None:
+            TMC_gpio._gpio_mem.output_multi(pins, value)
+        else:
+            GPIO.output(list(pins), value)
+
+    @staticmethod
+    def gpio_pulse_multi(pins, width_ns):
+        """set several gpio pins HIGH for the given time and then LOW again"""
+        TMC_gpio.gpio_output_multi(pins, Gpio.HIGH)
+        end = time.perf_counter_ns() + width_ns
+        while time.perf_counter_ns() < end:
+            pass
+        TMC_gpio.gpio_output_multi(pins, Gpio.LOW)
+
+    @staticmethod
+    def gpio_pulse(pin, width_ns):
+        """set gpio pin HIGH for the given time and then LOW again.
+        the pulse width is busy-waited, because sleep is much too coarse"""
+        TMC_gpio.gpio_output(pin, Gpio.HIGH)
+        end = time.perf_counter_ns() + width_ns
+        while time.perf_counter_ns() < end:
+            pass
+        TMC_gpio.gpio_output(pin, Gpio.LOW)
 
     @staticmethod
     def gpio_add_event_detect(pin, callback):
-        """add event detect"""
+        """add event detect; needs RPi.GPIO"""
         GPIO.add_event_detect(pin, GPIO.RISING, callback=callback,
                                 bouncetime=300)
 
     @staticmethod
     def gpio_remove_event_detect(pin):
         """remove event dectect"""
-        GPIO.remove_event_detect(pin)
+        if GPIO is not None:
+            GPIO.remove_event_detect(pin)
@@ -0,0 +1,176 @@
+#pylint: disable=invalid-name
+"""
+TMC_2209 memory mapped GPIO module
+
+writes the GPIO SET/CLR registers of the BCM2835/BCM2711 (Raspberry Pi 1-4)
+directly through /dev/gpiomem. one output costs a single register write
+instead of a call into RPi.GPIO.
+pin modes are still configured by RPi.GPIO
+"""
+
+import os
+import mmap
+
+GPIOMEM_SIZE = 4096
+
+# register offsets in 32bit words
+GPSET0 = 0x1C // 4
+GPCLR0 = 0x28 // 4
+GPLEV0 = 0x34 // 4
+
+
+
+class GpioMem:
+    """GpioMem
+
+    output backend for TMC_gpio which uses the memory mapped GPIO registers
+    """
+
+    _mem = None
+    _regs = None
+    _masks = None
+
+
+
+    def __init__(self, device = "/dev/gpiomem"):
+        """constructor
+
+        Args:
+            device (str): GPIO memory device (Default value = "/dev/gpiomem")
+        """
+        fd = os.open(device, os.O_RDWR | os.O_SYNC)
+        try:
+            self._mem = mmap.mmap(fd, GPIOMEM_SIZE, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._regs = memoryview(self._mem).cast("I")
+        self._masks = {}
+
+
+
+    def close(self):
+        """unmaps the GPIO registers"""
+        if self._regs is not None:
+            self._regs.release()
+            self._regs = None
+        if self._mem is not None:
+            self._mem.close()
+            self._mem = None
+
+
+
+    def output(self, pin, value):
+        """sets one pin HIGH or LOW
+
+        Args:
+            pin (int): BCM pin number
+            value (int): Gpio.HIGH or Gpio.LOW
+        """
+        if value:
+            self._regs[GPSET0 + (pin >> 5)] = 1 << (pin & 31)
+        else:
+            self._regs[GPCLR0 + (pin >> 5)] = 1 << (pin & 31)
+
+
+
+    def output_multi(self, pins, value):
+        """sets several pins HIGH or LOW with one register write per bank
+
+        Args:
+            pins (tuple): BCM pin numbers
+            value (int): Gpio.HIGH or Gpio.LOW
+        """
+        masks = self._masks.get(pins)
+        if masks is None:
+            masks = self._masks[pins] = self._compute_masks(pins)
+        reg = GPSET0 if value else GPCLR0
+        for bank, mask in masks:
+            self._regs[reg + bank] = mask
+
+
+
+    @staticmethod
+    def _compute_masks(pins):
+        """computes the register masks of a group of pins
+
+        Args:
+            pins (tuple): BCM pin numbers
+
+        Returns:
+            tuple: (bank, mask) tuples
+        """
+        masks = {}
+        for pin in pins:
+            masks[pin >> 5] = masks.get(pin >> 5, 0) | 1 << (pin & 31)
+        return tuple(masks.items())
+
+
+
+    def input(self, pin):
+        """reads the level of one pin
+
+        Args:
+            pin (int): BCM pin number
+
+        Returns:
+            int: 1 for HIGH, 0 for LOW
+        """
+        return (self._regs[GPLEV0 + (pin >> 5)] >> (pin & 31)) & 1
+
+
+
+class FakeGpioMem(GpioMem):
+    """FakeGpioMem
+
+    GpioMem on anonymous memory for machines without /dev/gpiomem.
+    it keeps the pin levels in the GPLEV registers like the hardware
+    and counts the writes per pin
+    """
+
+    writes = None
+
+
+
+    def __init__(self):
+        """constructor"""
+        # pylint: disable=super-init-not-called
+        self._mem = mmap.mmap(-1, GPIOMEM_SIZE)
+        self._regs = memoryview(self._mem).cast("I")
+        self._masks = {}
+        self.writes = {}
+
+
+
+    def output(self, pin, value):
+        """sets one pin HIGH or LOW
+
+        Args:
+            pin (int): BCM pin number
+            value (int): Gpio.HIGH or Gpio.LOW
+        """
+        super().output(pin, value)
+        bank = pin >> 5
+        if value:
+            self._regs[GPLEV0 + bank] |= self._regs[GPSET0 + bank]
+        else:
+            self._regs[GPLEV0 + bank] &= ~self._regs[GPCLR0 + bank] & 0xFFFFFFFF
+        self.writes[pin] = self.writes.get(pin, 0) + 1
+
+
+
+    def output_multi(self, pins, value):
+        """sets several pins HIGH or LOW with one register write per bank
+
+        Args:
+            pins (tuple): BCM pin numbers
+            value (int): Gpio.HIGH or Gpio.LOW
+        """
+        super().output_multi(pins, value)
+        for bank, mask in self._masks[pins]:
+            if value:
+                self._regs[GPLEV0 + bank] |= mask
+            else:
+                self._regs[GPLEV0 + bank] &= ~mask & 0xFFFFFFFF
+        for pin in pins:
+            self.writes[pin] = self.writes.get(pin, 0) + 1
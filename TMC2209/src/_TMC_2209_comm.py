@@ -7,8 +7,33 @@ TMC_2209 stepper driver communication module
 """
 
 import math
+from contextlib import contextmanager
 from ._TMC_2209_logger import Loglevel
+from ._TMC_2209_move import MovementAbsRel
 from . import _TMC_2209_reg as tmc_reg
+from . import _TMC_2209_math as tmc_math
+
+
+
+@contextmanager
+def batch(self):
+    """queues the verified register writes of the settings in the with block
+    and sends them back to back at its end. all of them are verified
+    with one IFCNT read instead of one per write.
+    the writes are dropped if the block raises an exception
+
+    Example:
+        with tmc.batch():
+            tmc.set_interpolation(True)
+            tmc.set_spreadcycle(False)
+    """
+    self.tmc_uart.begin_batch()
+    try:
+        yield self
+    except BaseException:
+        self.tmc_uart.abort_batch()
+        raise
+    self.tmc_uart.end_batch()
 
 
 
@@ -234,7 +259,7 @@ def set_direction_reg(self, direction):
     Args:
         direction (bool): direction of the motor False = CCW; True = CW
     """
-    gconf = self.tmc_uart.read_int(tmc_reg.GCONF)
+    gconf = self.tmc_uart.read_int_cached(tmc_reg.GCONF)
     if direction:
         self.tmc_logger.log("write inverse motor direction", Loglevel.INFO)
         gconf = self.tmc_uart.set_bit(gconf, tmc_reg.shaft)
@@ -262,7 +287,7 @@ def set_iscale_analog(self,en):
     Args:
         en (bool): True=Vref, False=5V
     """
-    gconf = self.tmc_uart.read_int(tmc_reg.GCONF)
+    gconf = self.tmc_uart.read_int_cached(tmc_reg.GCONF)
     if en:
         self.tmc_logger.log("activated Vref for current scale", Loglevel.INFO)
         gconf = self.tmc_uart.set_bit(gconf, tmc_reg.i_scale_analog)
@@ -294,7 +319,7 @@ def set_vsense(self,en):
     Args:
         en (bool):
     """
-    chopconf = self.tmc_uart.read_int(tmc_reg.CHOPCONF)
+    chopconf = self.tmc_uart.read_int_cached(tmc_reg.CHOPCONF)
     if en:
         self.tmc_logger.log("activated High sensitivity, low sense resistor voltage",
                             Loglevel.INFO)
@@ -333,7 +358,7 @@ def set_internal_rsense(self,en):
       en (bool): which sense resistor voltage is used; true will propably destroy your tmc
 
         """
-    gconf = self.tmc_uart.read_int(tmc_reg.GCONF)
+    gconf = self.tmc_uart.read_int_cached(tmc_reg.GCONF)
     if en:
         self.tmc_logger.log("activated internal sense resistors.",
                             Loglevel.INFO)
@@ -350,14 +375,18 @@ def set_internal_rsense(self,en):
 
 
 
-def set_irun_ihold(self, ihold, irun, ihold_delay):
+def set_irun_ihold(self, ihold, irun, ihold_delay, verify = True):
     """sets the current scale (CS) for Running and Holding
-    and the delay, when to be switched to Holding current
+    and the delay, when to be switched to Holding current.
+    IHOLD_IRUN is write only, so the write is skipped
+    if it equals the shadow copy of the last written value
 
     Args:
       ihold (int): multiplicator for current while standstill [0-31]
       irun (int): current while running [0-31]
       ihold_delay (int): delay after standstill for switching to ihold [0-15]
+      verify (bool): whether the write is verified with IFCNT; without it
+        the write costs one UART frame (Default value = True)
 
         """
     ihold_irun = 0
@@ -365,10 +394,13 @@ def set_irun_ihold(self, ihold, irun, ihold_delay):
     ihold_irun = ihold_irun | ihold << 0
     ihold_irun = ihold_irun | irun << 8
     ihold_irun = ihold_irun | ihold_delay << 16
-    self.tmc_logger.log(f"ihold_irun: {bin(ihold_irun)}", Loglevel.INFO)
-
-    self.tmc_logger.log("writing ihold_irun", Loglevel.INFO)
-    self.tmc_uart.write_reg_check(tmc_reg.IHOLD_IRUN, ihold_irun)
+    if ihold_irun == self.tmc_uart.get_shadow(tmc_reg.IHOLD_IRUN):
+        return
+    self.tmc_logger.log(f"writing ihold_irun: {bin(ihold_irun)}", Loglevel.INFO)
+    if verify:
+        self.tmc_uart.write_reg_check(tmc_reg.IHOLD_IRUN, ihold_irun)
+    else:
+        self.tmc_uart.write_reg(tmc_reg.IHOLD_IRUN, ihold_irun)
 
 
 
@@ -381,7 +413,7 @@ def set_pdn_disable(self,pdn_disable):
     Args:
         pdn_disable (bool): whether PDN should be disabled
     """
-    gconf = self.tmc_uart.read_int(tmc_reg.GCONF)
+    gconf = self.tmc_uart.read_int_cached(tmc_reg.GCONF)
     if pdn_disable:
         self.tmc_logger.log("enabled PDN_UART", Loglevel.INFO)
         gconf = self.tmc_uart.set_bit(gconf, tmc_reg.pdn_disable)
@@ -440,12 +472,32 @@ def set_current(self, run_current, hold_current_multiplier = 0.5,
     self.tmc_logger.log(f"actual current: {round(run_current_actual)} mA",
                         Loglevel.INFO)
 
+    self._cs_irun = cs_irun
+    self._cs_ihold = CS_IHold
+    self._ihold_delay = hold_current_delay
     self.set_irun_ihold(CS_IHold, cs_irun, hold_current_delay)
 
     self.set_pdn_disable(pdn_disable)
 
 
 
+def set_current_boost(self, factor):
+    """raises the run current by the given factor while the motor accelerates
+    or decelerates. during cruise and standstill the current of set_current is used.
+    set_current has to be called first
+
+    Args:
+        factor (float): current multiplier during acceleration; 1 turns the boost off
+    """
+    if factor == 1 or self._cs_irun is None:
+        self._cs_irun_boost = None
+        return
+    # the current is proportional to CS+1
+    self._cs_irun_boost = min(max(round((self._cs_irun + 1) * factor - 1), 0), 31)
+    self.tmc_logger.log(f"cs_irun boost: {self._cs_irun_boost}", Loglevel.INFO)
+
+
+
 def get_spreadcycle(self):
     """reads spreadcycle
 
@@ -464,7 +516,7 @@ def set_spreadcycle(self,en_spread):
       en_spread (bool): true to enable spreadcycle; false to enable stealthchop
 
         """
-    gconf = self.tmc_uart.read_int(tmc_reg.GCONF)
+    gconf = self.tmc_uart.read_int_cached(tmc_reg.GCONF)
     if en_spread:
         self.tmc_logger.log("activated Spreadcycle", Loglevel.INFO)
         gconf = self.tmc_uart.set_bit(gconf, tmc_reg.en_spreadcycle)
@@ -492,7 +544,7 @@ def set_interpolation(self, en):
     Args:
         en (bool): true to enable internal µstep interpolation
     """
-    chopconf = self.tmc_uart.read_int(tmc_reg.CHOPCONF)
+    chopconf = self.tmc_uart.read_int_cached(tmc_reg.CHOPCONF)
 
     if en:
         chopconf = self.tmc_uart.set_bit(chopconf, tmc_reg.intpol)
@@ -515,7 +567,7 @@ def set_toff(self, toff):
     toff = toff & 0x0F
 
     # Read the current value of the CHOPCONF register
-    chopconf = self.tmc_uart.read_int(tmc_reg.CHOPCONF)
+    chopconf = self.tmc_uart.read_int_cached(tmc_reg.CHOPCONF)
 
     # Zero out the lower four bits of the CHOPCONF register
     chopconf = chopconf & 0xFFFFFFF0
@@ -569,7 +621,7 @@ def set_microstepping_resolution(self, msres):
     Args:
         msres (int): µstep resolution; has to be a power of 2 or 1 for fullstep
     """
-    chopconf = self.tmc_uart.read_int(tmc_reg.CHOPCONF)
+    chopconf = self.tmc_uart.read_int_cached(tmc_reg.CHOPCONF)
     #setting all bits to zero
     chopconf = chopconf & (~tmc_reg.msres0 | ~tmc_reg.msres1 |
                             ~tmc_reg.msres2 | ~tmc_reg.msres3)
@@ -590,6 +642,38 @@ def set_microstepping_resolution(self, msres):
 
 
 
+def change_microstepping_resolution(self, msres):
+    """changes the µstep resolution between two movements and rescales
+    the position, the speeds and the acceleration to the new resolution,
+    so that the motor keeps its physical position and speed settings.
+    before switching to a coarser resolution the motor makes up to half a
+    coarse step to the nearest position which exists in both resolutions
+
+    Args:
+        msres (int): new µstep resolution; has to be a power of 2 or 1 for fullstep
+    """
+    old_msres = self._msres
+    if msres == old_msres:
+        return
+    if msres < old_msres:
+        factor = old_msres // msres
+        aligned = round(self._current_pos / factor) * factor
+        if aligned != self._current_pos:
+            self.run_to_position_steps(aligned, MovementAbsRel.ABSOLUTE)
+
+    self.set_microstepping_resolution(msres)
+    scale = msres / old_msres
+    self._current_pos = round(self._current_pos * scale)
+    self._target_pos = self._current_pos
+    self._max_speed_homing *= scale
+    # TPWMTHRS is a TSTEP value in 1/256 µsteps and does not change
+    self._stealthchop_max_speed *= scale
+    self.set_max_speed(self._max_speed * scale)
+    self.set_acceleration(self._acceleration * scale)
+    self.tmc_logger.log(f"changed µstep resolution from {old_msres} to {msres}", Loglevel.INFO)
+
+
+
 def set_mstep_resolution_reg_select(self, en):
     """sets the register bit "mstep_reg_select" to 1 or 0 depending to the given value.
     this is needed to set the microstep resolution via UART
@@ -598,7 +682,7 @@ def set_mstep_resolution_reg_select(self, en):
     Args:
         en (bool): true to set µstep resolution via UART
     """
-    gconf = self.tmc_uart.read_int(tmc_reg.GCONF)
+    gconf = self.tmc_uart.read_int_cached(tmc_reg.GCONF)
 
     if en is True:
         gconf = self.tmc_uart.set_bit(gconf, tmc_reg.mstep_reg_select)
@@ -624,6 +708,133 @@ def get_interface_transmission_counter(self):
 
 
 
+def get_warm_start_state(self):
+    """returns what is needed to trust the current position after a restart:
+    the position, the microstep resolution and the interface transmission counter.
+    the state is only valid as long as the motor stays enabled;
+    a disabled motor can be turned by hand or snap to the next fullstep
+
+    Returns:
+        dict: warm start state
+    """
+    return {
+        "position": self._current_pos,
+        "msres": self._msres,
+        "ifcnt": self.tmc_uart.read_int(tmc_reg.IFCNT),
+        "mscnt_ref": self._mscnt_ref
+    }
+
+
+
+def restore_warm_start_state(self, state):
+    """restores the position of a saved warm start state, if the driver
+    was neither reset nor written to since the state was saved
+    and MSCNT still matches the saved position.
+    GSTAT and IFCNT are taken from the init, before GSTAT was cleared
+
+    Args:
+        state (dict): warm start state from get_warm_start_state
+
+    Returns:
+        bool: True if the position was restored
+    """
+    if self._gstat_at_init is None or self._ifcnt_at_init is None or self._ifcnt_at_init < 0:
+        return False
+    if self._gstat_at_init & (tmc_reg.reset | tmc_reg.drv_err | tmc_reg.uv_cp):
+        self.tmc_logger.log(f"warm start rejected: GSTAT {bin(self._gstat_at_init)}",
+                            Loglevel.INFO)
+        return False
+    if state.get("ifcnt") != self._ifcnt_at_init:
+        self.tmc_logger.log("warm start rejected: driver configuration changed",
+                            Loglevel.INFO)
+        return False
+    # the position may have been saved with another µstep resolution
+    position = state["position"] * self._msres
+    if position % state["msres"] != 0:
+        self.tmc_logger.log("warm start rejected: position not in the current µstep resolution",
+                            Loglevel.INFO)
+        return False
+    current_pos = self._current_pos
+    self._current_pos = position // state["msres"]
+    # MSCNT was not reset either, so the old reference still finds pulses lost before the restart
+    mscnt_ref = state.get("mscnt_ref")
+    if mscnt_ref is not None:
+        old_mscnt_ref = self._mscnt_ref
+        self._mscnt_ref = tuple(mscnt_ref)
+        if not self.check_position(correct=False):
+            self.tmc_logger.log("warm start rejected: MSCNT does not match the position",
+                                Loglevel.INFO)
+            self._current_pos = current_pos
+            self._mscnt_ref = old_mscnt_ref
+            return False
+    else:
+        self.set_mscnt_reference()
+    self.tmc_logger.log(f"warm start at position {self._current_pos}", Loglevel.INFO)
+    return True
+
+
+
+def set_mscnt_direction(self, direction):
+    """sets in which direction the microstep counter MSCNT counts
+    for a positive movement. it depends on the wiring and on GCONF.shaft
+
+    Args:
+        direction (int): 1 if MSCNT counts up for positive movements, -1 if it counts down
+    """
+    self._mscnt_direction = 1 if direction >= 0 else -1
+
+
+
+def set_mscnt_reference(self):
+    """remembers the microstep counter MSCNT at the current position.
+    check_position compares MSCNT with the position relative to this reference.
+    has to be called when the position is known to be right, e.g. after homing
+    """
+    self._mscnt_ref = (self.get_microstep_counter(), self._current_pos * (256 // self._msres))
+
+
+
+def check_position(self, correct = True, max_error = None):
+    """compares the microstep counter MSCNT with the value which is expected
+    from the position since set_mscnt_reference.
+    MSCNT counts the STEP pulses the driver received, so pulses which were lost
+    on the way are found; a rotor which slipped behind the electrical position
+    under load is not. MSCNT covers one electrical period (4 fullsteps),
+    so errors of up to 2 fullsteps can be measured.
+    small errors are corrected in place by moving to the position again
+
+    Args:
+        correct (bool): whether small errors are corrected (Default value = True)
+        max_error (int): largest error in µsteps which is corrected
+            (Default value = None: 1 fullstep)
+
+    Returns:
+        bool: False if the error was too large to be corrected or correct is False;
+            True if there was no error, no reference or the error was corrected
+    """
+    if self._mscnt_ref is None:
+        return True
+    mscnt_ref, pos_ref = self._mscnt_ref
+    mscnt_per_step = 256 // self._msres
+    expected = mscnt_ref + self._mscnt_direction * (self._current_pos * mscnt_per_step - pos_ref)
+    deviation = (self.get_microstep_counter() - expected + 512) % 1024 - 512
+    error = round(self._mscnt_direction * deviation / mscnt_per_step)
+    if error == 0:
+        return True
+
+    if max_error is None:
+        max_error = self._msres
+    if not correct or abs(error) > max_error:
+        self.tmc_logger.log(f"position error: {error} µsteps", Loglevel.ERROR)
+        return False
+    self.tmc_logger.log(f"position error: {error} µsteps; correcting", Loglevel.WARNING)
+    position = self._current_pos
+    self._current_pos += error
+    self.run_to_position_steps(position, MovementAbsRel.ABSOLUTE)
+    return True
+
+
+
 def get_tstep(self):
     """reads the current tstep from the driver register
 
@@ -691,6 +902,49 @@ def set_coolstep_threshold(self, threshold):
 
 
 
+def set_stealthchop_threshold(self, threshold):
+    """sets the register "TPWMTHRS". this is the upper velocity for StealthChop.
+    when TSTEP falls below this value, the driver switches to SpreadCycle.
+    0 disables the switching. (unsigned, 20bit)
+
+    Args:
+        threshold (int): threshold as TSTEP value
+    """
+    threshold = min(max(int(threshold), 0), 0xFFFFF)
+    self.tmc_logger.log(f"tpwmthrs {bin(threshold)}", Loglevel.INFO)
+
+    self.tmc_logger.log("writing tpwmthrs", Loglevel.INFO)
+    self.tmc_uart.write_reg_check(tmc_reg.TPWMTHRS, threshold)
+
+
+
+def set_stealthchop_max_speed(self, speed):
+    """sets the speed above which the driver switches from StealthChop
+    to SpreadCycle. StealthChop has to be enabled (set_spreadcycle(False)).
+    the speed is converted with the current µstep resolution
+
+    Args:
+        speed (float): switch-over speed in µsteps per second; 0 disables the switching
+    """
+    self._stealthchop_max_speed = abs(speed)
+    if speed == 0:
+        self.set_stealthchop_threshold(0)
+    else:
+        self.set_stealthchop_threshold(tmc_math.steps_to_tstep(
+            abs(speed), self.get_microstepping_resolution()))
+
+
+
+def get_stealthchop_max_speed(self):
+    """returns the speed above which the driver switches to SpreadCycle
+
+    Returns:
+        float: switch-over speed in µsteps per second; 0 if the switching is disabled
+    """
+    return self._stealthchop_max_speed
+
+
+
 def get_microstep_counter(self):
     """returns the current Microstep counter.
     Indicates actual position in the microstep table for CUR_A
@@ -0,0 +1,445 @@
+#pylint: disable=invalid-name
+#pylint: disable=protected-access
+"""
+TMC_2209 CoreXY motion module
+
+moves two TMC_2209 drivers on one common timeline.
+the axis with more steps (major axis) follows the planned ramp,
+the steps of the other axis are interleaved with Bresenham's algorithm
+"""
+
+import math
+import time
+from ._TMC_2209_GPIO_board import TMC_gpio, Gpio
+from ._TMC_2209_logger import Loglevel
+from ._TMC_2209_move import MovementPhase, StopMode
+from ._TMC_2209_ramp import plan_ramp, estimate_duration, RampProfile, effective_acceleration
+from ._TMC_2209_scheduler import StepScheduler
+
+
+
+class TMC_CoreXY:
+    """TMC_CoreXY
+
+    this class generates the step pulses of both belts of a CoreXY
+    mechanism in one loop, so that both motors share one velocity profile
+    and can not drift apart
+    """
+
+    tmc_a = None
+    tmc_b = None
+    step_scheduler = None
+    _junction_speed = 0.0
+    _bulk_step_output = True
+    _jitter_recorder = None
+
+
+
+    def __init__(self, tmc_a, tmc_b):
+        """constructor
+
+        Args:
+            tmc_a (TMC_2209): driver of the A belt
+            tmc_b (TMC_2209): driver of the B belt
+        """
+        self.tmc_a = tmc_a
+        self.tmc_b = tmc_b
+        self.step_scheduler = StepScheduler()
+
+
+
+    def stop(self, stop_mode = StopMode.HARDSTOP):
+        """stop the current movement of both motors
+
+        Args:
+            stop_mode (enum): whether the movement should be stopped immediately or softly
+                (Default value = StopMode.HARDSTOP)
+        """
+        self.tmc_a.stop(stop_mode)
+        self.tmc_b.stop(stop_mode)
+
+
+
+    def get_max_speed(self):
+        """returns the max speed of the slower of both motors
+
+        Returns:
+            float: max speed in µsteps per second
+        """
+        return min(self.tmc_a.get_max_speed(), self.tmc_b.get_max_speed())
+
+
+
+    def get_acceleration(self):
+        """returns the acceleration of the weaker of both motors
+
+        Returns:
+            float: acceleration in µsteps per second per second
+        """
+        return min(self.tmc_a.get_acceleration(), self.tmc_b.get_acceleration())
+
+
+
+    def get_ramp_profile(self):
+        """returns the ramp profile of the movement.
+        the S-curve is used, as soon as one of the motors requests it
+
+        Returns:
+            ramp_profile (enum): RampProfile of both motors
+        """
+        if RampProfile.SCURVE in (self.tmc_a.get_ramp_profile(), self.tmc_b.get_ramp_profile()):
+            return RampProfile.SCURVE
+        return RampProfile.TRAPEZOID
+
+
+
+    @staticmethod
+    def _get_step_method(tmc):
+        """returns the method which makes one step of the given motor.
+        the logging check is done once here instead of once per step
+
+        Args:
+            tmc (TMC_2209): motor
+
+        Returns:
+            callable: step method
+        """
+        if tmc.tmc_logger.enabled_for(Loglevel.MOVEMENT):
+            return tmc.make_a_step
+        return tmc.pulse_step
+
+
+
+    def _get_both_step_method(self, major, minor):
+        """returns the method which makes one step of both motors at once.
+        with bulk output both STEP pins are pulsed together
+
+        Args:
+            major (TMC_2209): motor of the major axis
+            minor (TMC_2209): motor of the minor axis
+
+        Returns:
+            callable: step method
+        """
+        major_step = self._get_step_method(major)
+        minor_step = self._get_step_method(minor)
+        if (not self._bulk_step_output or major_step is major.make_a_step or
+            minor_step is minor.make_a_step):
+            def step_both():
+                major_step()
+                minor_step()
+            return step_both
+
+        pins = (major._pin_step, minor._pin_step)
+        width = max(major._min_pulse_width, minor._min_pulse_width) * 1000
+        def pulse_both():
+            TMC_gpio.gpio_pulse_multi(pins, width)
+        return pulse_both
+
+
+
+    def set_bulk_step_output(self, en):
+        """sets whether steps of both motors at the same time are written
+        with one bulk GPIO output instead of one output per motor
+
+        Args:
+            en (bool): true to pulse both STEP pins together
+        """
+        self._bulk_step_output = en
+
+
+
+    def set_jitter_recorder(self, recorder):
+        """sets a recorder for the planned and actual time of every step
+        of the major axis. None turns the recording off
+
+        Args:
+            recorder (StepJitterRecorder): recorder
+        """
+        self._jitter_recorder = recorder
+
+
+
+    def get_jitter_recorder(self):
+        """returns the step timing recorder
+
+        Returns:
+            StepJitterRecorder: recorder; None if the recording is off
+        """
+        return self._jitter_recorder
+
+
+
+    def _set_movement_phase(self, phase):
+        """sets the movement phase of both motors
+
+        Args:
+            phase (enum): new Movement Phase
+        """
+        self.tmc_a._set_movement_phase(phase)
+        self.tmc_b._set_movement_phase(phase)
+
+
+
+    def set_junction_speed(self, junction_speed):
+        """sets how much the speed of one motor may change abruptly
+        at the junction of two blended segments.
+        0 means that the motors stop at every change of direction
+
+        Args:
+            junction_speed (float): max speed change in µsteps per second
+        """
+        self._junction_speed = abs(junction_speed)
+
+
+
+    def plan_junction_speeds(self, segments, max_speed, acceleration):
+        """look-ahead planning of the speeds at the junctions of consecutive segments.
+        the speed at a junction is limited by the change of direction of both motors
+        and by the distance which is left to accelerate and decelerate
+
+        Args:
+            segments (list): list of (steps_a, steps_b) tuples
+            max_speed (float): max speed in µsteps per second
+            acceleration (float): mean acceleration in µsteps per second per second
+
+        Returns:
+            list: speed of the major axis at the start of each segment
+                and at the end of the last one
+        """
+        # motor velocities per unit of major axis speed
+        units = []
+        lengths = []
+        for steps_a, steps_b in segments:
+            major_steps = max(abs(steps_a), abs(steps_b))
+            units.append((steps_a / major_steps, steps_b / major_steps))
+            lengths.append(major_steps)
+
+        junctions = [0.0]
+        for prev, nxt in zip(units, units[1:]):
+            delta = max(abs(prev[0] - nxt[0]), abs(prev[1] - nxt[1]))
+            if delta == 0:
+                junctions.append(max_speed)
+            else:
+                junctions.append(min(max_speed, self._junction_speed / delta))
+        junctions.append(0.0)
+
+        # backward pass: every segment must be able to decelerate to the next junction
+        for i in range(len(lengths) - 1, 0, -1):
+            junctions[i] = min(junctions[i],
+                               math.sqrt(junctions[i+1]**2 + 2.0 * acceleration * lengths[i]))
+        # forward pass: every segment must be able to accelerate to the next junction
+        for i in range(len(lengths)):
+            junctions[i+1] = min(junctions[i+1],
+                                 math.sqrt(junctions[i]**2 + 2.0 * acceleration * lengths[i]))
+        return junctions
+
+
+
+    def estimate_segments(self, segments, max_speed = None, acceleration = None, profile = None):
+        """returns how long run_segments will take for the given segments.
+        the duration is computed in closed form; the motors are not moved
+
+        Args:
+            segments (list): list of (steps_a, steps_b) tuples; steps can be negative
+            max_speed (float): max speed in µsteps per second
+                (Default value = None: current max speed of the motors)
+            acceleration (float): acceleration in µsteps per second per second
+                (Default value = None: current acceleration of the motors)
+            profile (enum): ramp profile
+                (Default value = None: current ramp profile of the motors)
+
+        Returns:
+            float: duration in seconds
+        """
+        segments = [(steps_a, steps_b) for steps_a, steps_b in segments if steps_a or steps_b]
+        if not segments:
+            return 0.0
+        if max_speed is None:
+            max_speed = self.get_max_speed()
+        if acceleration is None:
+            acceleration = self.get_acceleration()
+        if profile is None:
+            profile = self.get_ramp_profile()
+
+        junctions = self.plan_junction_speeds(segments, max_speed,
+                                              effective_acceleration(acceleration, profile))
+        duration = 0.0
+        for i, (steps_a, steps_b) in enumerate(segments):
+            duration += estimate_duration(max(abs(steps_a), abs(steps_b)), max_speed,
+                                          acceleration, junctions[i], junctions[i+1], profile)
+        return duration
+
+
+
+    def run_to_position_steps(self, steps_a, steps_b):
+        """moves both motors relative to their current position.
+        blocks the code until finished or stopped from a different thread!
+
+        Args:
+            steps_a (int): amount of steps of the A motor; can be negative
+            steps_b (int): amount of steps of the B motor; can be negative
+
+        Returns:
+            stop (enum): how the movement was finished
+        """
+        return self.run_segments([(steps_a, steps_b)])
+
+
+
+    def run_segments(self, segments):
+        """moves both motors through consecutive relative segments without stopping
+        in between, where the change of direction allows it.
+        blocks the code until finished or stopped from a different thread!
+
+        Args:
+            segments (list): list of (steps_a, steps_b) tuples; steps can be negative
+
+        Returns:
+            stop (enum): how the movement was finished
+        """
+        segments = [(steps_a, steps_b) for steps_a, steps_b in segments if steps_a or steps_b]
+        tmc_a = self.tmc_a
+        tmc_b = self.tmc_b
+        tmc_a._stop = StopMode.NO
+        tmc_b._stop = StopMode.NO
+        tmc_a._target_pos = tmc_a._current_pos + sum(seg[0] for seg in segments)
+        tmc_b._target_pos = tmc_b._current_pos + sum(seg[1] for seg in segments)
+        if not segments:
+            return StopMode.NO
+
+        max_speed = self.get_max_speed()
+        acceleration = self.get_acceleration()
+        profile = self.get_ramp_profile()
+        junctions = self.plan_junction_speeds(segments, max_speed,
+                                              effective_acceleration(acceleration, profile))
+
+        stop = StopMode.NO
+        speed = 0.0
+        starttime = self.step_scheduler.start()
+        for i, (steps_a, steps_b) in enumerate(segments):
+            steps = max(abs(steps_a), abs(steps_b))
+            if stop == StopMode.SOFTSTOP:
+                # the deceleration of a soft stop goes on in the next segment
+                plan, _ = self._plan_stop(speed, steps, acceleration, profile)
+            else:
+                speed = junctions[i]
+                plan = plan_ramp(steps, max_speed, acceleration,
+                                 junctions[i], junctions[i+1], profile)
+            stop, starttime, speed = self._run_segment(steps_a, steps_b, plan,
+                                                       starttime, speed)
+            if stop == StopMode.HARDSTOP or (stop == StopMode.SOFTSTOP and speed == 0):
+                break
+
+        self._set_movement_phase(MovementPhase.STANDSTILL)
+        return stop
+
+
+
+    def _plan_stop(self, speed, steps, acceleration, profile):
+        """plans the deceleration of a soft stop from the given speed.
+        if the deceleration needs more than the given steps,
+        the plan ends with the speed reached after them
+
+        Args:
+            speed (float): speed of the major axis at the start of the deceleration
+            steps (int): max amount of steps of the deceleration
+            acceleration (float): acceleration in µsteps per second per second
+            profile (enum): ramp profile
+
+        Returns:
+            tuple: planned deceleration (RampPlan) and the speed at its end
+        """
+        accel = effective_acceleration(acceleration, profile)
+        steps = min(steps, math.ceil(speed**2 / (2.0 * accel)))
+        exit_speed = math.sqrt(max(speed**2 - 2.0 * accel * steps, 0.0))
+        return plan_ramp(steps, speed, acceleration, speed, exit_speed, profile), exit_speed
+
+
+
+    def _run_segment(self, steps_a, steps_b, plan, starttime, entry_speed):
+        """makes the steps of one segment.
+        a soft stop replaces the rest of the plan with the deceleration
+        from the current speed; the segment then ends after the deceleration
+
+        Args:
+            steps_a (int): amount of steps of the A motor; can be negative
+            steps_b (int): amount of steps of the B motor; can be negative
+            plan (RampPlan): planned ramp of the major axis
+            starttime (int): start of the segment in ns of time.perf_counter_ns()
+            entry_speed (float): speed of the major axis at the start of the segment
+
+        Returns:
+            tuple: how the segment was finished (StopMode), the planned time of
+                its last step in ns and, after a soft stop, the speed at its end
+        """
+        tmc_a = self.tmc_a
+        tmc_b = self.tmc_b
+        if abs(steps_a) >= abs(steps_b):
+            major, minor = tmc_a, tmc_b
+            major_steps, minor_steps = steps_a, steps_b
+        else:
+            major, minor = tmc_b, tmc_a
+            major_steps, minor_steps = steps_b, steps_a
+
+        for tmc, steps in ((major, major_steps), (minor, minor_steps)):
+            TMC_gpio.gpio_output(tmc._pin_step, Gpio.LOW)
+            if steps != 0:
+                tmc.set_direction_pin(1 if steps > 0 else 0)
+        major_inc = 1 if major_steps > 0 else -1
+        minor_inc = 1 if minor_steps > 0 else -1
+        major_steps = abs(major_steps)
+        minor_steps = abs(minor_steps)
+
+        deadlines = plan.deadlines.tolist()
+        accel_end = plan.accel_end
+        decel_start = plan.decel_start
+        self._set_movement_phase(MovementPhase.ACCELERATING)
+        error = major_steps // 2
+        wait_for_step = self.step_scheduler.wait_for_step
+        major_step = self._get_step_method(major)
+        both_step = self._get_both_step_method(major, minor)
+
+        recorder = self._jitter_recorder
+        stop = StopMode.NO
+        exit_speed = 0.0
+        deadline = starttime
+        i = 0
+        while i < len(deadlines):
+            deadline = starttime + deadlines[i]
+            target = wait_for_step(deadline)
+            waited = time.perf_counter_ns() if recorder is not None else 0
+
+            if tmc_a._stop == StopMode.HARDSTOP or tmc_b._stop == StopMode.HARDSTOP:
+                return StopMode.HARDSTOP, deadline, 0.0
+            if stop == StopMode.NO and StopMode.SOFTSTOP in (tmc_a._stop, tmc_b._stop):
+                # replace the rest of the plan with the deceleration from the current speed
+                stop = StopMode.SOFTSTOP
+                speed = 1e9 / (deadlines[i] - deadlines[i-1]) if i else entry_speed
+                if speed == 0:
+                    return stop, starttime, 0.0
+                decel, exit_speed = self._plan_stop(speed, len(deadlines) - i - 1,
+                                                    self.get_acceleration(),
+                                                    self.get_ramp_profile())
+                deadlines = deadlines[:i+1] + [deadlines[i] + d
+                                               for d in decel.deadlines.tolist()]
+                decel_start = i
+
+            if i == decel_start:
+                self._set_movement_phase(MovementPhase.DECELERATING)
+            elif i == accel_end and i < decel_start:
+                self._set_movement_phase(MovementPhase.MAXSPEED)
+
+            major._current_pos += major_inc
+            error -= minor_steps
+            if error < 0:
+                error += major_steps
+                minor._current_pos += minor_inc
+                both_step()
+            else:
+                major_step()
+            if recorder is not None:
+                recorder.record(target, waited, major._movement_phase.value)
+            i += 1
+
+        return stop, deadline, exit_speed
@@ -0,0 +1,128 @@
+#pylint: disable=invalid-name
+#pylint: disable=protected-access
+#pylint: disable=too-many-arguments
+"""
+TMC_2209 stepper driver StallGuard homing module
+
+homes the motor against a mechanical end stop with the StallGuard DIAG output.
+the stall is signalled by an edge interrupt on the DIAG pin,
+so no UART frames are needed while the motor is moving
+"""
+
+import time
+import threading
+from ._TMC_2209_GPIO_board import TMC_gpio
+from ._TMC_2209_logger import Loglevel
+from . import _TMC_2209_reg as tmc_reg
+from ._TMC_2209_move import Direction, MovementAbsRel, MovementPhase, StopMode, MAX_STEPS_ALLOWED
+
+
+
+def home_stallguard(self, pin_stallguard, threshold, direction = Direction.CW,
+                    speed_fast = None, speed_slow = None, backoff_steps = None,
+                    threshold_slow = None):
+    """homes the motor in two phases: a fast approach until the first stall,
+    a short backoff and a slow re-approach for a repeatable end position.
+    the position is set to 0 at the end stop and becomes the reference of check_position.
+    the StallGuard thresholds TCOOLTHRS and SGTHRS are restored at the end
+
+    Args:
+        pin_stallguard (int): pin which is connected to DIAG
+        threshold (int): StallGuard threshold like in take_me_home;
+            a stall is detected when SG_RESULT drops below it
+        direction (enum): direction of the end stop (Default value = Direction.CW)
+        speed_fast (float): speed of the first approach in µsteps per second
+            (Default value = None: the current max speed)
+        speed_slow (float): speed of the re-approach in µsteps per second
+            (Default value = None: the homing speed)
+        backoff_steps (int): µsteps to back off after the first stall
+            (Default value = None: 1/8 revolution)
+        threshold_slow (int): StallGuard threshold of the re-approach
+            (Default value = None: same as threshold)
+
+    Returns:
+        bool: True if the end stop was found in both phases
+    """
+    if speed_fast is None:
+        speed_fast = self._max_speed
+    if speed_slow is None:
+        speed_slow = self._max_speed_homing
+    if backoff_steps is None:
+        backoff_steps = max(self._steps_per_rev // 8, 1)
+    if threshold_slow is None:
+        threshold_slow = threshold
+    sign = -1 if direction == Direction.CCW else 1
+
+    self.tmc_logger.log(f"StallGuard homing with threshold = {threshold}", Loglevel.INFO)
+    # StallGuard only works in StealthChop
+    self.set_spreadcycle(0)
+    max_speed = self._max_speed
+    stealthchop_max_speed = self._stealthchop_max_speed
+    # TCOOLTHRS and SGTHRS are write-only; the last written values are in the shadow.
+    # never written means the reset value 0, which keeps StallGuard off DIAG
+    coolstep_threshold = self.tmc_uart.get_shadow(tmc_reg.TCOOLTHRS) or 0
+    stallguard_threshold = self.tmc_uart.get_shadow(tmc_reg.SGTHRS) or 0
+    if stealthchop_max_speed:
+        self.set_stealthchop_max_speed(0)
+    try:
+        found = self._home_approach(pin_stallguard, threshold, speed_fast,
+                                    sign * MAX_STEPS_ALLOWED)
+        if found:
+            self.run_to_position_steps(-sign * backoff_steps, MovementAbsRel.RELATIVE)
+            found = self._home_approach(pin_stallguard, threshold_slow, speed_slow,
+                                        sign * 2 * backoff_steps)
+    finally:
+        TMC_gpio.gpio_remove_event_detect(pin_stallguard)
+        self._sg_callback = None
+        self.set_coolstep_threshold(coolstep_threshold)
+        self.set_stallguard_threshold(stallguard_threshold)
+        self.set_max_speed(max_speed)
+        if stealthchop_max_speed:
+            self.set_stealthchop_max_speed(stealthchop_max_speed)
+
+    if found:
+        self.set_current_position(0)
+        self.set_mscnt_reference()
+        self.tmc_logger.log("StallGuard homing finished", Loglevel.INFO)
+    else:
+        self.tmc_logger.log("StallGuard homing failed: no stall detected", Loglevel.ERROR)
+    return found
+
+
+
+def _home_approach(self, pin_stallguard, threshold, speed, steps):
+    """moves towards the end stop until the DIAG interrupt reports a stall.
+    stalls while accelerating are ignored, because the StallGuard result
+    is not reliable before the motor runs at constant speed.
+    if DIAG is still high when the constant speed is reached,
+    no new edge follows, so the level is checked once then
+
+    Args:
+        pin_stallguard (int): pin which is connected to DIAG
+        threshold (int): SG_RESULT below which a stall is detected
+        speed (float): speed of the approach in µsteps per second
+        steps (int): max µsteps to move (relative)
+
+    Returns:
+        bool: True if a stall was detected
+    """
+    stalled = threading.Event()
+
+    def on_stall():
+        if self._movement_phase == MovementPhase.MAXSPEED:
+            self.stop(StopMode.HARDSTOP)
+            stalled.set()
+
+    self.set_max_speed(speed)
+    # DIAG is triggered when SG_RESULT falls below 2 * SGTHRS
+    self.set_stallguard_callback(pin_stallguard, min(threshold // 2, 255), on_stall,
+                                 min_speed=speed / 2)
+    future = self.run_to_position_steps_threaded(steps, MovementAbsRel.RELATIVE)
+    while not future.done() and not stalled.is_set():
+        if self._movement_phase == MovementPhase.MAXSPEED:
+            if TMC_gpio.gpio_input(pin_stallguard):
+                on_stall()
+            break
+        time.sleep(0.001)
+    self.wait_for_movement_finished_threaded()
+    return stalled.is_set()
@@ -0,0 +1,146 @@
+#pylint: disable=invalid-name
+"""
+TMC_2209 step timing recorder module
+
+records the planned and the actual time of every step into preallocated
+ring buffers, so that the step jitter can be analysed after a movement.
+recording a step only stores three numbers; the statistics are computed
+when the report is requested
+"""
+
+from array import array
+import numpy as np
+from ._TMC_2209_move import MovementPhase
+
+
+JITTER_CAPACITY = 65536
+# upper bin edges of the histogram in µs; steps made too early fall into the first bin
+JITTER_HISTOGRAM_EDGES = (0, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+JITTER_PERCENTILES = (50, 90, 99, 99.9)
+
+
+
+class StepJitterRecorder:
+    """StepJitterRecorder
+
+    ring buffer of planned and actual step times in ns of time.perf_counter_ns().
+    when it is full, the oldest steps are overwritten
+    """
+
+    _planned = None
+    _actual = None
+    _phase = None
+    _mask = 0
+    _index = 0
+    _count = 0
+
+
+
+    def __init__(self, capacity = JITTER_CAPACITY):
+        """constructor
+
+        Args:
+            capacity (int): amount of steps which are kept; a power of two
+                (Default value = JITTER_CAPACITY)
+        """
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("the capacity must be a power of two")
+        self._planned = array("Q", bytes(8 * capacity))
+        self._actual = array("Q", bytes(8 * capacity))
+        self._phase = array("B", bytes(capacity))
+        self._mask = capacity - 1
+        self.reset()
+
+
+
+    def reset(self):
+        """forgets all recorded steps"""
+        self._index = 0
+        self._count = 0
+
+
+
+    def record(self, planned, actual, phase):
+        """records one step
+
+        Args:
+            planned (int): planned time of the step in ns
+            actual (int): actual time of the step in ns
+            phase (int): value of the MovementPhase of the step
+        """
+        i = self._index
+        self._planned[i] = planned
+        self._actual[i] = actual
+        self._phase[i] = phase
+        self._index = (i + 1) & self._mask
+        self._count += 1
+
+
+
+    def get_lateness(self):
+        """returns how late the recorded steps were, oldest first
+
+        Returns:
+            tuple: lateness in µs (np.ndarray, negative if too early)
+                and the MovementPhase values of the steps (np.ndarray)
+        """
+        size = min(self._count, self._mask + 1)
+        order = (np.arange(self._index - size, self._index) & self._mask)
+        planned = np.frombuffer(self._planned, dtype=np.uint64)[order].astype(np.int64)
+        actual = np.frombuffer(self._actual, dtype=np.uint64)[order].astype(np.int64)
+        phases = np.frombuffer(self._phase, dtype=np.uint8)[order]
+        return (actual - planned) / 1000, phases
+
+
+
+    def report(self):
+        """computes the statistics of the recorded steps
+
+        Returns:
+            dict: count, dropped, mean, percentiles, histogram
+                and max lateness per MovementPhase; all times in µs
+        """
+        lateness, phases = self.get_lateness()
+        report = {
+            "count": len(lateness),
+            "dropped": self._count - len(lateness),
+            "mean": 0.0,
+            "percentiles": {p: 0.0 for p in JITTER_PERCENTILES},
+            "histogram": [],
+            "max_per_phase": {}
+        }
+        if len(lateness) == 0:
+            return report
+
+        report["mean"] = float(lateness.mean())
+        report["percentiles"] = dict(zip(JITTER_PERCENTILES,
+                                         np.percentile(lateness, JITTER_PERCENTILES).tolist()))
+        edges = [-np.inf, *JITTER_HISTOGRAM_EDGES, np.inf]
+        counts, _ = np.histogram(lateness, bins=edges)
+        report["histogram"] = list(zip(edges[1:], counts.tolist()))
+        for phase in MovementPhase:
+            in_phase = lateness[phases == phase.value]
+            if len(in_phase) > 0:
+                report["max_per_phase"][phase.name] = float(in_phase.max())
+        return report
+
+
+
+    def format_report(self):
+        """returns the report as text
+
+        Returns:
+            str: report with one line per value
+        """
+        report = self.report()
+        lines = [f"steps: {report['count']} (dropped: {report['dropped']})",
+                 f"mean lateness: {report['mean']:.1f} µs"]
+        for percentile, value in report["percentiles"].items():
+            lines.append(f"p{percentile}: {value:.1f} µs")
+        lower = "early"
+        for upper, count in report["histogram"]:
+            lines.append(f"{lower:>7} - {upper:<7} µs: {count}")
+            lower = upper
+        for phase, value in report["max_per_phase"].items():
+            lines.append(f"max {phase}: {value:.1f} µs")
+        return "\n".join(lines)
@@ -52,10 +52,13 @@ class TMC_logger:
         self.formatter = formatter
 
         if handlers is None:
-            # Default handler: StreamHandler (logs to console)
-            handlers = [logging.StreamHandler()]
+            # Default handler: StreamHandler (logs to console);
+            # a logger of the same name from an earlier driver already has one
+            handlers = [] if self.logger.handlers else [logging.StreamHandler()]
 
         for handler in handlers:
+            if handler in self.logger.handlers:
+                continue
             handler.setFormatter(self.formatter)
             self.logger.addHandler(handler)
 
@@ -81,6 +84,20 @@ class TMC_logger:
         self.loglevel = loglevel
         self.logger.setLevel(loglevel.value)
 
+    def enabled_for(self, loglevel: Loglevel):
+        """returns whether messages of the given loglevel are logged.
+        logging caches isEnabledFor and clears the cache on every level change,
+        also on changes made through logging directly,
+        so this is cheap enough to be called on hot paths
+
+        Args:
+            loglevel (enum): loglevel to check
+
+        Returns:
+            bool: whether messages of this loglevel are logged
+        """
+        return self.loglevel is not Loglevel.NONE and self.logger.isEnabledFor(loglevel.value)
+
     def add_handler(self, handler, formatter=None):
         """add a handler to the logger
 
@@ -104,7 +121,7 @@ class TMC_logger:
 
     def remove_all_handlers(self):
         """remove all handlers from the logger"""
-        for handler in self.logger.handlers:
+        for handler in list(self.logger.handlers):
             self.logger.removeHandler(handler)
 
     def set_formatter(self, formatter, handlers=None):
@@ -154,5 +171,5 @@ class TMC_logger:
             message (string): message to log
             loglevel (enum): loglevel of this message (Default value = Loglevel.INFO)
         """
-        if self.loglevel is not Loglevel.NONE:
+        if self.enabled_for(loglevel):
             self.logger.log(loglevel.value, message)
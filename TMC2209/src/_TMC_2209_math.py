@@ -33,6 +33,19 @@ def vactual_to_rps(vactual, steps_per_rev, fclk = 12000000):
     return vactual * (fclk / 16777216) / steps_per_rev
 
 
+def steps_to_vactual(steps, fclk = 12000000):
+    """converts steps/second -> vactual
+
+    Args:
+        steps (float): speed in µsteps per second
+        fclk (int): clock speed of the tmc (Default value = 12000000)
+
+    Returns:
+        vactual (int): value for vactual
+    """
+    return int(round(steps / (fclk / 16777216)))
+
+
 def rps_to_steps(rps, steps_per_rev):
     """converts rps -> steps/second
 
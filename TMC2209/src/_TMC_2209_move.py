@@ -11,12 +11,29 @@ TMC_2209 stepper driver communication module
 import time
 from enum import Enum
 import math
-import threading
 from ._TMC_2209_GPIO_board import TMC_gpio, Gpio
 from ._TMC_2209_logger import Loglevel
+from . import _TMC_2209_reg as tmc_reg
+from ._TMC_2209_ramp import plan_ramp, estimate_duration
+from ._TMC_2209_worker import MotionWorker
 
 MAX_STEPS_ALLOWED = 10000
 
+# fixed-point Austin ramp: step intervals in µs with 16 fractional bits
+FIXED_SHIFT = 16
+RECIPROCAL_SHIFT = 32
+RECIPROCAL_TABLE_SIZE = 4096
+# 1/(4n+1) while accelerating and 1/(4n-1) while decelerating (Equation 13)
+_RECIPROCALS_ACCEL = [round((1 << RECIPROCAL_SHIFT) / (4 * n + 1))
+                      for n in range(RECIPROCAL_TABLE_SIZE)]
+_RECIPROCALS_DECEL = [0] + [round((1 << RECIPROCAL_SHIFT) / (4 * n - 1))
+                            for n in range(1, RECIPROCAL_TABLE_SIZE)]
+_RECIPROCAL_HALF = 1 << (RECIPROCAL_SHIFT - 1)
+_FIXED_ONE = 1 << FIXED_SHIFT
+_FIXED_FRACTION = _FIXED_ONE - 1
+_FIXED_TO_FLOAT = 1.0 / _FIXED_ONE
+_FIXED_SPEED = 1000000 << FIXED_SHIFT
+
 class Direction(Enum):
     """movement direction of the motor"""
     CCW = 0
@@ -44,6 +61,19 @@ class StopMode(Enum):
     HARDSTOP = 2
 
 
+class MotionBackend(Enum):
+    """how the steps of a movement are generated"""
+    STEP_DIR = 0        # the Raspberry Pi toggles the STEP pin
+    VACTUAL = 1         # the internal step generator of the TMC is driven via UART
+
+
+class RampMode(Enum):
+    """how the speed profile of a movement is computed"""
+    PLANNED = 0         # whole profile is computed before the movement
+    REALTIME = 1        # next step interval is computed after every step
+    REALTIME_FIXED = 2  # like REALTIME, but with integer arithmetic
+
+
 def set_movement_abs_rel(self, movement_abs_rel):
     """set whether the movement should be relative or absolute by default.
     See the Enum MovementAbsoluteRelative
@@ -86,10 +116,12 @@ def set_max_speed(self, speed):
     if self._max_speed != speed:
         self._max_speed = speed
         self._cmin = 1000000.0 / speed
+        self._cmin_fx = round(self._cmin * _FIXED_ONE)
         # Recompute _n from current speed and adjust speed if accelerating or cruising
         if self._n > 0:
             self._n = (self._speed * self._speed) / (2.0 * self._acceleration) # Equation 16
-            self.compute_new_speed()
+            self._n_fx = round(self._n * _FIXED_ONE)
+            self._compute_new_speed()
 
 
 
@@ -125,10 +157,14 @@ def set_acceleration(self, acceleration):
     if self._acceleration != acceleration:
         # Recompute _n per Equation 17
         self._n = self._n * (self._acceleration / acceleration)
+        self._n_fx = round(self._n * _FIXED_ONE)
         # New c0 per Equation 7, with correction per Equation 15
         self._c0 = 0.676 * math.sqrt(2.0 / acceleration) * 1000000.0 # Equation 15
         self._acceleration = acceleration
-        self.compute_new_speed()
+        self._c0_fx = round(self._c0 * _FIXED_ONE)
+        # Equation 16 with the interval in fixed-point: steps_to_stop = _stop_k / cn²
+        self._stop_k = round(1e12 * (1 << 3 * FIXED_SHIFT) / (2.0 * acceleration))
+        self._compute_new_speed()
 
 
 
@@ -160,6 +196,93 @@ def stop(self, stop_mode = StopMode.HARDSTOP):
             (Default value = StopMode.HARDSTOP)
     """
     self._stop = stop_mode
+    self._stop_count += 1
+
+
+
+def set_motion_backend(self, motion_backend):
+    """set how the steps of the movements should be generated.
+    See the Enum MotionBackend
+
+    Args:
+        motion_backend (enum): STEP/DIR pins or VACTUAL register
+    """
+    self._motion_backend = motion_backend
+
+
+
+def set_ramp_mode(self, ramp_mode):
+    """set how the speed profile of the movements should be computed.
+    See the Enum RampMode
+
+    Args:
+        ramp_mode (enum): whether the profile is planned in advance or computed per step
+    """
+    self._ramp_mode = ramp_mode
+
+
+
+def set_jitter_recorder(self, recorder):
+    """sets a recorder for the planned and actual time of every step.
+    None turns the recording off
+
+    Args:
+        recorder (StepJitterRecorder): recorder
+    """
+    self._jitter_recorder = recorder
+
+
+
+def get_jitter_recorder(self):
+    """returns the step timing recorder
+
+    Returns:
+        StepJitterRecorder: recorder; None if the recording is off
+    """
+    return self._jitter_recorder
+
+
+
+def set_ramp_profile(self, ramp_profile):
+    """set the shape of the speed ramps of planned movements.
+    See the Enum RampProfile
+
+    Args:
+        ramp_profile (enum): constant acceleration or jerk-limited S-curve
+    """
+    self._ramp_profile = ramp_profile
+
+
+
+def get_ramp_profile(self):
+    """returns the shape of the speed ramps of planned movements
+
+    Returns:
+        ramp_profile (enum): current RampProfile
+    """
+    return self._ramp_profile
+
+
+
+def _set_movement_phase(self, phase):
+    """sets the movement phase and switches between the boosted
+    and the normal run current (see set_current_boost).
+    this is called from the step loop: the IHOLD_IRUN write is only queued
+    on the UART bus without logging, and skipped if the current does not change
+
+    Args:
+        phase (enum): new Movement Phase
+    """
+    self._movement_phase = phase
+    if self._cs_irun_boost is None or self.tmc_uart.bus is None:
+        return
+    if phase in (MovementPhase.ACCELERATING, MovementPhase.DECELERATING):
+        irun = self._cs_irun_boost
+    else:
+        irun = self._cs_irun
+    ihold_irun = self._cs_ihold | irun << 8 | self._ihold_delay << 16
+    if ihold_irun != self.tmc_uart.get_shadow(tmc_reg.IHOLD_IRUN):
+        self.tmc_uart.write_reg(tmc_reg.IHOLD_IRUN, ihold_irun)
 
 
 
@@ -185,6 +308,23 @@ def run_to_position_steps(self, steps, movement_abs_rel = None):
         movement_abs_rel (enum): whether the movement should be absolut or relative
             (Default value = None)
 
+    Returns:
+        stop (enum): how the movement was finished
+    """
+    self._stop = StopMode.NO
+    return self._run_to_position_steps(steps, movement_abs_rel)
+
+
+
+def _run_to_position_steps(self, steps, movement_abs_rel):
+    """runs the motor to the given position without resetting a stop
+
+    should not be called from outside!
+
+    Args:
+        steps (int): amount of steps; can be negative
+        movement_abs_rel (enum): whether the movement should be absolut or relative
+
     Returns:
         stop (enum): how the movement was finished
     """
@@ -196,20 +336,56 @@ def run_to_position_steps(self, steps, movement_abs_rel = None):
     else:
         self._target_pos = steps
 
-    self._stop = StopMode.NO
-    self._step_interval = 0
-    self._speed = 0.0
-    self._n = 0
-    self.compute_new_speed()
-    while self.run(): #returns false, when target position is reached
-        if self._stop == StopMode.HARDSTOP:
-            break
-
-    self._movement_phase = MovementPhase.STANDSTILL
+    if self._stop == StopMode.HARDSTOP:
+        self._set_movement_phase(MovementPhase.STANDSTILL)
+        return self._stop
+    if self._motion_backend == MotionBackend.VACTUAL:
+        self.run_vactual()
+    elif self._ramp_mode == RampMode.PLANNED:
+        self.run_planned()
+    else:
+        self._step_interval = 0
+        self._speed = 0.0
+        self._n = 0
+        self._n_fx = 0
+        self._cn_fx = 0
+        self._last_step_time = 0
+        self._compute_new_speed()
+        while self.run(): #returns false, when target position is reached
+            if self._stop == StopMode.HARDSTOP:
+                break
+            # sleep until shortly before the next step instead of polling all the time
+            self.step_scheduler.wait_until(int((self._last_step_time + self._step_interval)*1000))
+
+    self._set_movement_phase(MovementPhase.STANDSTILL)
     return self._stop
 
 
 
+def estimate_duration_steps(self, steps, movement_abs_rel = None):
+    """returns how long a movement to the given position will take
+    with the current speed, acceleration and ramp profile.
+    the duration is computed in closed form; the motor is not moved
+
+    Args:
+        steps (int): amount of steps; can be negative
+        movement_abs_rel (enum): whether the movement should be absolut or relative
+            (Default value = None)
+
+    Returns:
+        float: duration of the movement in seconds
+    """
+    if movement_abs_rel is None:
+        movement_abs_rel = self._movement_abs_rel
+
+    if movement_abs_rel == MovementAbsRel.ABSOLUTE:
+        steps = steps - self._current_pos
+
+    return estimate_duration(steps, self._max_speed, self._acceleration,
+                             profile=self._ramp_profile)
+
+
+
 def run_to_position_revolutions(self, revolutions, movement_abs_rel = None):
     """runs the motor to the given position.
     with acceleration and deceleration
@@ -239,12 +415,38 @@ def run_to_position_steps_threaded(self, steps, movement_abs_rel = None):
         movement_abs_rel (enum): whether the movement should be absolut or relative
             (Default value = None)
 
+    Returns:
+        Future: completed with how the movement was finished
+    """
+    if self._motion_worker is None:
+        self._motion_worker = MotionWorker(f"{self.tmc_logger.logger.name} motion")
+    # the movement counts as started as soon as it is queued
+    self._movement_phase = MovementPhase.ACCELERATING
+    self._movement_future = self._motion_worker.submit(self._run_queued_movement,
+                                                       steps, movement_abs_rel,
+                                                       self._stop_count)
+    return self._movement_future
+
+
+
+def _run_queued_movement(self, steps, movement_abs_rel, stop_count):
+    """runs a movement of run_to_position_steps_threaded in the worker thread.
+    a stop, which was issued after the movement was queued, is kept,
+    so that it is not lost before the worker starts the movement
+
+    should not be called from outside!
+
+    Args:
+        steps (int): amount of steps; can be negative
+        movement_abs_rel (enum): whether the movement should be absolut or relative
+        stop_count (int): amount of stops issued when the movement was queued
+
     Returns:
         stop (enum): how the movement was finished
     """
-    self._movement_thread = threading.Thread(target=self.run_to_position_steps,
-                                                args=(steps, movement_abs_rel))
-    self._movement_thread.start()
+    if self._stop_count == stop_count:
+        self._stop = StopMode.NO
+    return self._run_to_position_steps(steps, movement_abs_rel)
 
 
 
@@ -259,7 +461,7 @@ def run_to_position_revolutions_threaded(self, revolutions, movement_abs_rel = N
             (Default value = None)
 
     Returns:
-        stop (enum): how the movement was finished
+        Future: completed with how the movement was finished
     """
     return self.run_to_position_steps_threaded(round(revolutions * self._steps_per_rev),
                                                 movement_abs_rel)
@@ -275,8 +477,8 @@ def wait_for_movement_finished_threaded(self):
     Returns:
         enum: how the movement was finished
     """
-    if self._movement_thread:
-        self._movement_thread.join()
+    if self._movement_future:
+        self._movement_future.result()
     return self._stop
 
 
@@ -288,11 +490,88 @@ def run(self):
     should not be called from outside!
     """
     if self.run_speed(): #returns true, when a step is made
-        self.compute_new_speed()
+        self._compute_new_speed()
     return self._speed != 0.0 and self.distance_to_go() != 0
 
 
 
+def _compute_new_speed(self):
+    """calculates the next step interval with the implementation
+    of the current ramp mode
+    """
+    if self._ramp_mode == RampMode.REALTIME_FIXED:
+        self.compute_new_speed_fixed()
+    else:
+        self.compute_new_speed()
+
+
+
+def run_planned(self):
+    """runs the motor to the target position with a precomputed ramp.
+    the whole speed profile is planned before the first step,
+    so that the loop only has to wait for the next deadline
+
+    should not be called from outside!
+    """
+    distance = self.distance_to_go()
+    if distance == 0:
+        return
+    plan = plan_ramp(distance, self._max_speed, self._acceleration,
+                     profile=self._ramp_profile)
+
+    TMC_gpio.gpio_output(self._pin_step, Gpio.LOW)
+    if distance > 0:
+        self.set_direction_pin(1)
+        pos_inc = 1
+    else:
+        self.set_direction_pin(0)
+        pos_inc = -1
+
+    deadlines = plan.deadlines.tolist()
+    accel_end = plan.accel_end
+    decel_start = plan.decel_start
+    self._set_movement_phase(MovementPhase.ACCELERATING)
+    wait_for_step = self.step_scheduler.wait_for_step
+    if self.tmc_logger.enabled_for(Loglevel.MOVEMENT):
+        make_a_step = self.make_a_step
+    else:
+        make_a_step = self.pulse_step
+    recorder = self._jitter_recorder
+    starttime = self.step_scheduler.start()
+
+    i = 0
+    while i < len(deadlines):
+        target = wait_for_step(starttime + deadlines[i])
+        waited = time.perf_counter_ns() if recorder is not None else 0
+
+        if self._stop == StopMode.HARDSTOP:
+            break
+        if self._stop == StopMode.SOFTSTOP and i < decel_start:
+            # replace the rest of the plan with the deceleration from the current speed
+            steps_done = min(i, accel_end)
+            decel = plan.intervals[steps_done-1::-1].tolist() if steps_done else []
+            deadlines = deadlines[:i+1]
+            for interval in decel[1:]:
+                deadlines.append(deadlines[-1] + interval)
+            decel_start = i
+
+        if i >= decel_start:
+            phase = MovementPhase.DECELERATING
+        elif i >= accel_end:
+            phase = MovementPhase.MAXSPEED
+        else:
+            phase = MovementPhase.ACCELERATING
+        if phase is not self._movement_phase:
+            self._set_movement_phase(phase)
+
+        self._current_pos += pos_inc
+        make_a_step()
+        if recorder is not None:
+            recorder.record(target, waited, self._movement_phase.value)
+        i += 1
+
+
+
 def distance_to_go(self):
     """returns the remaining distance the motor should run"""
     return self._target_pos - self._current_pos
@@ -373,13 +652,98 @@ def compute_new_speed(self):
 
 
 
+def compute_new_speed_fixed(self):
+    """calculates the next step interval like compute_new_speed,
+    but with integers only: the interval and the step counter n are kept
+    with 16 fractional bits. while n is a whole number, the division of Equation 13
+    is a multiplication with a reciprocal from a table for the first
+    RECIPROCAL_TABLE_SIZE steps of a ramp. the deceleration starts at the
+    fractional n of Equation 16, like in the float implementation,
+    so the intervals match it within 1 µs
+    """
+    distance_to = self.distance_to_go() # +ve is clockwise from current location
+    cn = self._cn_fx
+    # Equation 16 in fixed-point
+    steps_to_stop = self._stop_k // (cn * cn) if cn else 0
+    if ((distance_to == 0 and steps_to_stop <= 2 * _FIXED_ONE) or
+    (self._stop == StopMode.SOFTSTOP and steps_to_stop <= _FIXED_ONE)):
+        # We are at the target and its time to stop
+        self._step_interval = 0
+        self._speed = 0.0
+        self._n = 0
+        self._n_fx = 0
+        self._cn_fx = 0
+        self._movement_phase = MovementPhase.STANDSTILL
+        self.tmc_logger.log("time to stop", Loglevel.MOVEMENT)
+        return
+
+    n = self._n_fx
+    distance_fx = distance_to << FIXED_SHIFT
+    if distance_to > 0:
+        if n > 0:
+            if ((steps_to_stop >= distance_fx) or self._direction == Direction.CCW or
+                self._stop == StopMode.SOFTSTOP):
+                n = -max(steps_to_stop, _FIXED_ONE) # Start deceleration
+                self._movement_phase = MovementPhase.DECELERATING
+        elif n < 0:
+            if (steps_to_stop < distance_fx) and self._direction == Direction.CW:
+                n = -n # Start acceleration
+                self._movement_phase = MovementPhase.ACCELERATING
+    elif distance_to < 0:
+        if n > 0:
+            if ((steps_to_stop >= -distance_fx) or self._direction == Direction.CW or
+                self._stop == StopMode.SOFTSTOP):
+                n = -max(steps_to_stop, _FIXED_ONE) # Start deceleration
+                self._movement_phase = MovementPhase.DECELERATING
+        elif n < 0:
+            if (steps_to_stop < -distance_fx) and self._direction == Direction.CCW:
+                n = -n # Start acceleration
+                self._movement_phase = MovementPhase.ACCELERATING
+
+    if n == 0:
+        # First step from stopped
+        cn = self._c0_fx
+        TMC_gpio.gpio_output(self._pin_step, Gpio.LOW)
+        if distance_to > 0:
+            self.set_direction_pin(1)
+            self.tmc_logger.log("going CW", Loglevel.MOVEMENT)
+        else:
+            self.set_direction_pin(0)
+            self.tmc_logger.log("going CCW", Loglevel.MOVEMENT)
+        self._movement_phase = MovementPhase.ACCELERATING
+    else:
+        # Equation 13
+        n_int = n >> FIXED_SHIFT
+        if n & _FIXED_FRACTION:
+            cn -= (2 * cn << FIXED_SHIFT) // (4 * n + _FIXED_ONE)
+        elif 0 < n_int < RECIPROCAL_TABLE_SIZE:
+            cn -= (2 * cn * _RECIPROCALS_ACCEL[n_int] + _RECIPROCAL_HALF) >> RECIPROCAL_SHIFT
+        elif -RECIPROCAL_TABLE_SIZE < n_int < 0:
+            cn += (2 * cn * _RECIPROCALS_DECEL[-n_int] + _RECIPROCAL_HALF) >> RECIPROCAL_SHIFT
+        else:
+            cn -= (2 * cn) // (4 * n_int + 1)
+        if cn <= self._cmin_fx:
+            cn = self._cmin_fx
+            self._movement_phase = MovementPhase.MAXSPEED
+    n += _FIXED_ONE
+    self._n_fx = n
+    self._n = n * _FIXED_TO_FLOAT
+    self._cn_fx = cn
+    self._step_interval = cn * _FIXED_TO_FLOAT
+    self._speed = _FIXED_SPEED // cn
+    if self._direction == 0:
+        self._speed = -self._speed
+
+
+
 def run_speed(self):
     """this methods does the actual steps with the current speed"""
     # Don't do anything unless we actually have a step interval
     if not self._step_interval:
         return False
 
-    curtime = time.time_ns()/1000
+    now = time.perf_counter_ns()
+    curtime = now/1000
 
     if curtime - self._last_step_time >= self._step_interval:
 
@@ -388,6 +752,10 @@ def run_speed(self):
         else: # Anticlockwise
             self._current_pos -= 1
         self.make_a_step()
+        # the first step of a movement has no planned time
+        if self._jitter_recorder is not None and self._last_step_time > 0:
+            self._jitter_recorder.record(int((self._last_step_time + self._step_interval)*1000),
+                                         now, self._movement_phase.value)
 
         self._last_step_time = curtime # Caution: does not account for costs in step()
         return True
@@ -400,9 +768,15 @@ def make_a_step(self):
 
     for the TMC2209 there needs to be a signal duration of minimum 100 ns
     """
-    TMC_gpio.gpio_output(self._pin_step, Gpio.HIGH)
-    time.sleep(1/1000/1000)
-    TMC_gpio.gpio_output(self._pin_step, Gpio.LOW)
-    time.sleep(1/1000/1000)
+    self.pulse_step()
+
+    if self.tmc_logger.enabled_for(Loglevel.MOVEMENT):
+        self.tmc_logger.log("one step", Loglevel.MOVEMENT)
+
 
-    self.tmc_logger.log("one step", Loglevel.MOVEMENT)
+
+def pulse_step(self):
+    """makes one step without logging it.
+    the stepping loops use this method directly, when movement logging is off
+    """
+    TMC_gpio.gpio_pulse(self._pin_step, self._min_pulse_width * 1000)
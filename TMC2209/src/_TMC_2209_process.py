@@ -0,0 +1,526 @@
+#pylint: disable=invalid-name
+#pylint: disable=protected-access
+#pylint: disable=import-outside-toplevel
+#pylint: disable=broad-exception-caught
+"""
+TMC_2209 motion process module
+
+runs the CoreXY step generation in a separate process, so that the GIL of the
+application (web server, image processing, ...) does not delay the steps.
+commands and results are exchanged through two single-producer/single-consumer
+ring buffers in shared memory. the UART stays in the application process
+"""
+
+import os
+import sys
+import time
+import zlib
+import struct
+import argparse
+import threading
+import subprocess
+from multiprocessing import shared_memory, resource_tracker
+from ._TMC_2209_GPIO_board import TMC_gpio
+from ._TMC_2209_GPIO_mmap import GpioMem
+from ._TMC_2209_logger import Loglevel
+from ._TMC_2209_move import MovementPhase, StopMode
+from ._TMC_2209_ramp import RampProfile
+from ._TMC_2209_corexy import TMC_CoreXY
+
+
+RING_SLOTS = 256
+POLL_INTERVAL = 0.0005          # seconds between two polls of an empty ring
+
+# header words: number of slots, head (next slot to write), tail (next slot to read), flag
+_HEADER_WORDS = 4
+_SLOTS, _HEAD, _TAIL, _FLAG = range(_HEADER_WORDS)
+_HEADER_SIZE = 4 * _HEADER_WORDS
+_COUNTER_MASK = 0xFFFFFFFF
+# sequence number, command code and up to 6 arguments, followed by their crc32
+_SLOT_DATA = struct.Struct("<Iq6d")
+_SLOT_CRC = struct.Struct("<I")
+_SLOT_SIZE = _SLOT_DATA.size + _SLOT_CRC.size
+
+CMD_CONFIG = 1          # motor index, max speed, acceleration, profile, position, pulse width
+CMD_JUNCTION = 2        # junction speed
+CMD_SEGMENT = 3         # steps A, steps B
+CMD_RUN = 4             # run all queued segments
+CMD_EXIT = 5
+
+STATUS_DONE = 1         # position A, position B, stop mode
+STATUS_ERROR = 2        # position A, position B, stop mode
+STATUS_PHASE = 3        # movement phase
+
+
+
+class ShmRing:
+    """ShmRing
+
+    lock-free ring buffer of fixed size records in shared memory
+    for exactly one writing and one reading process.
+    the head is only written by the writer and the tail only by the reader.
+    the counters are 32bit, so that every update is a single aligned store
+    also on 32bit ARM.
+    ARM does not keep the order of stores to different addresses, so the reader
+    may see the new head before the record. every record carries its sequence
+    number and a crc32; a record which does not match yet is read again later
+    """
+
+    _shm = None
+    _header = None
+    _owner = False
+
+
+
+    def __init__(self, name = None, slots = RING_SLOTS):
+        """constructor
+
+        Args:
+            name (str): name of an existing ring to attach to
+                (Default value = None: a new ring is created)
+            slots (int): number of records of a new ring; a power of two
+                (Default value = RING_SLOTS)
+        """
+        if name is None:
+            if slots <= 0 or slots & (slots - 1):
+                raise ValueError("the number of slots must be a power of two")
+            self._shm = shared_memory.SharedMemory(create=True,
+                                                   size=_HEADER_SIZE + slots * _SLOT_SIZE)
+            self._owner = True
+            self._header = self._shm.buf[:_HEADER_SIZE].cast("I")
+            self._header[_HEAD] = 0
+            self._header[_TAIL] = 0
+            self._header[_FLAG] = 0
+            self._header[_SLOTS] = slots
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # the creating process unlinks the memory, not the tracker of this process
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            self._header = self._shm.buf[:_HEADER_SIZE].cast("I")
+        self._mask = self._header[_SLOTS] - 1
+
+
+
+    @property
+    def name(self):
+        """name of the shared memory block"""
+        return self._shm.name
+
+
+
+    def put(self, code, *values):
+        """appends one record
+
+        Args:
+            code (int): command or status code
+            *values (float): up to 6 arguments
+
+        Returns:
+            bool: False if the ring is full
+        """
+        head = self._header[_HEAD]
+        if (head - self._header[_TAIL]) & _COUNTER_MASK > self._mask:
+            return False
+        data = _SLOT_DATA.pack(head, code, *values, *(0.0,) * (6 - len(values)))
+        offset = _HEADER_SIZE + (head & self._mask) * _SLOT_SIZE
+        self._shm.buf[offset:offset + _SLOT_SIZE] = data + _SLOT_CRC.pack(zlib.crc32(data))
+        self._header[_HEAD] = (head + 1) & _COUNTER_MASK
+        return True
+
+
+
+    def get(self):
+        """removes the oldest record
+
+        Returns:
+            tuple: code and 6 arguments; None if the ring is empty
+                or the record is not completely visible yet
+        """
+        tail = self._header[_TAIL]
+        if tail == self._header[_HEAD]:
+            return None
+        offset = _HEADER_SIZE + (tail & self._mask) * _SLOT_SIZE
+        slot = bytes(self._shm.buf[offset:offset + _SLOT_SIZE])
+        data = slot[:_SLOT_DATA.size]
+        if _SLOT_CRC.unpack_from(slot, _SLOT_DATA.size)[0] != zlib.crc32(data):
+            return None
+        record = _SLOT_DATA.unpack(data)
+        if record[0] != tail:
+            return None
+        self._header[_TAIL] = (tail + 1) & _COUNTER_MASK
+        return record[1:]
+
+
+
+    def set_flag(self, value):
+        """sets the flag word, which bypasses the queued records
+
+        Args:
+            value (int): 32bit value
+        """
+        self._header[_FLAG] = value
+
+
+
+    def get_flag(self):
+        """returns the flag word
+
+        Returns:
+            int: 32bit value
+        """
+        return self._header[_FLAG]
+
+
+
+    def close(self):
+        """detaches from the shared memory; the creator also removes it"""
+        if self._shm is None:
+            return
+        self._header.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+
+
+class TMC_CoreXYProcess(TMC_CoreXY):
+    """TMC_CoreXYProcess
+
+    TMC_CoreXY whose movements are stepped by a separate process.
+    the settings and positions of both drivers are sent with every movement,
+    the drivers in this process stay the owners of the configuration
+    """
+
+    _process = None
+    _commands = None
+    _status = None
+
+
+
+    def __init__(self, tmc_a, tmc_b, cpu = None, priority = None, use_gpio_mem = False,
+                 slots = RING_SLOTS):
+        """constructor
+
+        Args:
+            tmc_a (TMC_2209): driver of the A belt
+            tmc_b (TMC_2209): driver of the B belt
+            cpu (int): cpu core the motion process is pinned to (Default value = None)
+            priority (int): SCHED_FIFO priority of the motion process (Default value = None)
+            use_gpio_mem (bool): whether the motion process writes the STEP pins
+                through /dev/gpiomem (Default value = False)
+            slots (int): size of the command ring (Default value = RING_SLOTS)
+        """
+        super().__init__(tmc_a, tmc_b)
+        self._commands = ShmRing(slots=slots)
+        self._status = ShmRing(slots=slots)
+
+        args = [sys.executable, "-m", __name__,
+                "--commands", self._commands.name, "--status", self._status.name,
+                "--pins-a", str(tmc_a._pin_step), str(tmc_a._pin_dir),
+                "--pins-b", str(tmc_b._pin_step), str(tmc_b._pin_dir),
+                "--logprefixes", f"{tmc_a.tmc_logger.logger.name} motion",
+                f"{tmc_b.tmc_logger.logger.name} motion",
+                "--loglevel", tmc_a.tmc_logger.loglevel.name]
+        if cpu is not None:
+            args += ["--cpu", str(cpu)]
+        if priority is not None:
+            args += ["--priority", str(priority)]
+        if use_gpio_mem:
+            args.append("--gpio-mem")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        self._process = subprocess.Popen(args, env=env)
+
+
+
+    def __del__(self):
+        """destructor"""
+        self.close()
+
+
+
+    def close(self):
+        """stops the motion process and removes the rings"""
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._commands.put(CMD_EXIT)
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+        for ring in (self._commands, self._status):
+            if ring is not None:
+                ring.close()
+        self._commands = None
+        self._status = None
+
+
+
+    def stop(self, stop_mode = StopMode.HARDSTOP):
+        """stop the current movement of both motors
+
+        Args:
+            stop_mode (enum): whether the movement should be stopped immediately or softly
+                (Default value = StopMode.HARDSTOP)
+        """
+        self._commands.set_flag(stop_mode.value)
+
+
+
+    def run_segments(self, segments):
+        """runs a chain of relative movements in the motion process
+        and blocks until they are finished
+
+        Args:
+            segments (list): (steps_a, steps_b) tuple for every movement
+
+        Returns:
+            enum: how the movement was finished
+        """
+        for index, tmc in enumerate((self.tmc_a, self.tmc_b)):
+            self._send(CMD_CONFIG, index, tmc._max_speed, tmc._acceleration,
+                       tmc._ramp_profile.value, tmc._current_pos, tmc._min_pulse_width)
+        self._send(CMD_JUNCTION, self._junction_speed)
+        for steps_a, steps_b in segments:
+            self._send(CMD_SEGMENT, steps_a, steps_b)
+        self._set_movement_phase(MovementPhase.ACCELERATING)
+        self._send(CMD_RUN)
+
+        status = self._wait_status()
+        self.tmc_a._current_pos = int(status[1])
+        self.tmc_b._current_pos = int(status[2])
+        self._set_movement_phase(MovementPhase.STANDSTILL)
+        if status[0] != STATUS_DONE:
+            raise RuntimeError("the motion process failed to run the movement")
+        return StopMode(int(status[3]))
+
+
+
+    def _send(self, code, *values):
+        """puts one command into the command ring; waits while it is full
+
+        Args:
+            code (int): command
+            *values (float): arguments
+        """
+        while not self._commands.put(code, *values):
+            self._check_process()
+            time.sleep(POLL_INTERVAL)
+
+
+
+    def _wait_status(self):
+        """waits for the next status of the motion process
+
+        Returns:
+            tuple: status code and arguments
+        """
+        while True:
+            status = self._status.get()
+            if status is not None and status[0] == STATUS_PHASE:
+                # applied here, because the motion process has no UART (current boost)
+                self._set_movement_phase(MovementPhase(int(status[1])))
+            elif status is not None:
+                return status
+            self._check_process()
+            time.sleep(POLL_INTERVAL)
+
+
+
+    def _check_process(self):
+        """raises an error if the motion process has exited"""
+        if self._process is None or self._process.poll() is not None:
+            raise RuntimeError("the motion process is not running")
+
+
+
+class _PhaseReportingCoreXY(TMC_CoreXY):
+    """_PhaseReportingCoreXY
+
+    TMC_CoreXY of the motion process, which reports every change
+    of the movement phase to the application process
+    """
+
+    _status = None
+    _pending_phase = None
+
+
+
+    def __init__(self, status, tmc_a, tmc_b):
+        """constructor
+
+        Args:
+            status (ShmRing): status ring
+            tmc_a (TMC_2209): driver of the A belt
+            tmc_b (TMC_2209): driver of the B belt
+        """
+        super().__init__(tmc_a, tmc_b)
+        self._status = status
+
+
+
+    def _set_movement_phase(self, phase):
+        """sets the movement phase of both motors and reports it.
+        the step loop must not wait for the application process, so when
+        the status ring is full, the phase is kept and sent with the next change
+        or before the status of the movement
+
+        Args:
+            phase (enum): new Movement Phase
+        """
+        super()._set_movement_phase(phase)
+        self._pending_phase = phase
+        self.send_pending_phase()
+
+
+
+    def send_pending_phase(self):
+        """sends the last movement phase, if it was not sent yet
+
+        Returns:
+            bool: False if the status ring is still full
+        """
+        if self._pending_phase is None:
+            return True
+        if not self._status.put(STATUS_PHASE, self._pending_phase.value):
+            return False
+        self._pending_phase = None
+        return True
+
+
+
+def _set_realtime(tmc_logger, cpu, priority):
+    """pins the current process to one cpu core and gives it a real-time priority.
+    a busy-waiting SCHED_FIFO process should only run on an isolated core.
+    if that is not possible, the process keeps running with normal scheduling
+
+    Args:
+        tmc_logger (TMC_logger): logger for the failures
+        cpu (int): cpu core; None to keep the affinity
+        priority (int): SCHED_FIFO priority (1-99); None to keep the scheduler
+    """
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except OSError as e:
+            tmc_logger.log(f"cannot pin the motion process to cpu {cpu}: {e}", Loglevel.WARNING)
+            # without its own core, a busy-waiting SCHED_FIFO process starves the others
+            priority = None
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except PermissionError:
+            tmc_logger.log("no permission for SCHED_FIFO; running with normal priority",
+                           Loglevel.WARNING)
+
+
+
+def _watch_stop(commands, corexy, finished):
+    """forwards stop requests from the flag word of the command ring
+    to the running movement until finished is set
+
+    Args:
+        commands (ShmRing): command ring
+        corexy (TMC_CoreXY): motion of both motors
+        finished (threading.Event): set before the command ring is closed
+    """
+    while not finished.wait(POLL_INTERVAL):
+        stop_mode = commands.get_flag()
+        if stop_mode:
+            corexy.stop(StopMode(stop_mode))
+            commands.set_flag(0)
+
+
+
+def _serve(args):
+    """executes the commands of the command ring until CMD_EXIT
+    or until the application process has exited
+
+    Args:
+        args (argparse.Namespace): command line arguments
+    """
+    from .TMC_2209_StepperDriver import TMC_2209
+
+    # the EN pin and the UART stay with the application process
+    loglevel = Loglevel[args.loglevel]
+    tmcs = tuple(TMC_2209(-1, pins[0], pins[1], serialport=None, skip_uart_init=True,
+                          loglevel=loglevel, logprefix=logprefix)
+                 for pins, logprefix in zip((args.pins_a, args.pins_b), args.logprefixes))
+    tmc_logger = tmcs[0].tmc_logger
+    _set_realtime(tmc_logger, args.cpu, args.priority)
+    if args.gpio_mem:
+        TMC_gpio.use_gpio_mem(GpioMem())
+    commands = ShmRing(args.commands)
+    status = ShmRing(args.status)
+
+    corexy = _PhaseReportingCoreXY(status, *tmcs)
+    finished = threading.Event()
+    watcher = threading.Thread(target=_watch_stop, args=(commands, corexy, finished),
+                               daemon=True)
+    watcher.start()
+
+    segments = []
+    parent = os.getppid()
+    while os.getppid() == parent:
+        command = commands.get()
+        if command is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        code, values = command[0], command[1:]
+        if code == CMD_CONFIG:
+            tmc = tmcs[int(values[0])]
+            tmc.set_max_speed(values[1])
+            tmc.set_acceleration(values[2])
+            tmc.set_ramp_profile(RampProfile(int(values[3])))
+            tmc._current_pos = int(values[4])
+            tmc._min_pulse_width = values[5]
+        elif code == CMD_JUNCTION:
+            corexy.set_junction_speed(values[0])
+        elif code == CMD_SEGMENT:
+            segments.append((int(values[0]), int(values[1])))
+        elif code == CMD_RUN:
+            result = STATUS_DONE
+            stop_mode = StopMode.NO
+            try:
+                stop_mode = corexy.run_segments(segments)
+            except Exception as e:
+                tmc_logger.log(f"movement failed: {e}", Loglevel.ERROR)
+                result = STATUS_ERROR
+            segments = []
+            while not corexy.send_pending_phase():
+                time.sleep(POLL_INTERVAL)
+            while not status.put(result, tmcs[0]._current_pos, tmcs[1]._current_pos,
+                                 stop_mode.value):
+                time.sleep(POLL_INTERVAL)
+        elif code == CMD_EXIT:
+            break
+
+    # the watcher must not read the command ring after it is closed
+    finished.set()
+    watcher.join()
+    for tmc in tmcs:
+        tmc.set_deinitialize_true()
+    commands.close()
+    status.close()
+
+
+
+def main():
+    """entry point of the motion process"""
+    parser = argparse.ArgumentParser(description="TMC_2209 motion process")
+    parser.add_argument("--commands", required=True)
+    parser.add_argument("--status", required=True)
+    parser.add_argument("--pins-a", type=int, nargs=2, required=True)
+    parser.add_argument("--pins-b", type=int, nargs=2, required=True)
+    parser.add_argument("--cpu", type=int)
+    parser.add_argument("--priority", type=int)
+    parser.add_argument("--gpio-mem", action="store_true")
+    parser.add_argument("--logprefixes", nargs=2, default=["TMC2209 0 motion", "TMC2209 1 motion"])
+    parser.add_argument("--loglevel", default=Loglevel.INFO.name)
+    _serve(parser.parse_args())
+
+
+
+if __name__ == "__main__":
+    main()
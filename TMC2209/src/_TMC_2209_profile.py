@@ -0,0 +1,70 @@
+#pylint: disable=invalid-name
+"""
+TMC_2209 stepper driver profile module
+
+a profile describes the desired driver settings as a dict, which can be
+stored as JSON. every entry names a setter without "set_" and its value.
+applying a profile reads the readable configuration registers once
+and writes only the registers which differ
+"""
+
+import json
+from . import _TMC_2209_reg as tmc_reg
+
+
+# settings which may be used in a profile; the name of the setter without "set_"
+PROFILE_SETTINGS = (
+    "direction_reg", "iscale_analog", "vsense", "internal_rsense", "pdn_disable",
+    "current", "current_boost", "spreadcycle", "interpolation", "toff",
+    "microstepping_resolution", "mstep_resolution_reg_select",
+    "stallguard_threshold", "coolstep_threshold", "stealthchop_threshold"
+)
+
+# the configuration which is used by the scripts
+DEFAULT_PROFILE = {
+    "direction_reg": False,
+    "current": 300,
+    "interpolation": True,
+    "spreadcycle": False,
+    "microstepping_resolution": 2,
+    "internal_rsense": False
+}
+
+
+
+def load_profile(path):
+    """loads a profile from a JSON file
+
+    Args:
+        path (str): path of the JSON file
+
+    Returns:
+        dict: profile
+    """
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+
+def apply_profile(self, profile):
+    """applies the settings of a profile in the given order.
+    GCONF and CHOPCONF are read once, if their shadow copies are unknown;
+    the setters then work on the shadow copies and skip unchanged registers.
+    the remaining writes are sent in one batch.
+    IHOLD_IRUN cannot be read, so it is written once after a restart
+
+    Args:
+        profile (dict): setting name (setter without "set_") and value;
+            a list value is passed as the arguments of the setter
+    """
+    unknown = [name for name in profile if name not in PROFILE_SETTINGS]
+    if unknown:
+        raise ValueError(f"unknown profile settings: {', '.join(unknown)}")
+
+    for register in (tmc_reg.GCONF, tmc_reg.CHOPCONF):
+        if self.tmc_uart.get_shadow(register) is None:
+            self.tmc_uart.read_int(register)
+    with self.batch():
+        for name, value in profile.items():
+            args = value if isinstance(value, (list, tuple)) else [value]
+            getattr(self, "set_" + name)(*args)
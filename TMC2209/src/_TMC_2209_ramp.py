@@ -0,0 +1,261 @@
+#pylint: disable=invalid-name
+#pylint: disable=too-few-public-methods
+"""
+TMC_2209 stepper driver ramp planning module
+
+this module computes the complete acceleration/cruise/deceleration
+sequence of a movement before the first step is made.
+the stepping loop then only has to walk through an array of deadlines
+"""
+
+import math
+from enum import Enum
+from functools import lru_cache
+import numpy as np
+
+
+PLAN_CACHE_SIZE = 64
+SCURVE_SAMPLES_PER_STEP = 4
+
+
+class RampProfile(Enum):
+    """shape of the speed ramps"""
+    TRAPEZOID = 0       # constant acceleration
+    SCURVE = 1          # jerk-limited; acceleration rises and falls smoothly
+
+
+
+def effective_acceleration(acceleration, profile):
+    """returns the mean acceleration of a ramp with the given profile.
+    the S-curve ramp follows v = v0 + dv * (3u² - 2u³), its peak acceleration is
+    1.5 times its mean acceleration. the peak is limited to the given acceleration
+
+    Args:
+        acceleration (float): (peak) acceleration in µsteps per second per second
+        profile (enum): ramp profile
+
+    Returns:
+        float: mean acceleration in µsteps per second per second
+    """
+    if profile == RampProfile.SCURVE:
+        return acceleration / 1.5
+    return acceleration
+
+
+
+class RampPlan:
+    """RampPlan
+
+    precomputed step deadlines of one movement.
+    all times are relative to the start of the movement
+    """
+
+    def __init__(self, steps, max_speed, acceleration, deadlines, accel_end, decel_start):
+        """constructor
+
+        Args:
+            steps (int): amount of steps of the movement (always positive)
+            max_speed (float): max speed in µsteps per second
+            acceleration (float): acceleration in µsteps per second per second
+            deadlines (np.ndarray): time in ns at which each step has to be made
+            accel_end (int): index of the first step that is not accelerating
+            decel_start (int): index of the first decelerating step
+        """
+        self.steps = steps
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.deadlines = deadlines
+        self.intervals = np.diff(deadlines, prepend=0)
+        self.accel_end = accel_end
+        self.decel_start = decel_start
+        self.duration = int(deadlines[-1]) if steps > 0 else 0
+
+        self.deadlines.setflags(write=False)
+        self.intervals.setflags(write=False)
+
+
+
+def plan_ramp(steps, max_speed, acceleration, entry_speed = 0.0, exit_speed = 0.0,
+              profile = RampProfile.TRAPEZOID):
+    """returns the ramp plan for a movement of the given amount of steps.
+    plans are cached, because the same moves are made over and over again
+
+    Args:
+        steps (int): amount of steps; the sign is ignored
+        max_speed (float): max speed in µsteps per second
+        acceleration (float): acceleration in µsteps per second per second
+        entry_speed (float): speed at the start of the movement (Default value = 0.0)
+        exit_speed (float): speed at the end of the movement (Default value = 0.0)
+        profile (enum): shape of the ramps (Default value = RampProfile.TRAPEZOID)
+
+    Returns:
+        RampPlan: the planned movement
+    """
+    return _plan_ramp(abs(int(steps)), float(abs(max_speed)), float(abs(acceleration)),
+                      round(float(entry_speed), 1), round(float(exit_speed), 1), profile)
+
+
+
+def estimate_duration(steps, max_speed, acceleration, entry_speed = 0.0, exit_speed = 0.0,
+                      profile = RampProfile.TRAPEZOID):
+    """returns how long a planned movement takes (closed form, nothing is stepped)
+
+    Args:
+        steps (int): amount of steps; the sign is ignored
+        max_speed (float): max speed in µsteps per second
+        acceleration (float): acceleration in µsteps per second per second
+        entry_speed (float): speed at the start of the movement (Default value = 0.0)
+        exit_speed (float): speed at the end of the movement (Default value = 0.0)
+        profile (enum): shape of the ramps (Default value = RampProfile.TRAPEZOID)
+
+    Returns:
+        float: duration in seconds
+    """
+    steps = abs(int(steps))
+    if steps == 0:
+        return 0.0
+    shape = _ramp_shape(steps, abs(max_speed), effective_acceleration(abs(acceleration), profile),
+                        entry_speed, exit_speed)
+    return shape[5] + shape[6] + shape[7]
+
+
+
+def speed_at(t, steps, max_speed, acceleration, profile = RampProfile.TRAPEZOID):
+    """returns the planned speed of a movement from standstill to standstill
+    after the given time (closed form)
+
+    Args:
+        t (float): time since the start of the movement in seconds
+        steps (int): amount of steps; the sign is ignored
+        max_speed (float): max speed in µsteps per second
+        acceleration (float): acceleration in µsteps per second per second
+        profile (enum): shape of the ramps (Default value = RampProfile.TRAPEZOID)
+
+    Returns:
+        float: speed in µsteps per second
+    """
+    steps = abs(int(steps))
+    if steps == 0 or t <= 0:
+        return 0.0
+    accel = effective_acceleration(abs(acceleration), profile)
+    (_, _, peak_speed, _, _,
+     accel_time, cruise_time, decel_time) = _ramp_shape(steps, abs(max_speed), accel, 0.0, 0.0)
+
+    if t < accel_time:
+        u = t / accel_time
+    elif t < accel_time + cruise_time:
+        return peak_speed
+    elif t < accel_time + cruise_time + decel_time:
+        u = (accel_time + cruise_time + decel_time - t) / decel_time
+    else:
+        return 0.0
+    if profile == RampProfile.SCURVE:
+        return peak_speed * (3.0 * u**2 - 2.0 * u**3)
+    return peak_speed * u
+
+
+
+def _ramp_shape(steps, max_speed, accel, entry_speed, exit_speed):
+    """computes the speeds, distances and times of the phases of a movement
+
+    Args:
+        steps (int): amount of steps (positive)
+        max_speed (float): max speed in µsteps per second
+        accel (float): mean acceleration in µsteps per second per second
+        entry_speed (float): requested speed at the start of the movement
+        exit_speed (float): requested speed at the end of the movement
+
+    Returns:
+        tuple: entry speed, exit speed, peak speed, acceleration distance,
+            deceleration distance, acceleration time, cruise time, deceleration time
+    """
+    # entry and exit speed must be reachable from each other within the movement
+    v0 = min(entry_speed, max_speed, math.sqrt(exit_speed**2 + 2.0 * accel * steps))
+    v1 = min(exit_speed, max_speed, math.sqrt(v0**2 + 2.0 * accel * steps))
+
+    peak_speed = min(max_speed, math.sqrt(accel * steps + (v0**2 + v1**2) / 2.0))
+    peak_speed = max(peak_speed, v0, v1)
+    accel_dist = (peak_speed**2 - v0**2) / (2.0 * accel)
+    decel_dist = (peak_speed**2 - v1**2) / (2.0 * accel)
+    accel_time = (peak_speed - v0) / accel
+    decel_time = (peak_speed - v1) / accel
+    cruise_time = max(steps - accel_dist - decel_dist, 0.0) / peak_speed
+    return (v0, v1, peak_speed, accel_dist, decel_dist,
+            accel_time, cruise_time, decel_time)
+
+
+
+def _ramp_times(pos, v0, v1, acceleration, profile):
+    """returns the time at which the given positions are reached
+    during a ramp from the speed v0 to the faster speed v1
+
+    Args:
+        pos (np.ndarray): positions in µsteps from the start of the ramp
+        v0 (float): speed at the start of the ramp
+        v1 (float): speed at the end of the ramp
+        acceleration (float): mean acceleration of the ramp
+        profile (enum): ramp profile
+
+    Returns:
+        np.ndarray: times in seconds
+    """
+    if profile == RampProfile.TRAPEZOID or v1 <= v0 or len(pos) == 0:
+        return (np.sqrt(v0**2 + 2.0 * acceleration * pos) - v0) / acceleration
+
+    # x(u) = v0*t + dv*T*(u³ - u⁴/2) with u = t/T has no usable inverse,
+    # so the positions are interpolated on a fine time grid
+    ramp_time = (v1 - v0) / acceleration
+    u = np.linspace(0.0, 1.0, max(64, SCURVE_SAMPLES_PER_STEP * len(pos)))
+    x = v0 * u * ramp_time + (v1 - v0) * ramp_time * (u**3 - u**4 / 2.0)
+    return np.interp(pos, x, u * ramp_time)
+
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _plan_ramp(steps, max_speed, acceleration, entry_speed, exit_speed, profile):
+    """computes the velocity profile and the deadline of every step in it (vectorized)
+
+    for the trapezoid profile the position after t seconds while accelerating from v0
+    is x = v0*t + a*t²/2, therefore step n is made at t = (sqrt(v0² + 2*a*n) - v0) / a.
+    the S-curve profile covers the same distance in the same time as a trapezoid
+    with its mean acceleration, only the shape of the ramps differs.
+    the deceleration to v1 is the mirror image of an acceleration from v1
+
+    Args:
+        steps (int): amount of steps (positive)
+        max_speed (float): max speed in µsteps per second
+        acceleration (float): acceleration in µsteps per second per second
+        entry_speed (float): speed at the start of the movement
+        exit_speed (float): speed at the end of the movement
+        profile (enum): shape of the ramps
+
+    Returns:
+        RampPlan: the planned movement
+    """
+    if steps == 0:
+        return RampPlan(0, max_speed, acceleration, np.zeros(0, dtype=np.int64), 0, 0)
+
+    accel = effective_acceleration(acceleration, profile)
+    (v0, v1, peak_speed, accel_dist, decel_dist,
+     accel_time, cruise_time, decel_time) = _ramp_shape(steps, max_speed, accel,
+                                                        entry_speed, exit_speed)
+    duration = accel_time + cruise_time + decel_time
+
+    pos = np.arange(1, steps + 1, dtype=np.float64)
+    remaining = steps - pos
+    accelerating = pos <= accel_dist
+    decelerating = ~accelerating & (remaining <= decel_dist)
+    cruising = ~accelerating & ~decelerating
+
+    times = np.empty(steps, dtype=np.float64)
+    times[accelerating] = _ramp_times(pos[accelerating], v0, peak_speed, accel, profile)
+    times[decelerating] = duration - _ramp_times(remaining[decelerating], v1, peak_speed,
+                                                 accel, profile)
+    times[cruising] = accel_time + (pos[cruising] - accel_dist) / peak_speed
+
+    deadlines = np.rint(times * 1e9).astype(np.int64)
+    accel_end = int(np.searchsorted(pos, accel_dist, side="right"))
+    decel_start = int(np.searchsorted(pos, steps - decel_dist, side="left"))
+    # on short moves the rounded ramps overlap; the step at the peak decelerates
+    accel_end = min(accel_end, decel_start)
+    return RampPlan(steps, max_speed, acceleration, deadlines, accel_end, decel_start)
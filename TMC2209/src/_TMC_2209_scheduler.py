@@ -0,0 +1,183 @@
+#pylint: disable=invalid-name
+"""
+TMC_2209 step scheduler module
+
+waits for step deadlines without pinning a cpu core.
+the scheduler sleeps until shortly before the deadline
+and only busy-waits for the last few microseconds.
+after a stall the planned deadlines of a movement are shifted,
+so that the missed steps are not made back to back.
+the shift is paid back in small parts once the steps are on time again,
+so that the movement ends close to its planned duration
+"""
+
+import time
+import math
+
+
+
+class StepScheduler:
+    """StepScheduler
+
+    hybrid sleep/spin wait for step deadlines.
+    deadlines are given in ns of time.perf_counter_ns()
+    """
+
+    _spin_window = 80000            # time in ns before a deadline in which is busy-waited
+    _max_catchup = 100000           # lateness in ns which is caught up by the next steps
+    _shift = 0                      # delay in ns of the planned deadlines of the movement
+    _payback_shift = 4              # per step the step interval >> n of the shift is paid back
+    _last_deadline = 0              # last planned deadline of the movement in ns
+    _count = 0                      # amount of waited deadlines
+    _late_sum = 0                   # sum of all deviations in ns
+    _late_sqsum = 0                 # sum of all squared deviations in ns²
+    _late_max = 0                   # biggest deviation in ns
+
+
+
+    def __init__(self, spin_window_us = 80, max_catchup_us = 100):
+        """constructor
+
+        Args:
+            spin_window_us (int): time in µs before a deadline in which is busy-waited
+                (Default value = 80)
+            max_catchup_us (int): lateness in µs which is caught up by the next steps
+                (Default value = 100)
+        """
+        self.set_spin_window(spin_window_us)
+        self.set_max_catchup(max_catchup_us)
+        self.reset_statistics()
+
+
+
+    def set_spin_window(self, spin_window_us):
+        """sets the time before a deadline in which the scheduler busy-waits.
+        longer windows make the timing more precise,
+        shorter windows free more cpu time for other threads
+
+        Args:
+            spin_window_us (int): spin window in µs
+        """
+        self._spin_window = int(spin_window_us * 1000)
+
+
+
+    def get_spin_window(self):
+        """returns the spin window in µs
+
+        Returns:
+            float: spin window in µs
+        """
+        return self._spin_window / 1000
+
+
+
+    def set_max_catchup(self, max_catchup_us):
+        """sets how much lateness of a step is caught up by the following steps
+        of a movement. if a step is later, the rest of the movement is delayed
+        instead, so that a stall does not end in steps at a much too high speed
+
+        Args:
+            max_catchup_us (int): maximal caught up lateness in µs
+        """
+        self._max_catchup = int(max_catchup_us * 1000)
+
+
+
+    def get_max_catchup(self):
+        """returns how much lateness of a step is caught up in µs
+
+        Returns:
+            float: maximal caught up lateness in µs
+        """
+        return self._max_catchup / 1000
+
+
+
+    def start(self):
+        """starts a movement with planned deadlines
+
+        Returns:
+            int: start time of the movement in ns of time.perf_counter_ns()
+        """
+        self._shift = 0
+        self._last_deadline = time.perf_counter_ns()
+        return self._last_deadline
+
+
+
+    def wait_for_step(self, deadline):
+        """waits for a planned deadline of the movement started with start.
+        lateness beyond the maximal catch up delays all following deadlines.
+        while the steps are on time, the delay is reduced by up to 1/16
+        of the step interval per step, so the speed is at most 6.7 % above the plan
+
+        Args:
+            deadline (int): planned deadline in ns of time.perf_counter_ns()
+
+        Returns:
+            int: deadline which was waited for, delayed by the stalls of the movement
+        """
+        target = deadline + self._shift
+        late = self.wait_until(target)
+        if late > self._max_catchup:
+            self._shift += late - self._max_catchup
+        elif self._shift:
+            payback = (deadline - self._last_deadline) >> self._payback_shift
+            self._shift -= min(self._shift, payback)
+        self._last_deadline = deadline
+        return target
+
+
+
+    def wait_until(self, deadline):
+        """waits until the given deadline is reached
+
+        Args:
+            deadline (int): deadline in ns of time.perf_counter_ns()
+
+        Returns:
+            int: how many ns the deadline was missed
+        """
+        sleep_time = deadline - time.perf_counter_ns() - self._spin_window
+        if sleep_time > 0:
+            time.sleep(sleep_time / 1e9)
+        now = time.perf_counter_ns()
+        while now < deadline:
+            now = time.perf_counter_ns()
+
+        late = now - deadline
+        self._count += 1
+        self._late_sum += late
+        self._late_sqsum += late * late
+        if late > self._late_max:
+            self._late_max = late
+        return late
+
+
+
+    def reset_statistics(self):
+        """resets the jitter statistics"""
+        self._count = 0
+        self._late_sum = 0
+        self._late_sqsum = 0
+        self._late_max = 0
+
+
+
+    def get_statistics(self):
+        """returns the jitter statistics since the last reset
+
+        Returns:
+            dict: count, mean, stdev and max of the step lateness in µs
+        """
+        if self._count == 0:
+            return {"count": 0, "mean": 0.0, "stdev": 0.0, "max": 0.0}
+        mean = self._late_sum / self._count
+        variance = max(self._late_sqsum / self._count - mean * mean, 0.0)
+        return {
+            "count": self._count,
+            "mean": mean / 1000,
+            "stdev": math.sqrt(variance) / 1000,
+            "max": self._late_max / 1000
+        }
@@ -7,12 +7,230 @@ TMC_UART stepper driver uart module
 
 import time
 import struct
+import threading
+import queue
 import serial
 
 from . import _TMC_2209_reg as reg
 from ._TMC_2209_logger import Loglevel
 
 
+
+def _crc8_table():
+    """returns the CRC8-ATM (polynomial 0x07) of every byte value.
+    the TMC shifts the bytes in LSB first, so the table is indexed with
+    the bit reversed byte XOR the crc
+
+    Returns:
+        tuple: 256 crc values
+    """
+    table = []
+    for value in range(256):
+        crc = value
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return tuple(table)
+
+
+
+CRC8_TABLE = _crc8_table()
+BIT_REVERSED = tuple(int(f"{value:08b}"[::-1], 2) for value in range(256))
+
+# writable configuration registers, which only change when they are written.
+# GSTAT is cleared by writing and VACTUAL is a command, so they are not shadowed
+SHADOWED_REGISTERS = frozenset((reg.GCONF, reg.IHOLD_IRUN, reg.TPWMTHRS, reg.TCOOLTHRS,
+                                reg.SGTHRS, reg.CHOPCONF))
+
+# the writes of write_reg_check are verified with one IFCNT read at the latest
+# after this many writes, well before the 8 bit counter could wrap around
+MAX_UNVERIFIED_WRITES = 32
+
+
+
+class TMC_UART_Bus:
+    """TMC_UART_Bus
+
+    owns one serial port, which is shared by all drivers on it.
+    the frames of all drivers are sent by one thread in the order of a queue,
+    so that the frames and replies of two drivers cannot interleave.
+    writes are queued without waiting for them; reads wait for their reply
+    """
+    _buses = {}
+    _buses_lock = threading.Lock()
+
+    tmc_logger = None
+    ser = None
+    serialport = None
+    communication_pause = 0
+    _users = 0
+    _queue = None
+    _thread = None
+    _frame_time = 0
+
+
+
+    def __init__(self, tmc_logger, ser, communication_pause, serialport = None):
+        """constructor
+
+        Args:
+            tmc_logger (class): TMCLogger class
+            ser (serial.Serial): opened serial port
+            communication_pause (float): pause after every frame in seconds
+            serialport (string): serialport path, under which the bus is shared
+                (Default value = None: not shared)
+        """
+        self.tmc_logger = tmc_logger
+        self.ser = ser
+        self.serialport = serialport
+        self.communication_pause = communication_pause
+        self._users = 1
+        # longest time one frame can take: the read timeout and the pauses around it
+        self._frame_time = (getattr(ser, "timeout", None) or 0) + 2 * communication_pause
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name=f"TMC_UART_Bus {serialport}",
+                                        daemon=True)
+        self._thread.start()
+
+
+
+    @classmethod
+    def open(cls, tmc_logger, serialport, baudrate):
+        """returns the bus of a serial port; the port is opened by the first driver
+
+        Args:
+            tmc_logger (class): TMCLogger class
+            serialport (string): serialport path
+            baudrate (int): baudrate
+
+        Returns:
+            TMC_UART_Bus: bus of the serial port
+        """
+        with cls._buses_lock:
+            bus = cls._buses.get(serialport)
+            if bus is not None:
+                bus._users += 1
+                return bus
+            try:
+                ser = serial.Serial (serialport, baudrate)
+            except Exception as e:
+                errnum = e.args[0]
+                tmc_logger.log(f"SERIAL ERROR: {e}")
+                if errnum == 2:
+                    tmc_logger.log(f""""{serialport} does not exist.
+                          You need to activate the serial port with \"sudo raspi-config\"""")
+                if errnum == 13:
+                    tmc_logger.log("""you have no permission to use the serial port.
+                                        You may need to add your user to the dialout group
+                                        with \"sudo usermod -a -G dialout pi\"""")
+                raise
+
+            ser.BYTESIZES = 1
+            ser.PARITIES = serial.PARITY_NONE
+            ser.STOPBITS = 1
+
+            # adjust per baud and hardware. Sequential reads without some delay fail.
+            ser.timeout = 20000/baudrate
+            ser.reset_output_buffer()
+            ser.reset_input_buffer()
+
+            # adjust per baud and hardware. Sequential reads without some delay fail.
+            bus = cls(tmc_logger, ser, 500/baudrate, serialport)
+            cls._buses[serialport] = bus
+            return bus
+
+
+
+    def close(self):
+        """releases the bus; the port is closed when the last driver releases it"""
+        with self._buses_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            if self._buses.get(self.serialport) is self:
+                del self._buses[self.serialport]
+        self._queue.put(None)
+        # the thread may already be gone when the interpreter shuts down
+        if self._thread.is_alive():
+            self._thread.join(self._frame_time * (self._queue.qsize() + 1) + 0.1)
+        self.ser.close()
+
+
+
+    def write(self, frame):
+        """queues a frame; the call does not wait until it is sent
+
+        Args:
+            frame (bytearray): frame, which is copied
+        """
+        if not self._thread.is_alive():
+            self.tmc_logger.log("UART bus is closed; frame dropped", Loglevel.ERROR)
+            return
+        self._queue.put((bytes(frame), 0, None))
+
+
+
+    def transfer(self, frame, reply_length):
+        """sends a frame after the queued ones and waits for the reply
+
+        Args:
+            frame (bytearray): frame, which is copied
+            reply_length (int): bytes to read, including the echo of the frame
+
+        Returns:
+            bytes: reply; shorter than reply_length on a timeout or an error
+        """
+        if not self._thread.is_alive():
+            self.tmc_logger.log("UART bus is closed", Loglevel.ERROR)
+            return b""
+        request = [threading.Event(), b""]
+        # the frames queued before this one are sent first
+        timeout = (self._queue.qsize() + 1) * self._frame_time + 0.1
+        self._queue.put((bytes(frame), reply_length, request))
+        if not request[0].wait(timeout):
+            self.tmc_logger.log("UART bus did not answer in time", Loglevel.ERROR)
+            return b""
+        return request[1]
+
+
+
+    def flush(self):
+        """clears the buffers of the serial port after the queued frames were sent"""
+        self.transfer(b"", 0)
+
+
+
+    def _run(self):
+        """sends the queued frames until None is queued
+
+        should not be called from outside!
+        """
+        ser = self.ser
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            frame, reply_length, request = item
+            reply = b""
+            try:
+                # the replies of earlier frames are not read; the echo of writes neither
+                ser.reset_output_buffer()
+                ser.reset_input_buffer()
+                if frame:
+                    if ser.write(frame) != len(frame):
+                        self.tmc_logger.log("Err in write", Loglevel.ERROR)
+                    time.sleep(self.communication_pause)
+                if reply_length:
+                    reply = ser.read(reply_length)
+                    time.sleep(self.communication_pause)
+            except Exception as e:
+                self.tmc_logger.log(f"SERIAL ERROR: {e}", Loglevel.ERROR)
+            if request is not None:
+                request[1] = reply
+                request[0].set()
+
+
+
 class TMC_UART:
     """TMC_UART
 
@@ -23,59 +241,58 @@ class TMC_UART:
     tmc_logger = None
 
     mtr_id = 0
-    ser = None
-    r_frame  = [0x55, 0, 0, 0  ]
-    w_frame  = [0x55, 0, 0, 0 , 0, 0, 0, 0 ]
-    communication_pause = 0
+    bus = None
+    r_frame = None
+    w_frame = None
+    _r_frame_data = None
+    _w_frame_data = None
+    _frame_lock = None
+    _shadow = None
+    _ifcnt = None
+    _unverified = None
+    _unverified_count = 0
+    _unverified_ifcnt = None
+    _batch = None
+    _batch_depth = 0
     error_handler_running = False
 
 
 
     def __init__(self, tmc_logger, serialport, baudrate, mtr_id = 0):
-        """constructor
+        """constructor.
+        drivers with the same serialport share one TMC_UART_Bus
 
         Args:
             tmc_logger (class): TMCLogger class
-            serialport (string): serialport path
+            serialport (string): serialport path; None for no UART
             baudrate (int): baudrate
             mtr_id (int, optional): driver address [0-3]. Defaults to 0.
         """
         self.tmc_logger = tmc_logger
+        self.mtr_id = mtr_id
+        # the frames are patched in place and copied into the queue of the bus;
+        # the lock keeps threads of the same driver from patching them at the same time
+        self._frame_lock = threading.Lock()
+        self.r_frame = bytearray([0x55, 0, 0, 0])
+        self.w_frame = bytearray([0x55, 0, 0, 0, 0, 0, 0, 0])
+        # the bytes covered by the crc, without copying them for every frame
+        self._r_frame_data = memoryview(self.r_frame)[:3]
+        self._w_frame_data = memoryview(self.w_frame)[:7]
+        # last written or read value of the SHADOWED_REGISTERS
+        self._shadow = {}
+        # last written value of the registers written since the last IFCNT verification
+        self._unverified = {}
         if serialport is None:
             return
-        try:
-            self.ser = serial.Serial (serialport, baudrate)
-        except Exception as e:
-            errnum = e.args[0]
-            self.tmc_logger.log(f"SERIAL ERROR: {e}")
-            if errnum == 2:
-                self.tmc_logger.log(f""""{serialport} does not exist.
-                      You need to activate the serial port with \"sudo raspi-config\"""")
-            if errnum == 13:
-                self.tmc_logger.log("""you have no permission to use the serial port.
-                                    You may need to add your user to the dialout group
-                                    with \"sudo usermod -a -G dialout pi\"""")
-
-        self.mtr_id = mtr_id
-        self.ser.BYTESIZES = 1
-        self.ser.PARITIES = serial.PARITY_NONE
-        self.ser.STOPBITS = 1
-
-        # adjust per baud and hardware. Sequential reads without some delay fail.
-        self.ser.timeout = 20000/baudrate
-        # adjust per baud and hardware. Sequential reads without some delay fail.
-        self.communication_pause = 500/baudrate
-
-
-        self.ser.reset_output_buffer()
-        self.ser.reset_input_buffer()
+        self.bus = TMC_UART_Bus.open(tmc_logger, serialport, baudrate)
 
 
 
     def __del__(self):
         """""destructor"""""
-        if self.ser is not None:
-            self.ser.close()
+        if self.bus is not None:
+            self.bus.close()
+            self.bus = None
 
 
 
@@ -83,20 +300,12 @@ class TMC_UART:
         """this function calculates the crc8 parity bit
 
         Args:
-            datagram (list): datagram
+            datagram (list): datagram; any iterable of bytes
             initial_value (int): initial value (Default value = 0)
         """
         crc = initial_value
-        # Iterate bytes in data
         for byte in datagram:
-            # Iterate bits in byte
-            for _ in range(0, 8):
-                if (crc >> 7) ^ (byte & 0x01):
-                    crc = ((crc << 1) ^ 0x07) & 0xFF
-                else:
-                    crc = (crc << 1) & 0xFF
-                # Shift to next bit
-                byte = byte >> 1
+            crc = CRC8_TABLE[crc ^ BIT_REVERSED[byte]]
         return crc
 
 
@@ -108,40 +317,36 @@ class TMC_UART:
         Args:
             register (int): HEX, which register to read
         """
-
-        self.ser.reset_output_buffer()
-        self.ser.reset_input_buffer()
-
-        self.r_frame[1] = self.mtr_id
-        self.r_frame[2] = register
-        self.r_frame[3] = self.compute_crc8_atm(self.r_frame[:-1])
-
-        rtn = self.ser.write(self.r_frame)
-        if rtn != len(self.r_frame):
-            self.tmc_logger.log("Err in write", Loglevel.ERROR)
-            return False
-
-        # adjust per baud and hardware. Sequential reads without some delay fail.
-        time.sleep(self.communication_pause)
-
-        rtn = self.ser.read(12)
+        with self._frame_lock:
+            r_frame = self.r_frame
+            r_frame[1] = self.mtr_id
+            r_frame[2] = register
+            r_frame[3] = self.compute_crc8_atm(self._r_frame_data)
+            frame = bytes(r_frame)
+
+        # 4 bytes echo of the read frame and 8 bytes reply
+        rtn = self.bus.transfer(frame, 12)
         #self.tmc_logger.log(f"received {len(rtn)} bytes; {len(rtn*8)} bits")
         #self.tmc_logger.log(rtn.hex())
 
-        time.sleep(self.communication_pause)
-
         return rtn
 
 
 
     def read_int(self, register, tries=10):
         """this function tries to read the registry of the TMC 10 times
-        if a valid answer is returned, this function returns it as an integer
+        if a valid answer is returned, this function returns it as an integer.
+        a register with a write queued in a batch returns the queued value.
+        the unverified writes are verified first, so that a read sees them
 
         Args:
             register (int): HEX, which register to read
             tries (int): how many tries, before error is raised (Default value = 10)
         """
+        if self._batch and register in self._batch:
+            return self._batch[register]
+        if self._unverified_count and register != reg.IFCNT:
+            self.verify_writes()
         while True:
             tries -= 1
             rtn = self.read_reg(register)
@@ -165,41 +370,75 @@ class TMC_UART:
                 return -1
 
         val = struct.unpack(">i",rtn_data)[0]
+        if register == reg.IFCNT:
+            self._ifcnt = val
+        elif register == reg.GSTAT and val & reg.reset:
+            # the registers are back at their power up values
+            self.invalidate_shadow()
+        elif register in SHADOWED_REGISTERS:
+            self._shadow[register] = val
         return val
 
 
 
-    def write_reg(self, register, val):
-        """this function can write a value to the register of the tmc
-        1. use read_int to get the current setting of the TMC
-        2. then modify the settings as wished
-        3. write them back to the driver with this function
+    def read_int_cached(self, register):
+        """returns the shadow copy of a register, if there is one;
+        otherwise the register is read from the TMC
 
         Args:
-            register (int): HEX, which register to write
-            val (int): value for that register
+            register (int): HEX, which register to read
+        """
+        val = self._shadow.get(register)
+        if val is None:
+            val = self.read_int(register)
+        return val
+
+
+
+    def get_shadow(self, register):
+        """returns the shadow copy of a register
+
+        Args:
+            register (int): HEX, which register
+
+        Returns:
+            int: last written or read value; None if it is unknown
         """
+        return self._shadow.get(register)
 
-        self.ser.reset_output_buffer()
-        self.ser.reset_input_buffer()
 
-        self.w_frame[1] = self.mtr_id
-        self.w_frame[2] =  register | 0x80  # set write bit
 
-        self.w_frame[3] = 0xFF & (val>>24)
-        self.w_frame[4] = 0xFF & (val>>16)
-        self.w_frame[5] = 0xFF & (val>>8)
-        self.w_frame[6] = 0xFF & val
+    def invalidate_shadow(self):
+        """forgets the shadow copies of the registers and the counted IFCNT,
+        so that they are read from the TMC again"""
+        self._shadow.clear()
+        self._ifcnt = None
 
-        self.w_frame[7] = self.compute_crc8_atm(self.w_frame[:-1])
 
 
-        rtn = self.ser.write(self.w_frame)
-        if rtn != len(self.w_frame):
-            self.tmc_logger.log("Err in write", Loglevel.ERROR)
-            return False
+    def write_reg(self, register, val):
+        """this function can write a value to the register of the tmc
+        1. use read_int to get the current setting of the TMC
+        2. then modify the settings as wished
+        3. write them back to the driver with this function
+        the frame is queued on the bus; the function does not wait until it is sent
 
-        time.sleep(self.communication_pause)
+        Args:
+            register (int): HEX, which register to write
+            val (int): value for that register
+        """
+        with self._frame_lock:
+            w_frame = self.w_frame
+            w_frame[1] = self.mtr_id
+            w_frame[2] = register | 0x80  # set write bit
+            struct.pack_into(">I", w_frame, 3, val & 0xFFFFFFFF)
+            w_frame[7] = self.compute_crc8_atm(self._w_frame_data)
+
+            self.bus.write(w_frame)
+            if register in SHADOWED_REGISTERS:
+                self._shadow[register] = val
+            if self._ifcnt is not None:
+                self._ifcnt = (self._ifcnt + 1) & 0xFF
 
         return True
 
@@ -208,40 +447,135 @@ class TMC_UART:
     def write_reg_check(self, register, val, tries=10):
         """this function als writes a value to the register of the TMC
         but it also checks if the writing process was successfully by checking
-        the InterfaceTransmissionCounter before and after writing
+        the InterfaceTransmissionCounter.
+        the write costs one frame: it is verified together with the following writes
+        by verify_writes, which is called by the next read. IFCNT is only read
+        before the write, if its count is unknown.
+        the write is skipped if the value equals the shadow copy
 
         Args:
             register: HEX, which register to write
             val: value for that register
             tries: how many tries, before error is raised (Default value = 10)
         """
-        ifcnt1 = self.read_int(reg.IFCNT)
+        if register in SHADOWED_REGISTERS and self._shadow.get(register) == val:
+            return True
+        if self._batch is not None:
+            # a later write to the same register replaces the queued one
+            self._batch.pop(register, None)
+            self._batch[register] = val
+            if register in SHADOWED_REGISTERS:
+                self._shadow[register] = val
+            return True
+        self._write_unverified(register, val)
+        if self._unverified_count >= MAX_UNVERIFIED_WRITES:
+            return self.verify_writes(tries)
+        return True
 
-        if ifcnt1 == 255:
-            ifcnt1 = -1
 
-        while True:
-            self.write_reg(register, val)
+
+    def _write_unverified(self, register, val):
+        """writes a register and keeps the write for verify_writes.
+        the counter before the first unverified write is taken from the last read,
+        counted on with every write
+
+        Args:
+            register: HEX, which register to write
+            val: value for that register
+        """
+        if self._unverified_count == 0:
+            ifcnt = self._ifcnt
+            if ifcnt is None:
+                ifcnt = self.read_int(reg.IFCNT)
+            self._unverified_ifcnt = ifcnt
+        self.write_reg(register, val)
+        # a later write to the same register replaces the earlier one, if they are sent again
+        self._unverified.pop(register, None)
+        self._unverified[register] = val
+        self._unverified_count += 1
+
+
+
+    def verify_writes(self, tries=10):
+        """verifies the writes since the last verification with one IFCNT read:
+        the counter has to advance by the number of writes.
+        on a mismatch the last value of every written register is sent again
+
+        Args:
+            tries: how many tries, before error is raised (Default value = 10)
+        """
+        while self._unverified_count:
             tries -= 1
             ifcnt2 = self.read_int(reg.IFCNT)
-            if ifcnt1 >= ifcnt2:
-                self.tmc_logger.log("writing not successful!", Loglevel.ERROR)
-                self.tmc_logger.log("ifcnt:",ifcnt1,ifcnt2, Loglevel.DEBUG)
-            else:
+            if (ifcnt2 - self._unverified_ifcnt) & 0xFF == self._unverified_count:
+                self._unverified.clear()
+                self._unverified_count = 0
                 return True
+            self.tmc_logger.log("writing not successful!", Loglevel.ERROR)
+            self.tmc_logger.log(f"ifcnt: {self._unverified_ifcnt}, {ifcnt2}; "
+                                f"{self._unverified_count} writes", Loglevel.DEBUG)
+            writes = list(self._unverified.items())
             if tries<=0:
                 self.tmc_logger.log("after 10 tries no valid write access", Loglevel.ERROR)
+                for register, _ in writes:
+                    self._shadow.pop(register, None)
+                self._unverified.clear()
+                self._unverified_count = 0
                 self.handle_error()
                 return -1
+            self._unverified_ifcnt = ifcnt2
+            self._unverified_count = len(writes)
+            for register, val in writes:
+                self.write_reg(register, val)
+        return True
+
+
+
+    def begin_batch(self):
+        """starts queueing the writes of write_reg_check until end_batch.
+        batches can be nested; the outermost end_batch sends the writes"""
+        if self._batch_depth == 0:
+            self._batch = {}
+        self._batch_depth += 1
+
+
+
+    def end_batch(self, tries=10):
+        """sends the queued writes back to back and verifies all of them
+        with one IFCNT read, together with the writes before the batch
+
+        Args:
+            tries: how many tries, before error is raised (Default value = 10)
+        """
+        if self._batch_depth > 1:
+            self._batch_depth -= 1
+            return True
+        self._batch_depth = 0
+        batch = self._batch
+        self._batch = None
+        if not batch:
+            return True
+
+        for register, val in batch.items():
+            self._write_unverified(register, val)
+        return self.verify_writes(tries)
+
+
+
+    def abort_batch(self):
+        """drops the queued writes. the shadow copies are dropped as well,
+        because they already hold the queued values"""
+        self._batch_depth = 0
+        self._batch = None
+        self.invalidate_shadow()
 
 
 
     def flush_serial_buffer(self):
         """this function clear the communication buffers of the Raspberry Pi"""
-        if self.ser is None:
+        if self.bus is None:
             return
-        self.ser.reset_output_buffer()
-        self.ser.reset_input_buffer()
+        self.bus.flush()
 
 
 
@@ -299,28 +633,16 @@ class TMC_UART:
         Args:
             register (int):  HEX, which register to read
         """
+        with self._frame_lock:
+            self.r_frame[1] = self.mtr_id
+            self.r_frame[2] = register
+            self.r_frame[3] = self.compute_crc8_atm(self._r_frame_data)
+            frame = bytes(self.r_frame)
 
-        self.ser.reset_output_buffer()
-        self.ser.reset_input_buffer()
-
-        self.r_frame[1] = self.mtr_id
-        self.r_frame[2] = register
-        self.r_frame[3] = self.compute_crc8_atm(self.r_frame[:-1])
-
-        rtn = self.ser.write(self.r_frame)
-        if rtn != len(self.r_frame):
-            self.tmc_logger.log("Err in write", Loglevel.ERROR)
-            return False
-
-        # adjust per baud and hardware. Sequential reads without some delay fail.
-        time.sleep(self.communication_pause)
-
-        rtn = self.ser.read(12)
+        rtn = self.bus.transfer(frame, 12)
         self.tmc_logger.log(f"received {len(rtn)} bytes; {len(rtn)*8} bits", Loglevel.DEBUG)
         self.tmc_logger.log(f"hex: {rtn.hex()}", Loglevel.DEBUG)
         rtn_bin = format(int(rtn.hex(),16), f"0>{len(rtn)*8}b")
         self.tmc_logger.log(f"bin: {rtn_bin}", Loglevel.DEBUG)
 
-        time.sleep(self.communication_pause)
-
-        return bytes(self.r_frame), rtn
+        return frame, rtn
@@ -0,0 +1,135 @@
+#pylint: disable=invalid-name
+#pylint: disable=protected-access
+"""
+TMC_2209 stepper driver VACTUAL motion module
+
+moves the motor with the internal step generator of the TMC
+by updating the velocity register VACTUAL via UART along the planned ramp.
+the position is tracked by integrating the commanded velocity over time
+and corrected with the microstep counter MSCNT at the end of the movement
+"""
+
+import time
+from ._TMC_2209_logger import Loglevel
+from ._TMC_2209_move import MovementPhase, StopMode
+from ._TMC_2209_ramp import speed_at, estimate_duration, _ramp_shape, effective_acceleration
+from . import _TMC_2209_reg as tmc_reg
+from . import _TMC_2209_math as tmc_math
+
+
+
+def set_vactual_update_interval(self, interval):
+    """sets how often VACTUAL is updated during a movement.
+    every update costs one UART frame
+
+    Args:
+        interval (float): time between two VACTUAL updates in seconds
+    """
+    self._vactual_update_interval = interval
+
+
+
+def set_vactual_creep_speed(self, speed):
+    """sets the speed which is used to correct the remaining position error
+    at the end of a VACTUAL movement
+
+    Args:
+        speed (float): speed in µsteps per second
+    """
+    self._vactual_creep_speed = abs(speed)
+
+
+
+def run_vactual(self):
+    """runs the motor to the target position with the internal step generator.
+    no STEP pulses are generated by the Raspberry Pi.
+    MSCNT is expected to count in the direction set with set_mscnt_direction
+    for positive VACTUAL values.
+    the TMC has no ramp of its own, so a stop ends the movement immediately
+
+    should not be called from outside!
+    """
+    distance = self.distance_to_go()
+    if distance == 0:
+        return
+    sign = 1 if distance > 0 else -1
+    steps = abs(distance)
+    max_speed = self._max_speed
+    acceleration = self._acceleration
+    profile = self._ramp_profile
+    interval = self._vactual_update_interval
+
+    shape = _ramp_shape(steps, max_speed, effective_acceleration(acceleration, profile), 0.0, 0.0)
+    accel_time, cruise_time = shape[5], shape[6]
+    duration = estimate_duration(steps, max_speed, acceleration, profile=profile)
+
+    pos_start = self._current_pos
+    mscnt_start = self.get_microstep_counter()
+
+    travelled = 0.0
+    speed = 0.0
+    self._set_movement_phase(MovementPhase.ACCELERATING)
+    starttime = time.perf_counter()
+    last_update = starttime
+    while True:
+        now = time.perf_counter()
+        travelled += speed * (now - last_update)
+        last_update = now
+        t = now - starttime
+        if self._stop != StopMode.NO or t >= duration or travelled >= steps:
+            break
+
+        if t >= accel_time + cruise_time:
+            self._set_movement_phase(MovementPhase.DECELERATING)
+        elif t >= accel_time:
+            self._set_movement_phase(MovementPhase.MAXSPEED)
+
+        # use the speed of the middle of the next interval
+        speed = speed_at(t + interval / 2, steps, max_speed, acceleration, profile)
+        self.tmc_uart.write_reg(tmc_reg.VACTUAL, sign * tmc_math.steps_to_vactual(speed))
+        time.sleep(max(last_update + interval - time.perf_counter(), 0))
+
+    self.set_vactual(0)
+    travelled += speed * (time.perf_counter() - last_update)
+
+    estimate = pos_start + sign * round(travelled)
+    actual = self._vactual_position_from_mscnt(mscnt_start, pos_start, estimate)
+    for _ in range(3):
+        error = self._target_pos - actual
+        if error == 0 or self._stop != StopMode.NO:
+            break
+        self.tmc_logger.log(f"VACTUAL position error: {error} µsteps; correcting",
+                            Loglevel.DEBUG)
+        creep_speed = min(self._vactual_creep_speed, max_speed)
+        direction = 1 if error > 0 else -1
+        self.tmc_uart.write_reg(tmc_reg.VACTUAL,
+                                direction * tmc_math.steps_to_vactual(creep_speed))
+        time.sleep(abs(error) / creep_speed)
+        self.set_vactual(0)
+        # measured again, so the position is right even after the last correction
+        actual = self._vactual_position_from_mscnt(mscnt_start, pos_start, actual + error)
+
+    self._current_pos = actual
+
+
+
+def _vactual_position_from_mscnt(self, mscnt_start, pos_start, estimate):
+    """returns the position which matches the microstep counter
+    and is the nearest to the estimated position.
+    MSCNT covers one electrical period (4 fullsteps),
+    so the estimate must be better than 2 fullsteps
+
+    Args:
+        mscnt_start (int): MSCNT at the start of the movement
+        pos_start (int): position at the start of the movement in µsteps
+        estimate (int): estimated position in µsteps
+
+    Returns:
+        int: position in µsteps
+    """
+    period = 4 * self._msres
+    moved_in_period = (self._mscnt_direction * (self.get_microstep_counter() - mscnt_start)
+                       * self._msres / 256)
+    moved_estimate = estimate - pos_start
+    offset = (moved_in_period - moved_estimate + period / 2) % period - period / 2
+    return pos_start + round(moved_estimate + offset)
@@ -0,0 +1,85 @@
+#pylint: disable=invalid-name
+#pylint: disable=broad-exception-caught
+"""
+TMC_2209 motion worker module
+
+a long-lived thread which executes movements from a command queue.
+every submitted movement returns a future, which is completed
+when the movement is finished
+"""
+
+import threading
+import queue
+from concurrent.futures import Future
+
+
+
+class MotionWorker:
+    """MotionWorker
+
+    executes the submitted commands one after another in one persistent thread,
+    so that a movement does not have to pay for thread creation and join
+    """
+
+    _queue = None
+    _thread = None
+
+
+
+    def __init__(self, name = None):
+        """constructor
+
+        Args:
+            name (str, optional): name of the worker thread. Defaults to None.
+        """
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker_loop, name=name, daemon=True)
+        self._thread.start()
+
+
+
+    def submit(self, func, *args):
+        """queues a command for the worker thread
+
+        Args:
+            func (callable): function to execute
+            *args: arguments for the function
+
+        Returns:
+            Future: completed with the return value of the function
+        """
+        future = Future()
+        self._queue.put((future, func, args))
+        return future
+
+
+
+    def shutdown(self, wait = True):
+        """stops the worker thread after all queued commands are finished
+
+        Args:
+            wait (bool): whether to block until the thread has stopped (Default value = True)
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        if wait and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+
+
+    def _worker_loop(self):
+        """executes the queued commands until shutdown is called"""
+        while True:
+            command = self._queue.get()
+            if command is None:
+                break
+            future, func, args = command
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            # do not keep the driver alive while waiting for the next command
+            del command, future, func, args
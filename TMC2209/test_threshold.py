@@ -26,12 +26,7 @@ tmc.set_movement_abs_rel(MovementAbsRel.ABSOLUTE)
 #-----------------------------------------------------------------------
 # these functions change settings in the TMC register
 #-----------------------------------------------------------------------
-tmc.set_direction_reg(False)
-tmc.set_current(300)
-tmc.set_interpolation(True)
-tmc.set_spreadcycle(False)
-tmc.set_microstepping_resolution(2)
-tmc.set_internal_rsense(False)
+tmc.apply_profile(DEFAULT_PROFILE)
 
 
 print("---\n---")
@@ -0,0 +1,175 @@
+#pylint: disable=invalid-name
+"""
+fixtures for the unit tests of the TMC_2209 library
+
+the tests run without a Raspberry Pi and without a TMC attached:
+the pins are written to FakeGpioMem and the UART frames
+are answered by FakeTMCSerial, which keeps the registers of one driver
+"""
+
+import os
+import sys
+import struct
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from src.TMC_2209_StepperDriver import TMC_2209, Loglevel, FakeGpioMem
+from src._TMC_2209_GPIO_board import TMC_gpio
+from src._TMC_2209_uart import TMC_UART_Bus, CRC8_TABLE, BIT_REVERSED
+from src import _TMC_2209_reg as tmc_reg
+
+
+
+def crc8(datagram):
+    """crc8 of a UART frame, as the TMC computes it"""
+    crc = 0
+    for byte in datagram:
+        crc = CRC8_TABLE[crc ^ BIT_REVERSED[byte]]
+    return crc
+
+
+
+class FakeTMCSerial:
+    """FakeTMCSerial
+
+    serial port with one TMC2209 behind it.
+    write frames set the registers and count IFCNT up,
+    read frames are answered with the echo and the reply of the register
+    """
+
+    timeout = 0.01
+
+
+
+    def __init__(self):
+        """constructor"""
+        self.regs = {
+            tmc_reg.GCONF: 0x101,
+            tmc_reg.GSTAT: 0,
+            tmc_reg.IFCNT: 0,
+            tmc_reg.CHOPCONF: 0x10000053,
+            tmc_reg.MSCNT: 0,
+            tmc_reg.IOIN: 0x21000000,
+        }
+        self.frames = []
+        self._reply = b""
+
+
+
+    def reset_output_buffer(self):
+        """nothing is buffered"""
+
+
+
+    def reset_input_buffer(self):
+        """drops a reply which was not read"""
+        self._reply = b""
+
+
+
+    def close(self):
+        """nothing to close"""
+
+
+
+    def write(self, data):
+        """receives one frame
+
+        Args:
+            data (bytes): write frame (8 bytes) or read frame (4 bytes)
+
+        Returns:
+            int: amount of written bytes
+        """
+        data = bytes(data)
+        assert data[-1] == crc8(data[:-1]), "frame with a wrong crc"
+        self.frames.append(data)
+        register = data[2] & 0x7F
+        if len(data) == 8:
+            self.regs[register] = struct.unpack(">I", data[3:7])[0]
+            self.regs[tmc_reg.IFCNT] = (self.regs[tmc_reg.IFCNT] + 1) & 0xFF
+        else:
+            reply = bytes([0x05, 0xFF, register]) + struct.pack(">I", self.regs.get(register, 0))
+            self._reply = data + reply + bytes([crc8(reply)])
+        return len(data)
+
+
+
+    def read(self, size):
+        """returns the pending reply
+
+        Args:
+            size (int): amount of bytes to read
+        """
+        reply, self._reply = self._reply[:size], b""
+        return reply
+
+
+
+    def writes(self):
+        """returns the registers of the write frames received so far"""
+        return [frame[2] & 0x7F for frame in self.frames if len(frame) == 8]
+
+
+
+    def reads(self):
+        """returns the registers of the read frames received so far"""
+        return [frame[2] for frame in self.frames if len(frame) == 4]
+
+
+
+@pytest.fixture
+def gpio_mem():
+    """writes the pins of the drivers to FakeGpioMem"""
+    mem = FakeGpioMem()
+    TMC_gpio.use_gpio_mem(mem)
+    yield mem
+    TMC_gpio.use_gpio_mem(None)
+    mem.close()
+
+
+
+def make_driver(pin_en, pin_step, pin_dir, driver_address = 0):
+    """returns a driver without UART, which moves fast enough for tests"""
+    tmc = TMC_2209(pin_en, pin_step, pin_dir, serialport=None, skip_uart_init=True,
+                   driver_address=driver_address, loglevel=Loglevel.ERROR)
+    tmc.set_max_speed(4000)
+    tmc.set_acceleration(40000)
+    return tmc
+
+
+
+@pytest.fixture
+def tmc(gpio_mem):
+    """driver without UART"""
+    # pylint: disable=redefined-outer-name,unused-argument
+    tmc = make_driver(21, 16, 20)
+    yield tmc
+    tmc.set_deinitialize_true()
+
+
+
+@pytest.fixture
+def tmc_pair(gpio_mem):
+    """two drivers without UART, as they are used by TMC_CoreXY"""
+    # pylint: disable=unused-argument
+    tmc_a = make_driver(21, 16, 20)
+    tmc_b = make_driver(26, 13, 19, driver_address=1)
+    yield tmc_a, tmc_b
+    tmc_a.set_deinitialize_true()
+    tmc_b.set_deinitialize_true()
+
+
+
+@pytest.fixture
+def fake_serial(tmc):
+    """FakeTMCSerial, which is connected to the UART of the tmc fixture"""
+    # pylint: disable=redefined-outer-name
+    ser = FakeTMCSerial()
+    bus = TMC_UART_Bus(tmc.tmc_logger, ser, 0)
+    tmc.tmc_uart.bus = bus
+    yield ser
+    tmc.tmc_uart.bus = None
+    bus.close()
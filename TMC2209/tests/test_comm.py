@@ -0,0 +1,181 @@
+#pylint: disable=invalid-name
+"""
+tests of the register settings of the comm module with FakeTMCSerial
+"""
+
+import pytest
+from src import _TMC_2209_reg as tmc_reg
+
+
+
+@pytest.fixture
+def checked_tmc(tmc, fake_serial):
+    """driver at 16 µsteps with a MSCNT reference at position 0 and MSCNT 8"""
+    tmc.set_microstepping_resolution(16)
+    fake_serial.regs[tmc_reg.MSCNT] = 8
+    tmc.set_current_position(0)
+    tmc.set_mscnt_reference()
+    return tmc
+
+
+
+def test_no_reference(tmc, fake_serial):
+    """without a reference there is nothing to check"""
+    fake_serial.regs[tmc_reg.MSCNT] = 500
+    assert tmc.check_position(correct=False)
+
+
+
+@pytest.mark.parametrize("position, mscnt", [
+    (10, 8 + 10 * 16),
+    (-3, 8 - 3 * 16 + 1024),
+    (100, (8 + 100 * 16) % 1024),
+])
+def test_position_matches(checked_tmc, fake_serial, position, mscnt):
+    """MSCNT moves by 256/msres per µstep and wraps around after 1024"""
+    # pylint: disable=redefined-outer-name
+    checked_tmc.set_current_position(position)
+    fake_serial.regs[tmc_reg.MSCNT] = mscnt
+    assert checked_tmc.check_position(correct=False)
+
+
+
+@pytest.mark.parametrize("direction", [1, -1])
+def test_lost_steps(checked_tmc, fake_serial, direction):
+    """lost steps are found in both counting directions"""
+    # pylint: disable=redefined-outer-name
+    checked_tmc.set_mscnt_direction(direction)
+    checked_tmc.set_current_position(10)
+    fake_serial.regs[tmc_reg.MSCNT] = (8 + direction * 10 * 16) % 1024
+    assert checked_tmc.check_position(correct=False)
+    # two µsteps did not reach the driver
+    fake_serial.regs[tmc_reg.MSCNT] = (8 + direction * 8 * 16) % 1024
+    assert not checked_tmc.check_position(correct=False)
+
+
+
+def test_correction(checked_tmc, fake_serial, gpio_mem):
+    """small errors are corrected by moving to the position again"""
+    # pylint: disable=redefined-outer-name
+    checked_tmc.set_current_position(10)
+    fake_serial.regs[tmc_reg.MSCNT] = 8 + 8 * 16
+    step_writes = gpio_mem.writes.get(16, 0)
+    assert checked_tmc.check_position()
+    assert checked_tmc.get_current_position() == 10
+    # the two lost µsteps are made again; every pulse is one HIGH and one LOW write
+    assert gpio_mem.writes[16] - step_writes >= 4
+
+
+
+@pytest.mark.parametrize("lost, corrected", [(16, True), (17, False), (20, False)])
+def test_error_too_large(checked_tmc, fake_serial, lost, corrected):
+    """errors of more than one fullstep are flagged and not corrected"""
+    # pylint: disable=redefined-outer-name
+    checked_tmc.set_current_position(40)
+    fake_serial.regs[tmc_reg.MSCNT] = 8 + (40 - lost) * 16
+    assert checked_tmc.check_position() == corrected
+    assert checked_tmc.get_current_position() == 40
+
+
+
+@pytest.fixture
+def warm_state(checked_tmc, fake_serial):
+    """warm start state at position 10, after which the driver was restarted
+    without a reset and without writes"""
+    # pylint: disable=redefined-outer-name
+    checked_tmc.set_current_position(10)
+    fake_serial.regs[tmc_reg.MSCNT] = 8 + 10 * 16
+    state = checked_tmc.get_warm_start_state()
+    checked_tmc._gstat_at_init = 0
+    checked_tmc._ifcnt_at_init = state["ifcnt"]
+    checked_tmc.set_current_position(0)
+    return state
+
+
+
+def test_warm_start(checked_tmc, warm_state):
+    """the saved position is restored while MSCNT matches it"""
+    # pylint: disable=redefined-outer-name
+    assert checked_tmc.restore_warm_start_state(warm_state)
+    assert checked_tmc.get_current_position() == 10
+
+
+
+def test_warm_start_mscnt_moved(checked_tmc, fake_serial, warm_state):
+    """a driver which received steps since the state was saved rejects the warm start"""
+    # pylint: disable=redefined-outer-name
+    fake_serial.regs[tmc_reg.MSCNT] = 8 + 12 * 16
+    assert not checked_tmc.restore_warm_start_state(warm_state)
+    assert checked_tmc.get_current_position() == 0
+
+
+
+def sent_register(tmc, fake_serial, register):
+    """returns a register of the TMC after the queued writes are sent"""
+    tmc.tmc_uart.flush_serial_buffer()
+    return fake_serial.regs[register]
+
+
+
+def test_stealthchop_max_speed(tmc, fake_serial):
+    """the switch-over speed is written as TSTEP value to TPWMTHRS"""
+    tmc.set_microstepping_resolution(16)
+    tmc.set_stealthchop_max_speed(1000)
+    # TSTEP is the time of one µstep in 1/fclk: 12 MHz / (1000 µsteps/s * 256 / 16)
+    assert sent_register(tmc, fake_serial, tmc_reg.TPWMTHRS) == 750
+    assert tmc.get_stealthchop_max_speed() == 1000
+    # below 0.72 µsteps/s the TSTEP value does not fit into 20 bits
+    tmc.set_stealthchop_max_speed(0.5)
+    assert sent_register(tmc, fake_serial, tmc_reg.TPWMTHRS) == 0xFFFFF
+    tmc.set_stealthchop_max_speed(0)
+    assert sent_register(tmc, fake_serial, tmc_reg.TPWMTHRS) == 0
+    assert tmc.get_stealthchop_max_speed() == 0
+
+
+
+def test_stealthchop_max_speed_msres(tmc, fake_serial):
+    """TPWMTHRS does not depend on the µstep resolution;
+    the switch-over speed in µsteps changes with it"""
+    tmc.set_microstepping_resolution(16)
+    tmc.set_stealthchop_max_speed(1000)
+    tmc.change_microstepping_resolution(8)
+    assert sent_register(tmc, fake_serial, tmc_reg.TPWMTHRS) == 750
+    assert tmc.get_stealthchop_max_speed() == 500
+    tmc.set_stealthchop_max_speed(500)
+    assert sent_register(tmc, fake_serial, tmc_reg.TPWMTHRS) == 750
+
+
+
+def test_change_microstepping_resolution(tmc, fake_serial, gpio_mem):
+    """the position, the speeds and the acceleration keep their physical value"""
+    tmc.set_microstepping_resolution(16)
+    tmc.set_current_position(1001)
+    tmc.set_max_speed(4000)
+    tmc.set_acceleration(40000)
+    step_writes = gpio_mem.writes.get(16, 0)
+    tmc.change_microstepping_resolution(8)
+    # 1001 does not exist at 8 µsteps, so the motor moves to 1000 first:
+    # the STEP pin is set LOW before the movement and pulsed once
+    assert gpio_mem.writes[16] - step_writes == 3
+    assert tmc.get_microstepping_resolution() == 8
+    assert tmc.get_current_position() == 500
+    assert tmc.get_max_speed() == 2000
+    assert tmc.get_acceleration() == 20000
+    tmc.change_microstepping_resolution(32)
+    assert tmc.get_microstepping_resolution() == 32
+    assert tmc.get_current_position() == 2000
+    assert tmc.get_max_speed() == 8000
+    assert tmc.get_acceleration() == 80000
+
+
+
+def test_change_microstepping_resolution_check(tmc, fake_serial):
+    """the MSCNT reference stays valid with the new resolution"""
+    tmc.set_microstepping_resolution(16)
+    fake_serial.regs[tmc_reg.MSCNT] = 8
+    tmc.set_current_position(0)
+    tmc.set_mscnt_reference()
+    tmc.change_microstepping_resolution(4)
+    tmc.set_current_position(10)
+    fake_serial.regs[tmc_reg.MSCNT] = 8 + 10 * 64
+    assert tmc.check_position(correct=False)
@@ -0,0 +1,134 @@
+#pylint: disable=invalid-name
+"""
+tests of the coordinated CoreXY movement and its look-ahead planning
+"""
+
+import math
+import threading
+import pytest
+from src.TMC_2209_StepperDriver import TMC_CoreXY, StopMode
+
+MAX_SPEED = 4000
+ACCELERATION = 20000
+
+
+
+@pytest.fixture
+def corexy(tmc_pair):
+    """TMC_CoreXY of two drivers without UART"""
+    return TMC_CoreXY(*tmc_pair)
+
+
+
+def test_common_timeline(corexy, gpio_mem):
+    """both motors make all of their steps in one move"""
+    # pylint: disable=redefined-outer-name
+    assert corexy.run_to_position_steps(400, -150) == StopMode.NO
+    assert corexy.tmc_a.get_current_position() == 400
+    assert corexy.tmc_b.get_current_position() == -150
+    # every step writes the STEP pin HIGH and LOW
+    pin_a = corexy.tmc_a._pin_step
+    pin_b = corexy.tmc_b._pin_step
+    assert gpio_mem.writes[pin_a] - gpio_mem.writes[pin_b] == 2 * (400 - 150)
+
+
+
+def test_softstop(corexy):
+    """a soft stop decelerates both motors before the end of the move"""
+    # pylint: disable=redefined-outer-name
+    timer = threading.Timer(0.1, corexy.stop, (StopMode.SOFTSTOP,))
+    timer.start()
+    assert corexy.run_to_position_steps(4000, 2000) == StopMode.SOFTSTOP
+    timer.join()
+    pos_a = corexy.tmc_a.get_current_position()
+    pos_b = corexy.tmc_b.get_current_position()
+    assert 0 < pos_a < 4000
+    assert abs(2 * pos_b - pos_a) <= 1
+
+
+
+def assert_reachable(segments, junctions):
+    """every segment can change from the speed at its start to the one at its end"""
+    assert junctions[0] == 0
+    assert junctions[-1] == 0
+    for (steps_a, steps_b), v0, v1 in zip(segments, junctions, junctions[1:]):
+        length = max(abs(steps_a), abs(steps_b))
+        assert abs(v1**2 - v0**2) <= 2 * ACCELERATION * length + 1e-6
+        assert 0 <= v1 <= MAX_SPEED
+
+
+
+def test_straight_line(corexy):
+    """segments in the same direction are joined at max speed"""
+    # pylint: disable=redefined-outer-name
+    segments = [(1000, 1000), (2000, 2000), (1000, 1000)]
+    junctions = corexy.plan_junction_speeds(segments, MAX_SPEED, ACCELERATION)
+    assert junctions[1:3] == [MAX_SPEED, MAX_SPEED]
+    assert_reachable(segments, junctions)
+
+
+
+def test_short_segments(corexy):
+    """short segments limit the junction speed to what can be reached"""
+    # pylint: disable=redefined-outer-name
+    segments = [(100, 100), (100, 100)]
+    junctions = corexy.plan_junction_speeds(segments, MAX_SPEED, ACCELERATION)
+    assert junctions[1] == pytest.approx(math.sqrt(2 * ACCELERATION * 100))
+    assert_reachable(segments, junctions)
+
+
+
+def test_corner_without_junction_speed(corexy):
+    """without a junction speed the motors stop at every change of direction"""
+    # pylint: disable=redefined-outer-name
+    segments = [(1000, 0), (0, 1000), (-1000, -1000)]
+    junctions = corexy.plan_junction_speeds(segments, MAX_SPEED, ACCELERATION)
+    assert junctions == [0, 0, 0, 0]
+
+
+
+def test_corner_with_junction_speed(corexy):
+    """the junction speed limits the abrupt speed change of each motor"""
+    # pylint: disable=redefined-outer-name
+    corexy.set_junction_speed(500)
+    # 90° corner: each motor changes its speed by the full major axis speed
+    # diagonal to half diagonal: the B motor changes by half of it
+    segments = [(1000, 0), (0, 1000), (1000, 1000), (1000, 500)]
+    junctions = corexy.plan_junction_speeds(segments, MAX_SPEED, ACCELERATION)
+    assert junctions[1] == pytest.approx(500)
+    assert junctions[2] == pytest.approx(500)
+    assert junctions[3] == pytest.approx(1000)
+    assert_reachable(segments, junctions)
+
+
+
+def test_reversal(corexy):
+    """a reversal is limited to half of the junction speed"""
+    # pylint: disable=redefined-outer-name
+    corexy.set_junction_speed(500)
+    segments = [(1000, 1000), (-1000, -1000)]
+    junctions = corexy.plan_junction_speeds(segments, MAX_SPEED, ACCELERATION)
+    assert junctions[1] == pytest.approx(250)
+    assert_reachable(segments, junctions)
+
+
+
+def test_junction_speeds_msres(corexy):
+    """with the junction speed scaled like the other settings,
+    a coarser µstep resolution gives the same physical junction speeds"""
+    # pylint: disable=redefined-outer-name
+    segments = [(1000, 0), (0, 1000), (1000, 1000), (1000, 500), (-1000, -1000)]
+    corexy.set_junction_speed(500)
+    junctions = corexy.plan_junction_speeds(segments, MAX_SPEED, ACCELERATION)
+    corexy.set_junction_speed(500 / 2)
+    coarse = corexy.plan_junction_speeds([(a // 2, b // 2) for a, b in segments],
+                                         MAX_SPEED / 2, ACCELERATION / 2)
+    assert coarse == pytest.approx([v / 2 for v in junctions])
+
+
+
+def test_estimate_segments(corexy):
+    """a single segment takes as long as the planned ramp of its major axis"""
+    # pylint: disable=redefined-outer-name
+    duration = corexy.estimate_segments([(5000, -2000)], MAX_SPEED, ACCELERATION)
+    assert duration == pytest.approx(2 * 0.2 + 4200 / 4000)
@@ -0,0 +1,127 @@
+#pylint: disable=invalid-name
+"""
+tests of the movement module
+"""
+
+import time
+import numpy as np
+import pytest
+from src.TMC_2209_StepperDriver import StopMode, StepJitterRecorder, TMC_CoreXY
+from src import _TMC_2209_reg as tmc_reg
+
+
+
+class StallingRecorder(StepJitterRecorder):
+    """StepJitterRecorder, which stalls the step loop once while recording"""
+
+    stall_step = 10
+    stall_end = None
+
+
+
+    def record(self, planned, actual, phase):
+        """records one step and stalls for 20 ms after the stall_step"""
+        super().record(planned, actual, phase)
+        if self._count == self.stall_step + 1:
+            time.sleep(0.02)
+            self.stall_end = time.perf_counter_ns()
+
+
+
+def austin_intervals(tmc, compute_new_speed, steps):
+    """returns the step intervals of the real-time ramp of one movement in µs,
+    without making the steps"""
+    tmc.set_current_position(0)
+    tmc._target_pos = steps
+    tmc._stop = StopMode.NO
+    tmc._speed = 0.0
+    tmc._n = 0
+    tmc._n_fx = 0
+    tmc._cn_fx = 0
+    compute_new_speed()
+    intervals = []
+    while tmc._speed != 0.0 and tmc.distance_to_go() != 0:
+        intervals.append(tmc._step_interval)
+        tmc._current_pos += 1
+        compute_new_speed()
+    return intervals
+
+
+
+@pytest.mark.parametrize("steps, max_speed, acceleration", [
+    (20000, 4000, 8000),    # trapezoid
+    (5000, 4000, 40000),    # trapezoid
+    (4040, 2000, 1200),     # trapezoid with a short cruise
+    (505, 1000, 1000),      # triangle
+    (300, 4000, 8000),      # triangle
+    (7, 4000, 8000),        # triangle of a few steps
+])
+def test_fixed_point_ramp(tmc, steps, max_speed, acceleration):
+    """the fixed-point Austin ramp has the intervals of the float implementation"""
+    tmc.set_max_speed(max_speed)
+    tmc.set_acceleration(acceleration)
+    intervals_float = austin_intervals(tmc, tmc.compute_new_speed, steps)
+    intervals_fixed = austin_intervals(tmc, tmc.compute_new_speed_fixed, steps)
+    assert len(intervals_fixed) == len(intervals_float)
+    assert intervals_fixed == pytest.approx(intervals_float, abs=1)
+
+
+
+@pytest.mark.parametrize("corexy", [False, True])
+def test_recorded_step_times(tmc_pair, corexy):
+    """the recorder gets the real time after the wait and the deadline
+    which was waited for, also when a stall delays the rest of the movement"""
+    tmc, tmc_b = tmc_pair
+    recorder = StallingRecorder(1024)
+    if corexy:
+        mover = TMC_CoreXY(tmc, tmc_b)
+        mover.set_jitter_recorder(recorder)
+        mover.run_to_position_steps(400, 100)
+    else:
+        tmc.set_jitter_recorder(recorder)
+        tmc.run_to_position_steps(400)
+    planned = np.frombuffer(recorder._planned, dtype=np.uint64)[:400].astype(np.int64)
+    actual = np.frombuffer(recorder._actual, dtype=np.uint64)[:400].astype(np.int64)
+    assert np.all(np.diff(actual) > 0)
+    assert np.all(actual[recorder.stall_step+1:] >= recorder.stall_end)
+    # the step after the stall is late; then the deadlines are delayed by the stall
+    lateness, _ = recorder.get_lateness()
+    assert lateness[recorder.stall_step+1] > 10000
+    assert np.median(lateness[recorder.stall_step+2:]) < 1000
+    assert np.all(planned[recorder.stall_step+2:] > recorder.stall_end - 1000000)
+
+
+
+def irun_writes(tmc, fake_serial):
+    """returns the IRUN of every IHOLD_IRUN write, after the queued frames were sent"""
+    tmc.tmc_uart.flush_serial_buffer()
+    return [frame[5] & 0x1F for frame in fake_serial.frames
+            if len(frame) == 8 and frame[2] & 0x7F == tmc_reg.IHOLD_IRUN]
+
+
+
+def test_no_boost(tmc, fake_serial):
+    """without a boost the movement writes no current"""
+    tmc.set_current(800)
+    tmc.tmc_uart.flush_serial_buffer()
+    fake_serial.frames.clear()
+    tmc.run_to_position_steps(1000)
+    assert not irun_writes(tmc, fake_serial)
+
+
+
+def test_boost(tmc, fake_serial):
+    """the boosted current is written for the ramps and the normal one
+    for the cruise and the standstill; unchanged currents are not written again"""
+    tmc.set_current(500)
+    tmc.set_current_boost(1.5)
+    tmc.tmc_uart.flush_serial_buffer()
+    irun = tmc._cs_irun
+    boost = tmc._cs_irun_boost
+    # the current is proportional to CS+1
+    assert boost == min(round((irun + 1) * 1.5 - 1), 31)
+    assert boost > irun
+    fake_serial.frames.clear()
+    tmc.run_to_position_steps(1000)
+    assert irun_writes(tmc, fake_serial) == [boost, irun, boost, irun]
+    assert fake_serial.regs[tmc_reg.IHOLD_IRUN] >> 8 & 0x1F == irun
@@ -0,0 +1,146 @@
+#pylint: disable=invalid-name
+"""
+tests of the shared-memory rings of the motion process, in a single process
+"""
+
+import zlib
+import threading
+import pytest
+from src.TMC_2209_StepperDriver import TMC_CoreXY, StopMode
+from src import _TMC_2209_process as tmc_process
+from src._TMC_2209_process import ShmRing, CMD_SEGMENT
+
+
+
+@pytest.fixture
+def ring():
+    """ring of 4 slots"""
+    shm_ring = ShmRing(slots=4)
+    yield shm_ring
+    shm_ring.close()
+
+
+
+def slot_offset(index):
+    """returns the offset of a slot in the shared memory"""
+    return tmc_process._HEADER_SIZE + index * tmc_process._SLOT_SIZE
+
+
+
+def test_slots_must_be_a_power_of_two():
+    """the mask of the counters needs a power of two"""
+    with pytest.raises(ValueError):
+        ShmRing(slots=6)
+
+
+
+def test_put_get(ring):
+    """records come out in order, padded to 6 arguments"""
+    # pylint: disable=redefined-outer-name
+    assert ring.get() is None
+    assert ring.put(CMD_SEGMENT, 100, -50)
+    assert ring.put(CMD_SEGMENT, 1.5)
+    assert ring.get() == (CMD_SEGMENT, 100.0, -50.0, 0.0, 0.0, 0.0, 0.0)
+    assert ring.get() == (CMD_SEGMENT, 1.5, 0.0, 0.0, 0.0, 0.0, 0.0)
+    assert ring.get() is None
+
+
+
+def test_full_ring(ring):
+    """a full ring refuses records until the reader frees a slot"""
+    # pylint: disable=redefined-outer-name
+    for i in range(4):
+        assert ring.put(CMD_SEGMENT, i)
+    assert not ring.put(CMD_SEGMENT, 4)
+    assert ring.get()[1] == 0
+    assert ring.put(CMD_SEGMENT, 4)
+    assert [ring.get()[1] for _ in range(4)] == [1, 2, 3, 4]
+
+
+
+@pytest.mark.parametrize("start", [0, 0xFFFFFFFE])
+def test_wrap_around(ring, start):
+    """the slots are reused and the 32bit counters wrap around"""
+    # pylint: disable=redefined-outer-name
+    ring._header[tmc_process._HEAD] = start
+    ring._header[tmc_process._TAIL] = start
+    for i in range(10):
+        assert ring.put(CMD_SEGMENT, i, i)
+        assert ring.put(CMD_SEGMENT, -i, i)
+        assert ring.get()[1:3] == (i, i)
+        assert ring.get()[1:3] == (-i, i)
+    assert ring.get() is None
+    assert ring._header[tmc_process._HEAD] == (start + 20) & 0xFFFFFFFF
+
+
+
+def test_torn_slot(ring):
+    """a record whose crc does not match yet is not read and not removed"""
+    # pylint: disable=redefined-outer-name
+    ring.put(CMD_SEGMENT, 100, 200)
+    offset = slot_offset(0) + 12
+    byte = ring._shm.buf[offset]
+    ring._shm.buf[offset] = byte ^ 0xFF
+    assert ring.get() is None
+    assert ring.get() is None
+    # the rest of the record becomes visible
+    ring._shm.buf[offset] = byte
+    assert ring.get() == (CMD_SEGMENT, 100.0, 200.0, 0.0, 0.0, 0.0, 0.0)
+
+
+
+def test_stale_slot(ring):
+    """a slot which still holds the record of the previous round is not read"""
+    # pylint: disable=redefined-outer-name
+    for i in range(4):
+        ring.put(CMD_SEGMENT, i)
+        ring.get()
+    # the head is visible before the new record: the slot has a valid crc, but sequence 0
+    ring._header[tmc_process._HEAD] = 5
+    assert ring.get() is None
+    data = tmc_process._SLOT_DATA.pack(4, CMD_SEGMENT, 4, 0, 0, 0, 0, 0)
+    ring._shm.buf[slot_offset(0):slot_offset(1)] = (
+        data + tmc_process._SLOT_CRC.pack(zlib.crc32(data)))
+    assert ring.get()[1] == 4
+
+
+
+def test_flag(ring):
+    """the flag word bypasses the queued records"""
+    # pylint: disable=redefined-outer-name
+    ring.put(CMD_SEGMENT, 1)
+    assert ring.get_flag() == 0
+    ring.set_flag(StopMode.SOFTSTOP.value)
+    assert ring.get_flag() == StopMode.SOFTSTOP.value
+    assert ring.get()[1] == 1
+
+
+
+def test_close_twice():
+    """closing a closed ring does nothing"""
+    shm_ring = ShmRing(slots=4)
+    shm_ring.close()
+    shm_ring.close()
+
+
+
+@pytest.mark.parametrize("stop_mode", [StopMode.SOFTSTOP, StopMode.HARDSTOP])
+def test_stop_during_segment(ring, tmc_pair, stop_mode):
+    """the stop watcher forwards the flag to the running segment and clears it"""
+    # pylint: disable=redefined-outer-name
+    corexy = TMC_CoreXY(*tmc_pair)
+    finished = threading.Event()
+    watcher = threading.Thread(target=tmc_process._watch_stop,
+                               args=(ring, corexy, finished), daemon=True)
+    watcher.start()
+    timer = threading.Timer(0.05, ring.set_flag, (stop_mode.value,))
+    timer.start()
+    try:
+        assert corexy.run_segments([(4000, 1000), (2000, 2000)]) == stop_mode
+    finally:
+        timer.join()
+        finished.set()
+        watcher.join(1)
+    assert not watcher.is_alive()
+    assert ring.get_flag() == 0
+    assert 0 < corexy.tmc_a.get_current_position() < 4000
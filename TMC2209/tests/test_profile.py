@@ -0,0 +1,64 @@
+#pylint: disable=invalid-name
+"""
+tests of the driver profiles, which are applied with diff-only register writes
+"""
+
+import json
+import pytest
+from src._TMC_2209_profile import DEFAULT_PROFILE, load_profile
+from src import _TMC_2209_reg as tmc_reg
+
+
+
+def sent(tmc, fake_serial):
+    """returns the registers of the write and of the read frames since the last call"""
+    tmc.tmc_uart.flush_serial_buffer()
+    writes, reads = fake_serial.writes(), fake_serial.reads()
+    fake_serial.frames.clear()
+    return writes, reads
+
+
+
+def test_unknown_setting(tmc, fake_serial):
+    """a profile with a setting which is not a profile setting is not applied"""
+    with pytest.raises(ValueError):
+        tmc.apply_profile({"current": 300, "max_speed": 1000})
+    writes, _ = sent(tmc, fake_serial)
+    assert not writes
+
+
+
+def test_apply_profile(tmc, fake_serial):
+    """the first apply writes each changed register once;
+    applying the same profile again sends no frame at all"""
+    tmc.apply_profile(DEFAULT_PROFILE)
+    writes, reads = sent(tmc, fake_serial)
+    assert sorted(writes) == sorted([tmc_reg.GCONF, tmc_reg.IHOLD_IRUN, tmc_reg.CHOPCONF])
+    assert reads.count(tmc_reg.GCONF) <= 1
+    assert reads.count(tmc_reg.CHOPCONF) <= 1
+    assert tmc.get_microstepping_resolution() == 2
+    assert tmc.get_interpolation()
+    sent(tmc, fake_serial)
+
+    tmc.apply_profile(DEFAULT_PROFILE)
+    assert sent(tmc, fake_serial) == ([], [])
+
+
+
+def test_apply_profile_diff(tmc, fake_serial):
+    """only the registers which differ from the applied profile are written"""
+    tmc.apply_profile(DEFAULT_PROFILE)
+    sent(tmc, fake_serial)
+    tmc.apply_profile(dict(DEFAULT_PROFILE, spreadcycle=True))
+    writes, reads = sent(tmc, fake_serial)
+    assert writes == [tmc_reg.GCONF]
+    assert reads == [tmc_reg.IFCNT]
+    assert fake_serial.regs[tmc_reg.GCONF] & tmc_reg.en_spreadcycle
+
+
+
+def test_load_profile(tmp_path):
+    """profiles are stored as JSON"""
+    path = tmp_path / "profile.json"
+    path.write_text(json.dumps(DEFAULT_PROFILE), encoding="utf-8")
+    assert load_profile(path) == DEFAULT_PROFILE
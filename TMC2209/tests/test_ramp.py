@@ -0,0 +1,93 @@
+#pylint: disable=invalid-name
+"""
+tests of the ramp planning module
+"""
+
+import numpy as np
+import pytest
+from src._TMC_2209_ramp import RampProfile, plan_ramp, estimate_duration
+
+
+MOVES = [
+    (1, 4000, 20000, 0.0, 0.0),
+    (10, 4000, 20000, 0.0, 0.0),
+    (400, 4000, 20000, 0.0, 0.0),
+    (5000, 4000, 20000, 0.0, 0.0),
+    (300, 4000, 20000, 1000.0, 500.0),
+    (200, 4000, 20000, 4000.0, 4000.0),
+]
+
+
+
+@pytest.mark.parametrize("profile", list(RampProfile))
+@pytest.mark.parametrize("steps, max_speed, acceleration, entry_speed, exit_speed", MOVES)
+def test_plan_deadlines(steps, max_speed, acceleration, entry_speed, exit_speed, profile):
+    """every step has one increasing deadline; the last one is the duration"""
+    plan = plan_ramp(steps, max_speed, acceleration, entry_speed, exit_speed, profile)
+    assert len(plan.deadlines) == steps
+    assert np.all(plan.intervals > 0)
+    assert plan.duration == plan.deadlines[-1]
+    assert 0 <= plan.accel_end <= plan.decel_start <= steps
+
+
+
+@pytest.mark.parametrize("profile", list(RampProfile))
+@pytest.mark.parametrize("steps, max_speed, acceleration, entry_speed, exit_speed", MOVES)
+def test_estimate_duration(steps, max_speed, acceleration, entry_speed, exit_speed, profile):
+    """the closed form estimate matches the planned duration"""
+    plan = plan_ramp(steps, max_speed, acceleration, entry_speed, exit_speed, profile)
+    duration = estimate_duration(steps, max_speed, acceleration, entry_speed, exit_speed,
+                                 profile)
+    assert duration == pytest.approx(plan.duration / 1e9, abs=1e-8)
+
+
+
+@pytest.mark.parametrize("steps", range(1, 40))
+def test_short_moves(steps):
+    """the acceleration of short moves ends before the deceleration starts"""
+    plan = plan_ramp(steps, 4000, 20000)
+    assert plan.accel_end <= plan.decel_start
+    assert plan.accel_end <= steps // 2
+
+
+
+def test_trapezoid():
+    """a long move accelerates in v²/2a steps and cruises at max speed"""
+    plan = plan_ramp(5000, 4000, 20000)
+    assert plan.accel_end == 400
+    assert plan.decel_start == 4599
+    assert plan.intervals[plan.accel_end:plan.decel_start] == pytest.approx(250000, abs=1)
+    assert plan.duration / 1e9 == pytest.approx(2 * 0.2 + 4200 / 4000)
+
+
+
+def test_scurve():
+    """the S-curve ramps take 1.5 times as long and as far,
+    because the acceleration is their peak acceleration"""
+    trapezoid = plan_ramp(5000, 4000, 20000)
+    scurve = plan_ramp(5000, 4000, 20000, profile=RampProfile.SCURVE)
+    assert scurve.accel_end == 600
+    assert scurve.decel_start == 4399
+    assert scurve.intervals[scurve.accel_end:scurve.decel_start] == pytest.approx(250000, abs=1)
+    # both ramps take 0.1 s longer and shorten the cruise by 200 steps
+    assert (scurve.duration - trapezoid.duration) / 1e9 == pytest.approx(2 * (0.1 - 200 / 4000))
+
+
+
+def test_sign_and_zero():
+    """the sign of the steps is ignored and no steps need no time"""
+    assert plan_ramp(-300, 4000, 20000).duration == plan_ramp(300, 4000, 20000).duration
+    assert estimate_duration(-300, 4000, 20000) == estimate_duration(300, 4000, 20000)
+    plan = plan_ramp(0, 4000, 20000)
+    assert len(plan.deadlines) == 0
+    assert plan.duration == 0
+    assert estimate_duration(0, 4000, 20000) == 0
+
+
+
+def test_plan_is_read_only():
+    """plans are cached, so they must not be changed by the stepping loops"""
+    plan = plan_ramp(100, 4000, 20000)
+    assert plan_ramp(100, 4000, 20000) is plan
+    with pytest.raises(ValueError):
+        plan.deadlines[0] = 0
@@ -0,0 +1,83 @@
+#pylint: disable=invalid-name
+"""
+tests of the step scheduler with a fake clock
+"""
+
+import pytest
+from src import _TMC_2209_scheduler
+from src._TMC_2209_scheduler import StepScheduler
+from src._TMC_2209_ramp import plan_ramp, estimate_duration
+
+
+
+class FakeClock:
+    """clock of the scheduler, which advances 1 µs per read
+    and by the requested time per sleep"""
+
+    now = 0
+
+
+
+    def perf_counter_ns(self):
+        """returns the time in ns and advances it"""
+        self.now += 1000
+        return self.now
+
+
+
+    def sleep(self, seconds):
+        """advances the time without waiting"""
+        self.now += int(seconds * 1e9)
+
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """FakeClock, which replaces the time module of the scheduler"""
+    fake = FakeClock()
+    monkeypatch.setattr(_TMC_2209_scheduler, "time", fake)
+    return fake
+
+
+
+def run_move(clock, deadlines, stalls):
+    """waits for all deadlines of a move and stalls the loop after some steps
+
+    Returns:
+        tuple: start time and the deadlines which were waited for
+    """
+    # pylint: disable=redefined-outer-name
+    scheduler = StepScheduler()
+    starttime = scheduler.start()
+    targets = []
+    for i, deadline in enumerate(deadlines):
+        targets.append(scheduler.wait_for_step(starttime + deadline))
+        clock.now += stalls.get(i, 0)
+    return starttime, targets
+
+
+
+def test_on_time(clock):
+    """without stalls the deadlines are not delayed"""
+    # pylint: disable=redefined-outer-name
+    plan = plan_ramp(5000, 4000, 20000)
+    starttime, targets = run_move(clock, plan.deadlines.tolist(), {})
+    assert [t - starttime for t in targets] == plan.deadlines.tolist()
+
+
+
+def test_stalls_are_paid_back(clock):
+    """the delay of stalls is paid back, so the move ends close to the estimate
+    without exceeding the planned speed by more than 1/16"""
+    # pylint: disable=redefined-outer-name
+    plan = plan_ramp(5000, 4000, 20000)
+    estimate = estimate_duration(5000, 4000, 20000)
+    stalls = {100: 2000000, 1000: 5000000, 2500: 2000000, 4000: 1000000}
+    starttime, targets = run_move(clock, plan.deadlines.tolist(), stalls)
+    # the last stall, 1000 steps before the end, is paid back as well
+    assert (targets[-1] - starttime) / 1e9 == pytest.approx(estimate, abs=1e-6)
+    # each step on time pays back 1/16 of its interval from the following one;
+    # the deadline after a stall is missed, so the shift grows once more
+    for i in range(2, len(targets)):
+        if i - 1 not in stalls and i - 2 not in stalls:
+            assert targets[i] - targets[i-1] >= plan.intervals[i] - plan.intervals[i-1] // 16
@@ -0,0 +1,262 @@
+#pylint: disable=invalid-name
+"""
+tests of the UART module: crc, frames, verified writes
+and the shadow copies of the registers in batches
+"""
+
+import threading
+import pytest
+from src._TMC_2209_uart import TMC_UART, TMC_UART_Bus, CRC8_TABLE, MAX_UNVERIFIED_WRITES
+from src._TMC_2209_logger import TMC_logger, Loglevel
+from src import _TMC_2209_reg as tmc_reg
+from conftest import FakeTMCSerial
+
+
+
+def crc8_bitwise(datagram):
+    """crc8 as given in the TMC2209 datasheet, one bit at a time"""
+    crc = 0
+    for byte in datagram:
+        for _ in range(8):
+            if (crc >> 7) ^ (byte & 0x01):
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+            byte >>= 1
+    return crc
+
+
+
+@pytest.fixture
+def uart():
+    """TMC_UART without a serial port"""
+    return TMC_UART(None, None, 115200)
+
+
+
+def test_crc_table(uart):
+    """the table driven crc equals the bitwise crc of the datasheet"""
+    # pylint: disable=redefined-outer-name
+    assert len(CRC8_TABLE) == 256
+    for byte in range(256):
+        assert uart.compute_crc8_atm([byte]) == crc8_bitwise([byte])
+    for frame in ([0x55, 0x00, 0x6C], [0x55, 0x03, 0xEC, 0x10, 0x00, 0x00, 0x53],
+                  [0x05, 0xFF, 0x02, 0x00, 0x00, 0x00, 0x2A]):
+        assert uart.compute_crc8_atm(frame) == crc8_bitwise(frame)
+    # the read request of GCONF from the datasheet
+    assert uart.compute_crc8_atm([0x05, 0x00, 0x00]) == 0x48
+
+
+
+def test_frames(uart):
+    """the frames carry the address, the register and the crc"""
+    # pylint: disable=redefined-outer-name
+    uart.mtr_id = 2
+    sent = []
+    uart.bus = type("Bus", (), {"write": lambda self, frame: sent.append(frame)})()
+    uart.write_reg(tmc_reg.CHOPCONF, 0x10000053)
+    assert sent[0] == bytes([0x55, 2, 0xEC, 0x10, 0x00, 0x00, 0x53,
+                             crc8_bitwise([0x55, 2, 0xEC, 0x10, 0x00, 0x00, 0x53])])
+    assert uart.get_shadow(tmc_reg.CHOPCONF) == 0x10000053
+    uart.bus = None
+
+
+
+def test_unchanged_writes_are_skipped(tmc, fake_serial):
+    """a write which equals the shadow copy costs no frame"""
+    tmc.set_interpolation(False)
+    frames = len(fake_serial.frames)
+    tmc.set_interpolation(False)
+    with tmc.batch():
+        tmc.set_interpolation(False)
+    assert len(fake_serial.frames) == frames
+
+
+
+def test_reset_invalidates_shadow(tmc, fake_serial):
+    """after a reset of the TMC the shadow copies are read again"""
+    tmc.set_interpolation(False)
+    fake_serial.regs[tmc_reg.CHOPCONF] |= tmc_reg.intpol
+    fake_serial.regs[tmc_reg.GSTAT] = tmc_reg.reset
+    tmc.read_gstat()
+    assert tmc.tmc_uart.get_shadow(tmc_reg.CHOPCONF) is None
+    tmc.set_interpolation(False)
+    assert not fake_serial.regs[tmc_reg.CHOPCONF] & tmc_reg.intpol
+
+
+
+def test_batch_writes_at_the_end(tmc, fake_serial):
+    """the writes of a batch are sent at its end and verified with one IFCNT read"""
+    # the counter before the writes is read once and then counted on
+    tmc.get_interface_transmission_counter()
+    tmc.read_gconf()
+    tmc.read_chopconf()
+    fake_serial.frames.clear()
+    with tmc.batch():
+        tmc.set_interpolation(False)
+        tmc.set_vsense(True)
+        tmc.set_spreadcycle(True)
+        assert not fake_serial.writes()
+    assert fake_serial.writes() == [tmc_reg.CHOPCONF, tmc_reg.GCONF]
+    assert fake_serial.reads() == [tmc_reg.IFCNT]
+    assert not fake_serial.regs[tmc_reg.CHOPCONF] & tmc_reg.intpol
+    assert fake_serial.regs[tmc_reg.CHOPCONF] & tmc_reg.vsense
+    assert fake_serial.regs[tmc_reg.GCONF] & tmc_reg.en_spreadcycle
+
+
+
+def test_batch_reads_queued_value(tmc, fake_serial):
+    """a register with a queued write is read from the batch, not from the TMC"""
+    tmc.set_interpolation(True)
+    with tmc.batch():
+        tmc.set_interpolation(False)
+        assert not tmc.get_interpolation()
+        # the second setter works on the queued value, not on the register
+        tmc.set_vsense(True)
+    chopconf = fake_serial.regs[tmc_reg.CHOPCONF]
+    assert not chopconf & tmc_reg.intpol
+    assert chopconf & tmc_reg.vsense
+
+
+
+def test_aborted_batch(tmc, fake_serial):
+    """an exception in the batch drops the writes and the shadow copies"""
+    tmc.set_interpolation(True)
+    with pytest.raises(RuntimeError):
+        with tmc.batch():
+            tmc.set_interpolation(False)
+            raise RuntimeError
+    assert fake_serial.regs[tmc_reg.CHOPCONF] & tmc_reg.intpol
+    assert tmc.tmc_uart.get_shadow(tmc_reg.CHOPCONF) is None
+    assert tmc.get_interpolation()
+
+
+
+def test_write_costs_one_frame(tmc, fake_serial):
+    """the writes are verified together with one IFCNT read before the next read"""
+    tmc.get_interface_transmission_counter()
+    tmc.read_gconf()
+    tmc.read_chopconf()
+    fake_serial.frames.clear()
+    tmc.set_interpolation(False)
+    tmc.set_vsense(True)
+    tmc.set_spreadcycle(True)
+    tmc.tmc_uart.flush_serial_buffer()
+    assert fake_serial.writes() == [tmc_reg.CHOPCONF, tmc_reg.CHOPCONF, tmc_reg.GCONF]
+    assert not fake_serial.reads()
+    tmc.get_microstep_counter()
+    assert fake_serial.reads() == [tmc_reg.IFCNT, tmc_reg.MSCNT]
+
+
+
+def test_unknown_counter(tmc, fake_serial):
+    """IFCNT is read before the first write, if its count is unknown"""
+    tmc.set_interpolation(False)
+    tmc.set_vsense(True)
+    tmc.tmc_uart.verify_writes()
+    assert fake_serial.reads() == [tmc_reg.CHOPCONF, tmc_reg.IFCNT, tmc_reg.IFCNT]
+    assert len(fake_serial.writes()) == 2
+
+
+
+class LossySerial(FakeTMCSerial):
+    """FakeTMCSerial, which loses the next write frames"""
+
+    lost = 0
+
+
+
+    def write(self, data):
+        """loses a write frame while lost is set"""
+        if len(data) == 8 and self.lost:
+            self.lost -= 1
+            return len(data)
+        return super().write(data)
+
+
+
+def test_lost_write_is_sent_again(tmc):
+    """the verification sends the last value of every unverified register again"""
+    ser = LossySerial()
+    tmc.tmc_uart.bus = TMC_UART_Bus(tmc.tmc_logger, ser, 0)
+    tmc.get_interface_transmission_counter()
+    tmc.read_chopconf()
+    ser.lost = 1
+    tmc.set_interpolation(False)
+    tmc.set_vsense(True)
+    assert tmc.tmc_uart.verify_writes()
+    assert not ser.regs[tmc_reg.CHOPCONF] & tmc_reg.intpol
+    assert ser.regs[tmc_reg.CHOPCONF] & tmc_reg.vsense
+    assert ser.writes() == [tmc_reg.CHOPCONF, tmc_reg.CHOPCONF]
+    tmc.tmc_uart.bus.close()
+    tmc.tmc_uart.bus = None
+
+
+
+def test_max_unverified_writes(tmc, fake_serial):
+    """a stream of writes without reads is verified before IFCNT wraps around"""
+    tmc.get_interface_transmission_counter()
+    fake_serial.frames.clear()
+    for vactual in range(1, 2 * MAX_UNVERIFIED_WRITES + 1):
+        tmc.set_vactual(vactual)
+    assert fake_serial.reads() == [tmc_reg.IFCNT, tmc_reg.IFCNT]
+    assert len(fake_serial.writes()) == 2 * MAX_UNVERIFIED_WRITES
+
+
+
+class MultiDropSerial(FakeTMCSerial):
+    """FakeTMCSerial with one register set per driver address"""
+
+
+
+    def __init__(self, addresses):
+        """constructor
+
+        Args:
+            addresses (iterable): driver addresses on the bus
+        """
+        super().__init__()
+        self.drivers = {address: dict(self.regs) for address in addresses}
+
+
+
+    def write(self, data):
+        """receives one frame for the driver of its address"""
+        self.regs = self.drivers[data[1]]
+        return super().write(data)
+
+
+
+def test_shared_bus_threads():
+    """two drivers on one bus, used from two threads at the same time:
+    every frame arrives whole and every reply reaches the driver which asked"""
+    ser = MultiDropSerial((0, 1))
+    tmc_logger = TMC_logger(Loglevel.ERROR, "shared bus")
+    bus = TMC_UART_Bus(tmc_logger, ser, 0)
+    errors = []
+
+    def use_driver(address):
+        uart = TMC_UART(tmc_logger, None, 115200, address)
+        uart.bus = bus
+        for i in range(300):
+            value = address << 16 | i
+            uart.write_reg(tmc_reg.TPWMTHRS, value)
+            read = uart.read_int(tmc_reg.TPWMTHRS)
+            if read != value:
+                errors.append((address, value, read))
+
+    threads = [threading.Thread(target=use_driver, args=(address,)) for address in (0, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bus.close()
+
+    assert not errors
+    # FakeTMCSerial checks the crc of every frame it receives
+    assert all(len(frame) in (4, 8) for frame in ser.frames)
+    assert len(ser.frames) == 2 * 2 * 300
+    assert {frame[1] for frame in ser.frames} == {0, 1}
+    # the frames of both drivers were interleaved on the bus, not sent one driver after the other
+    addresses = [frame[1] for frame in ser.frames]
+    assert sum(a != b for a, b in zip(addresses, addresses[1:])) > 2
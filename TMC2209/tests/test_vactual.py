@@ -0,0 +1,89 @@
+#pylint: disable=invalid-name
+"""
+tests of the VACTUAL motion backend with a simulated step generator
+"""
+
+import time
+import pytest
+from src.TMC_2209_StepperDriver import MotionBackend
+from src._TMC_2209_uart import TMC_UART_Bus
+from src import _TMC_2209_reg as tmc_reg
+from conftest import FakeTMCSerial
+
+VACTUAL_UNIT = 12000000 / (1 << 24)     # µsteps per second of one VACTUAL unit
+
+
+
+class StepGeneratorSerial(FakeTMCSerial):
+    """FakeTMCSerial whose driver moves with the velocity of VACTUAL
+    and counts its microsteps in MSCNT.
+    the clock of the driver runs fast by the given factor"""
+
+    position = 0.0
+    _velocity = 0.0
+    _since = 0.0
+
+
+
+    def __init__(self, msres, clock_factor):
+        """constructor
+
+        Args:
+            msres (int): µstep resolution of the driver
+            clock_factor (float): real speed per commanded speed
+        """
+        super().__init__()
+        self.msres = msres
+        self.clock_factor = clock_factor
+        self._since = time.perf_counter()
+
+
+
+    def _move(self):
+        """integrates the velocity up to now"""
+        now = time.perf_counter()
+        self.position += self._velocity * (now - self._since)
+        self._since = now
+        self.regs[tmc_reg.MSCNT] = round(self.position) * 256 // self.msres % 1024
+
+
+
+    def write(self, data):
+        """receives one frame; a VACTUAL write changes the velocity"""
+        self._move()
+        written = super().write(data)
+        if len(data) == 8 and data[2] & 0x7F == tmc_reg.VACTUAL:
+            # VACTUAL is a signed 24 bit value
+            vactual = self.regs[tmc_reg.VACTUAL] & 0xFFFFFF
+            if vactual & 0x800000:
+                vactual -= 1 << 24
+            self._velocity = vactual * VACTUAL_UNIT * self.clock_factor
+        return written
+
+
+
+@pytest.fixture(params=[1.0, 1.02, 0.98], ids=["exact", "fast", "slow"])
+def generator(tmc, request):
+    """driver with the VACTUAL backend at 16 µsteps and its simulated step generator"""
+    ser = StepGeneratorSerial(16, request.param)
+    bus = TMC_UART_Bus(tmc.tmc_logger, ser, 0)
+    tmc.tmc_uart.bus = bus
+    tmc.set_microstepping_resolution(16)
+    tmc.set_motion_backend(MotionBackend.VACTUAL)
+    tmc.set_vactual_update_interval(0.01)
+    yield ser
+    tmc.tmc_uart.bus = None
+    bus.close()
+
+
+
+@pytest.mark.parametrize("steps", [800, -500])
+def test_vactual_position(tmc, generator, steps):
+    """the position is corrected with MSCNT, also when the clock of the driver is off"""
+    tmc.set_max_speed(2000)
+    tmc.set_acceleration(20000)
+    tmc.set_vactual_creep_speed(100)
+    tmc.run_to_position_steps(steps)
+    assert tmc.get_current_position() == steps
+    assert generator.position == pytest.approx(steps, abs=1)
+    assert generator.regs[tmc_reg.VACTUAL] == 0
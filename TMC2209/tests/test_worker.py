@@ -0,0 +1,101 @@
+#pylint: disable=invalid-name
+"""
+tests of the motion worker, which runs the threaded movements
+"""
+
+import threading
+from concurrent.futures import Future
+import pytest
+from src.TMC_2209_StepperDriver import StopMode
+from src._TMC_2209_worker import MotionWorker
+
+
+
+@pytest.fixture
+def worker():
+    """MotionWorker, which is shut down after the test"""
+    motion_worker = MotionWorker("test motion")
+    yield motion_worker
+    motion_worker.shutdown()
+
+
+
+def block(motion_worker):
+    """queues a command which blocks the worker until the returned event is set"""
+    release = threading.Event()
+    motion_worker.submit(release.wait, 5)
+    return release
+
+
+
+def test_commands_in_order(worker):
+    """the commands run one after another in the same thread"""
+    release = block(worker)
+    calls = []
+    futures = [worker.submit(lambda i: calls.append((i, threading.get_ident())) or i, i)
+               for i in range(5)]
+    assert not any(future.done() for future in futures)
+    release.set()
+    assert [future.result(timeout=5) for future in futures] == list(range(5))
+    assert [i for i, _ in calls] == list(range(5))
+    assert len({ident for _, ident in calls}) == 1
+    assert calls[0][1] != threading.get_ident()
+
+
+
+def test_exception(worker):
+    """an exception of a command completes its future and does not end the worker"""
+    failed = worker.submit(int, "no number")
+    with pytest.raises(ValueError):
+        failed.result(timeout=5)
+    assert worker.submit(int, "42").result(timeout=5) == 42
+
+
+
+def test_shutdown_finishes_queued_commands(worker):
+    """shutdown waits for the commands, which were queued before it"""
+    release = block(worker)
+    future = worker.submit(sum, [1, 2, 3])
+    release.set()
+    worker.shutdown()
+    assert future.result(timeout=0) == 6
+
+
+
+def test_threaded_movements(tmc):
+    """the threaded movements return futures and run in the order they were queued;
+    the position of the last queued movement is reached"""
+    tmc.set_current_position(0)
+    first = tmc.run_to_position_steps_threaded(100)
+    second = tmc.run_to_position_steps_threaded(70)
+    assert isinstance(first, Future)
+    assert first.result(timeout=5) == StopMode.NO
+    assert second.result(timeout=5) == StopMode.NO
+    assert tmc.get_current_position() == 70
+    assert tmc.wait_for_movement_finished_threaded() == StopMode.NO
+    tmc._motion_worker.shutdown()
+
+
+
+def test_stop_before_the_movement_starts(tmc):
+    """a stop, which is issued while the movement is still queued, is not lost"""
+    tmc.set_current_position(0)
+    tmc.run_to_position_steps_threaded(0)
+    release = block(tmc._motion_worker)
+    future = tmc.run_to_position_steps_threaded(100)
+    tmc.stop()
+    release.set()
+    assert future.result(timeout=5) == StopMode.HARDSTOP
+    assert tmc.get_current_position() == 0
+    tmc._motion_worker.shutdown()
+
+
+
+def test_stop_before_queueing(tmc):
+    """a stop of an earlier movement does not stop the next queued movement"""
+    tmc.set_current_position(0)
+    tmc.stop()
+    future = tmc.run_to_position_steps_threaded(50)
+    assert future.result(timeout=5) == StopMode.NO
+    assert tmc.get_current_position() == 50
+    tmc._motion_worker.shutdown()
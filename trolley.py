@@ -1,5 +1,10 @@
+import os
+import math
 import sys
 import time
+import json
+import tempfile
+from contextlib import contextmanager
 from TMC2209.src.TMC_2209_StepperDriver import *
 from RPi import GPIO
 from chess_board import chess_board_inst, Move
@@ -14,15 +19,56 @@ ENABLE1_PIN = 26
 STEP1_PIN = 13
 DIR1_PIN = 19
 
+# StallGuard DIAG output of tmc1, the only driver homed against an end stop.
+# Interrupt homing is opt-in: with -1 (not wired) the StallGuard result is polled over UART
+DIAG1_PIN = -1
+
 # Define variables for aDir, bDir, aPower, bPower
 aDir = 0
 bDir = 1
 aPower = 2
 bPower = 3
 
+# Steps per square and per diagonal at BASE_MSRES; speeds and accelerations use the same unit
+BASE_MSRES = 2
 SQUARE_STEP = 505
 DIAG_STEP = 1010
 
+# Without a fixed junction_speed, the motors may change their speed at the corners of blended moves
+# by as much as the ramp gains within these steps, so a corner jolts the piece no more than the start
+# of a move of a sixteenth of a square (~140 µsteps/s loaded, ~250 µsteps/s free with the default settings)
+JUNCTION_STEPS = SQUARE_STEP / 16
+
+# Desired driver settings; only the registers which differ are written at startup
+DRIVER_PROFILE = {
+    "direction_reg": False,
+    "current": 300,
+    "interpolation": True,
+    "spreadcycle": False,
+    "microstepping_resolution": BASE_MSRES,
+    "internal_rsense": False,
+    # TPWMTHRS survives a restart of the program; set_chopper_switch sets it again
+    "stealthchop_threshold": 0
+}
+
+# Time the piece is held on the target square before the magnet is released
+MAGNET_RELEASE_TIME = 1
+
+# Last known position, used to skip homing after a restart
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "trolley_state.json")
+STATE_MAX_AGE = 24 * 3600
+
+# Loaded moves stay below this multiple of loaded_speed in StealthChop
+STEALTHCHOP_MARGIN = 1.2
+
+# Direction in which MSCNT counts for positive steps with set_direction_reg(False)
+MSCNT_DIRECTION = 1
+
+# Core and SCHED_FIFO priority of the opt-in step generation process (isolcpus=3 in cmdline.txt);
+# without that core the process runs with normal scheduling
+MOTION_CPU = 3
+MOTION_PRIORITY = 50
+
 class Trolley:
 
     # Motor control settings [aDir, bDir, aPower, bPower]
@@ -37,38 +83,59 @@ class Trolley:
         "DUPR": [1, -1, 1, 0]
     }
 
-    def __init__(self, free_speed = 1000, free_acceleration = 1000, loaded_speed = 500, loaded_acceleration = 300):
+    def __init__(self, free_speed = 1000, free_acceleration = 1000, loaded_speed = 500, loaded_acceleration = 300,
+                 junction_speed = None, free_profile = RampProfile.TRAPEZOID, loaded_profile = RampProfile.SCURVE,
+                 state_file = STATE_FILE, motion_process = False, current_boost = 1.5,
+                 free_msres = BASE_MSRES, loaded_msres = 8):
 
         self.free_speed = free_speed
         self.free_acceleration = free_acceleration
+        self.free_profile = free_profile
         self.loaded_speed = loaded_speed
         self.loaded_acceleration = loaded_acceleration
+        self.loaded_profile = loaded_profile
+        self.free_msres = free_msres
+        self.loaded_msres = loaded_msres
+        self.msres = BASE_MSRES
+        self.loaded = False
+        self.junction_speed = junction_speed
         self.currentX = 7
         self.currentY = 7
         self.stallguard_threshold_1 = 250
         self.stallguard_threshold_2 = 250
         self.castling = None
+        self.queued_segments = []
+        self.blending = False
+        self.estimating = False
+        self.estimate_params = None
+        self.estimated_time = 0.0
+        self.state_file = state_file
         # Pin Setup for ElectroMagnet
         GPIO.setmode(GPIO.BCM)  
         GPIO.setup(MAGNET_PIN, GPIO.OUT)  
         self.magnet_OFF()
 
-        # Set up the 2 Core XY motors
+        # Set up the 2 Core XY motors; they share one UART bus on /dev/serial0
         self.tmc2 = TMC_2209(ENABLE0_PIN, STEP0_PIN, DIR0_PIN, driver_address=0)
         self.tmc1 = TMC_2209(ENABLE1_PIN, STEP1_PIN, DIR1_PIN, driver_address=1)
+        if motion_process:
+            # Steps are generated in their own process, away from the GIL of the web server and OpenCV
+            self.corexy = TMC_CoreXYProcess(self.tmc1, self.tmc2, cpu=MOTION_CPU, priority=MOTION_PRIORITY)
+        else:
+            self.corexy = TMC_CoreXY(self.tmc1, self.tmc2)
+        self.corexy.set_junction_speed(self.get_junction_speed(loaded=False))
 
         for tmc in [self.tmc1, self.tmc2]:
 
             tmc.tmc_logger.set_loglevel(Loglevel.DEBUG)
-            tmc.set_direction_reg(False)
-            tmc.set_current(300)
-            tmc.set_interpolation(True)
-            tmc.set_spreadcycle(False)
-            tmc.set_microstepping_resolution(2)
-            tmc.set_internal_rsense(False)
+            # More torque while accelerating, without heating the motors while cruising
+            tmc.apply_profile(dict(DRIVER_PROFILE, current_boost=current_boost))
+            tmc.set_mscnt_direction(MSCNT_DIRECTION)
             tmc.set_motor_enabled(True)
             
-        self.move_to_chess_origin()
+        if not self.restore_state():
+            self.move_to_chess_origin()
+        self.set_chopper_switch()
         self.take_initial_position()
 
     def move_to_chess_origin(self):
@@ -80,16 +147,41 @@ class Trolley:
         #Find one edge
         self.move_in_direction(1, "DDOWNL")
         self.tmc2.run_to_position_steps_threaded(10000, MovementAbsRel.RELATIVE)
-        self.tmc1.take_me_home(threshold=self.stallguard_threshold_1)
+        self.home_tmc1(self.stallguard_threshold_1)
         self.tmc2.stop()
+        # A disabled motor can turn freely, so a saved position is no longer valid
+        self.invalidate_state()
         self.tmc2.set_motor_enabled(False)
         
         # Find the physical origin
-        self.tmc1.take_me_home(threshold=self.stallguard_threshold_2)
+        self.home_tmc1(self.stallguard_threshold_2)
         self.tmc2.set_motor_enabled(True)
         
         # Move to chess origin
         self.move_in_direction(0.75, "XLEFT")
+        for tmc in [self.tmc1, self.tmc2]:
+            tmc.set_mscnt_reference()
+
+    def rehome(self):
+        # The origin is found at BASE_MSRES
+        for tmc in [self.tmc1, self.tmc2]:
+            tmc.change_microstepping_resolution(BASE_MSRES)
+        self.msres = BASE_MSRES
+        self.move_to_chess_origin()
+        self.currentX = 7
+        self.currentY = 7
+
+    def check_position(self):
+        # MSCNT shows step pulses the drivers missed; small errors are corrected in place
+        return all([tmc.check_position() for tmc in [self.tmc1, self.tmc2]])
+
+    def home_tmc1(self, threshold):
+        # The DIAG interrupt stops the motor on the first stall edge,
+        # otherwise the StallGuard result has to be polled over UART
+        if DIAG1_PIN == -1:
+            self.tmc1.take_me_home(threshold=threshold)
+        else:
+            self.tmc1.home_stallguard(DIAG1_PIN, threshold, speed_fast=self.free_speed)
 
     def move_in_direction(self, inc, direction: str):
         
@@ -97,19 +189,38 @@ class Trolley:
         if direction in self.MOTOR_DIREC:
             bits = self.MOTOR_DIREC[direction]
             if direction in ["XLEFT", "XRIGHT", "YUP", "YDOWN"]: 
-                base_step = int(SQUARE_STEP*inc)
+                base_step = int(SQUARE_STEP*inc*self.msres/BASE_MSRES)
             elif direction in ["DUPL", "DUPR", "DDOWNL", "DDOWNR"]:
-                base_step = int(DIAG_STEP*inc)
-
-            if bits[aPower]:
-                steps = base_step * bits[aDir]
-                self.tmc1.run_to_position_steps_threaded(steps, MovementAbsRel.RELATIVE)
-            if bits[bPower]:
-                steps = base_step * bits[bDir]
-                self.tmc2.run_to_position_steps_threaded(steps, MovementAbsRel.RELATIVE)
-
-            self.tmc1.wait_for_movement_finished_threaded()
-            self.tmc2.wait_for_movement_finished_threaded()
+                base_step = int(DIAG_STEP*inc*self.msres/BASE_MSRES)
+
+            steps_a = base_step * bits[aDir] * bits[aPower]
+            steps_b = base_step * bits[bDir] * bits[bPower]
+            self.queued_segments.append((steps_a, steps_b))
+            if not self.blending:
+                self.flush_segments()
+
+    @contextmanager
+    def blended_moves(self):
+        # Queue all moves made inside the block and run them without stopping in between
+        self.queued_segments = []
+        self.blending = True
+        try:
+            yield
+            self.blending = False
+            self.flush_segments()
+        finally:
+            # Moves queued before an error are dropped instead of running with the next move
+            self.blending = False
+            self.queued_segments = []
+
+    def flush_segments(self):
+        segments = self.queued_segments
+        self.queued_segments = []
+        if self.estimating:
+            self.estimated_time += self.corexy.estimate_segments(segments, *self.estimate_params)
+            return
+        # Both belts are stepped from one timeline so diagonals stay straight
+        self.corexy.run_segments(segments)
 
     def move_rook_castling(self):
         if self.castling[0] == 'white':
@@ -257,35 +368,133 @@ class Trolley:
 
     def make_move(self, move_string, rook_castling = False):
         move = self.chess_to_cartesian(move_string)
+        self.invalidate_state()
         if rook_castling:
             print(move_string)
         # Bring the trolley to the piece
         free_move = Move(self.currentX, self.currentY, move.startX, move.startY)
         self.set_speed_acceleration(loaded=False)
-        self.calculate_movement(free_move)
+        with self.blended_moves():
+            self.calculate_movement(free_move)
+        if not self.check_position():
+            # Too far off to pick up the piece, start again from the origin
+            print("Lost steps, homing again")
+            self.rehome()
+            free_move = Move(self.currentX, self.currentY, move.startX, move.startY)
+            self.set_speed_acceleration(loaded=False)
+            with self.blended_moves():
+                self.calculate_movement(free_move)
 
         # Make a move with that piece
         self.set_speed_acceleration(loaded=True)
         self.magnet_ON()
-        self.calculate_movement(move, rook_castling=rook_castling, loaded_move=True)
-        time.sleep(1)
+        with self.blended_moves():
+            self.calculate_movement(move, rook_castling=rook_castling, loaded_move=True)
+        time.sleep(MAGNET_RELEASE_TIME)
         self.magnet_OFF()
 
         self.currentX = move.endX
         self.currentY = move.endY
+        if not self.check_position():
+            print("Lost steps, homing again")
+            self.rehome()
+        self.save_state()
         chess_board_inst.move_piece(move)
         
         if self.castling is not None:
             print(self.castling)
             self.make_move(self.castling[2], rook_castling = True)
 
+    def estimate(self, move_string):
+        # Predict how long make_move will take, without moving the trolley
+        saved_state = (self.currentX, self.currentY, self.castling, self.msres, self.loaded)
+        self.estimating = True
+        self.estimated_time = 0.0
+        rook_castling = False
+        try:
+            while move_string is not None:
+                move = self.chess_to_cartesian(move_string)
+                free_move = Move(self.currentX, self.currentY, move.startX, move.startY)
+                self.msres = self.get_msres(loaded=False)
+                self.estimate_params = self.get_speed_acceleration(loaded=False)
+                self.corexy.set_junction_speed(self.get_junction_speed(loaded=False))
+                with self.blended_moves():
+                    self.calculate_movement(free_move)
+
+                self.msres = self.get_msres(loaded=True)
+                self.estimate_params = self.get_speed_acceleration(loaded=True)
+                self.corexy.set_junction_speed(self.get_junction_speed(loaded=True))
+                with self.blended_moves():
+                    self.calculate_movement(move, rook_castling=rook_castling, loaded_move=True)
+                self.estimated_time += MAGNET_RELEASE_TIME
+
+                self.currentX = move.endX
+                self.currentY = move.endY
+                # The rook move of a castling follows the king move
+                move_string = self.castling[2] if self.castling is not None else None
+                rook_castling = True
+        finally:
+            self.estimating = False
+            self.currentX, self.currentY, self.castling, self.msres, self.loaded = saved_state
+            self.corexy.set_junction_speed(self.get_junction_speed(self.loaded))
+        return self.estimated_time
+
     def take_initial_position(self):
         chess_board_inst.board = chess_board_inst.create_starting_board()
         free_move = Move(self.currentX, self.currentY, 3, 7)
+        self.invalidate_state()
         self.set_speed_acceleration(loaded=False)
-        self.calculate_movement(free_move)
+        with self.blended_moves():
+            self.calculate_movement(free_move)
         self.currentX = 3
         self.currentY = 7
+        self.save_state()
+
+    def save_state(self):
+        # Written to a temporary file and renamed, so a crash never leaves a half written state
+        state = {
+            "time": time.time(),
+            "x": self.currentX,
+            "y": self.currentY,
+            "motors": [tmc.get_warm_start_state() for tmc in [self.tmc1, self.tmc2]]
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.state_file), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_file)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def invalidate_state(self):
+        # The position is unknown while the trolley moves
+        try:
+            os.remove(self.state_file)
+        except FileNotFoundError:
+            pass
+
+    def restore_state(self):
+        # Trust the saved position only if it is recent and both drivers kept their state
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - state.get("time", 0) > STATE_MAX_AGE:
+            return False
+        motor_states = state.get("motors", [])
+        if len(motor_states) != 2:
+            return False
+        for tmc, motor_state in zip([self.tmc1, self.tmc2], motor_states):
+            if not tmc.restore_warm_start_state(motor_state):
+                return False
+        self.currentX = state["x"]
+        self.currentY = state["y"]
+        print("Warm start at", self.currentX, self.currentY)
+        return True
         
     def demo_test(self):
         # Prompt the user for a direction
@@ -295,14 +504,45 @@ class Trolley:
             # self.calculate_movement(move)
             self.make_move(position)
 
+    def set_chopper_switch(self):
+        # Loaded moves stay quiet in StealthChop, faster free moves get the torque of SpreadCycle
+        switch_speed = self.loaded_speed * STEALTHCHOP_MARGIN
+        if self.free_speed <= switch_speed:
+            switch_speed = 0
+        for tmc in [self.tmc1, self.tmc2]:
+            tmc.set_stealthchop_max_speed(switch_speed)
+
+    def get_msres(self, loaded):
+        # Fine microsteps keep slow loaded moves smooth, coarse ones keep the step rate of free moves low
+        return self.loaded_msres if loaded else self.free_msres
+
+    def get_speed_acceleration(self, loaded):
+        # Speeds are configured at BASE_MSRES
+        scale = self.get_msres(loaded) / BASE_MSRES
+        if loaded:
+            # Jerk-limited ramps keep the piece on the magnet
+            return self.loaded_speed*scale, self.loaded_acceleration*scale, self.loaded_profile
+        return self.free_speed*scale, self.free_acceleration*scale, self.free_profile
+
+    def get_junction_speed(self, loaded):
+        # Junction speeds are configured at BASE_MSRES, like the speeds
+        scale = self.get_msres(loaded) / BASE_MSRES
+        if self.junction_speed is not None:
+            return self.junction_speed*scale
+        speed, acceleration, _ = self.get_speed_acceleration(loaded)
+        return min(speed, math.sqrt(2*acceleration*JUNCTION_STEPS*scale))
+
     def set_speed_acceleration(self, loaded):
+        self.msres = self.get_msres(loaded)
+        self.loaded = loaded
+        for tmc in [self.tmc1, self.tmc2]:
+            tmc.change_microstepping_resolution(self.msres)
+        self.corexy.set_junction_speed(self.get_junction_speed(loaded))
+        speed, acceleration, profile = self.get_speed_acceleration(loaded)
         for tmc in [self.tmc1, self.tmc2]:    
-            if loaded:        
-                tmc.set_acceleration(self.loaded_acceleration)
-                tmc.set_max_speed(self.loaded_speed)
-            else:
-                tmc.set_acceleration(self.free_acceleration)
-                tmc.set_max_speed(self.free_speed)
+            tmc.set_acceleration(acceleration)
+            tmc.set_max_speed(speed)
+            tmc.set_ramp_profile(profile)
 
     def magnet_ON(self):
         GPIO.output(MAGNET_PIN, GPIO.HIGH)
@@ -312,6 +552,8 @@ class Trolley:
 
     def __del__(self):
         self.take_initial_position()
+        # The deinit of the drivers disables the motors; only a crash keeps them energized
+        self.invalidate_state()
         GPIO.cleanup(MAGNET_PIN)
 
 